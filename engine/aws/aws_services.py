@@ -1,21 +1,41 @@
+import json
+import threading
 import time
 import boto3
+import botocore.session
 from botocore.config import Config
 
 import datetime
+from collections import defaultdict
 from django.conf import settings
+from django.db import transaction
+from django.db.models import JSONField
 from django.utils import timezone
 from webapp.models import Settings, AWS_REGION
 from webapp.models import Settings as SettingsModal
-from engine.models import ClusterInfo, DbCredentials
+from engine.credentials import CredentialsProvider
+from engine.models import ClusterInfo, DbCredentials, Ec2DbInfo
+from engine.waiter import Waiter, WaitTimeout
 import logging
 logger = logging.getLogger(__name__)
 
 
+class RegionClients:
+    """
+    Dict-like map of region name to a boto client for one service.
+    A region's client is only built the first time it is asked for.
+    """
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+    def __getitem__(self, region_name):
+        return AWSServices.get_client(self.service_name, region_name)
+
+    def __repr__(self):
+        return "<RegionClients service:%s>" % (self.service_name)
+
+
 class AWSServices:
-    ec2_client_region_dict = dict()
-    rds_client_region_dict = dict()
-    cloudwatch_client_region_dict = dict()
     SERVICE_TYPE = ""
     """
     Environment Variables to be set
@@ -23,37 +43,181 @@ class AWSServices:
         - AWS_SECRET_ACCESS_KEY
         - AWS_REGION
     """
+    # Shared by every service, so the session is set up and each service model is loaded only once per process.
+    # The stored AWS secret is looked at again every CREDENTIALS_CACHE_TTL seconds, and when it changed,
+    # in this process or another one, the session and clients are built again with it.
+    _session = None
+    _credentials = None
+    _checked_at = None
+    _clients = dict()
+    _lock = threading.RLock()
+    # We're going to want to be a bit more resiliant to AWS errors
+    _config = Config(retries={'max_attempts': 13, 'mode': 'standard'})
 
     def __init__(self):
-        try:
-            cred = DbCredentials.objects.get(name="aws")
-            self.aws_session = boto3.Session(aws_access_key_id=cred.user_name, aws_secret_access_key=cred.password)
-            sts = self.aws_session.client('sts')
-            sts.get_caller_identity()
-            logger.info("Successfully create AWS Session using DB Credentials")
-        except Exception:
+        started = time.monotonic()
+        AWSServices.get_session()
+        self.ec2_client_region_dict = RegionClients('ec2')
+        self.rds_client_region_dict = RegionClients('rds')
+        self.cloudwatch_client_region_dict = RegionClients('cloudwatch')
+        logger.info(f"{self.SERVICE_TYPE or 'AWS'} service ready in {time.monotonic() - started:.3f}s")
+
+    @property
+    def aws_session(self):
+        return AWSServices.get_session()
+
+    @classmethod
+    def get_session(cls):
+        """
+        The shared session, built again along with the clients when the stored AWS secret changed
+        """
+        with cls._lock:
+            if cls._session is not None and time.monotonic() - cls._checked_at < settings.CREDENTIALS_CACHE_TTL:
+                return cls._session
+            credentials = CredentialsProvider().aws_env()
+            cls._checked_at = time.monotonic()
+            if cls._session is not None and credentials == cls._credentials:
+                return cls._session
+            if cls._session is not None:
+                logger.info("AWS credentials changed, building the AWS session and clients again")
+            botocore_session = botocore.session.get_session()
             try:
-                self.aws_session = boto3.Session()
-                logger.debug("Creating AWS Session using default/env credentials")
-            except Exception as e:
-                logger.error("Failed to create AWS Session using DB Credentials")
-                raise e
-        # We're going to want to be a bit more resiliant to AWS errors
-        config = Config(retries={'max_attempts': 13, 'mode': 'standard'})
-        self.ec2_client = self.aws_session.client('ec2', region_name=settings.DEFAULT_REGION, config=config)
-        self.rds_client = self.aws_session.client('rds', region_name=settings.DEFAULT_REGION, config=config)
-        for region in self.ec2_client.describe_regions()["Regions"]:
-            region_name = region["RegionName"]
-            self.ec2_client_region_dict[region_name] = self.aws_session.client('ec2', region_name=region_name, config=config)
-            self.rds_client_region_dict[region_name] = self.aws_session.client('rds', region_name=region_name, config=config)
-            self.cloudwatch_client_region_dict[region_name] = self.aws_session.client('cloudwatch',
-                                                                                      region_name=region_name, config=config)
+                if not credentials:
+                    raise DbCredentials.DoesNotExist("No aws credentials")
+                session = boto3.Session(aws_access_key_id=credentials["AWS_ACCESS_KEY_ID"],
+                                        aws_secret_access_key=credentials["AWS_SECRET_ACCESS_KEY"],
+                                        botocore_session=botocore_session)
+                sts = session.client('sts')
+                sts.get_caller_identity()
+                logger.info("Successfully create AWS Session using DB Credentials")
+            except Exception:
+                try:
+                    session = boto3.Session(botocore_session=botocore.session.get_session())
+                    logger.debug("Creating AWS Session using default/env credentials")
+                except Exception as e:
+                    logger.error("Failed to create AWS Session using DB Credentials")
+                    raise e
+            cls._session = session
+            cls._credentials = credentials
+            cls._clients = dict()
+            return cls._session
+
+    @classmethod
+    def get_client(cls, service_name, region_name):
+        """
+        The shared client for a service in a region, built the first time it is needed
+        """
+        if cls._session is None or time.monotonic() - cls._checked_at >= settings.CREDENTIALS_CACHE_TTL:
+            cls.get_session()
+        key = (service_name, region_name)
+        client = cls._clients.get(key)
+        if client is None:
+            with cls._lock:
+                client = cls._clients.get(key)
+                if client is None:
+                    started = time.monotonic()
+                    client = cls.get_session().client(service_name, region_name=region_name, config=cls._config)
+                    cls._clients[key] = client
+                    logger.debug(f"Created {service_name} client for {region_name} in {time.monotonic() - started:.3f}s")
+        return client
+
+    @classmethod
+    def clear_clients(cls):
+        """
+        Forget the shared session and clients, e.g. right after the AWS credentials changed in this process
+        """
+        with cls._lock:
+            cls._session = None
+            cls._credentials = None
+            cls._clients = dict()
+
+    @property
+    def ec2_client(self):
+        return AWSServices.get_client('ec2', settings.DEFAULT_REGION)
+
+    @property
+    def rds_client(self):
+        return AWSServices.get_client('rds', settings.DEFAULT_REGION)
+
+    @property
+    def cloudwatch_client(self):
+        return AWSServices.get_client('cloudwatch', settings.DEFAULT_REGION)
 
     @staticmethod
     def get_enabled_regions():
         regions = [setting.description for setting in Settings.objects.filter(type=AWS_REGION, value="True").all()]
         return regions
 
+    @staticmethod
+    def comparable(field, value):
+        """
+        A value as it will read back from the database, so fresh API data can be compared with stored rows
+        """
+        if isinstance(field, JSONField):
+            return json.loads(json.dumps(value, cls=field.encoder))
+        return field.to_python(value)
+
+    def sync_region_rows(self, model, region, rows, fields, delete_stale=True):
+        """
+        Make the stored rows of model for region match rows (unsaved instances of model).
+        New rows are inserted, existing rows only get the fields that changed, and, if delete_stale,
+        rows we no longer found are deleted along with their Ec2DbInfo. All in one transaction.
+        Rows a running rule has locked are left for a later sync rather than waited for.
+        Returns the primary keys of the deleted rows.
+        """
+        with transaction.atomic():
+            pks = [row.pk for row in rows]
+            existing = model.objects.select_for_update(skip_locked=True).in_bulk(pks)
+            locked = set(model.objects.filter(pk__in=pks).values_list("pk", flat=True)) - set(existing.keys())
+            if delete_stale:
+                existing.update(model.objects.select_for_update(skip_locked=True).filter(region=region).exclude(pk__in=pks).in_bulk())
+            new_rows = list()
+            changes = defaultdict(list)
+            for row in rows:
+                if row.pk in locked:
+                    continue
+                current = existing.pop(row.pk, None)
+                if current is None:
+                    new_rows.append(row)
+                    continue
+                changed = tuple(name for name in fields
+                                if self.comparable(model._meta.get_field(name), getattr(row, name)) != getattr(current, name))
+                if changed:
+                    changes[changed].append(row)
+
+            model.objects.bulk_create(new_rows)
+            updated = 0
+            for changed, changed_rows in changes.items():
+                if hasattr(model, "lastUpdated"):
+                    now = timezone.now()
+                    for row in changed_rows:
+                        row.lastUpdated = now
+                    changed = changed + ("lastUpdated",)
+                model.objects.bulk_update(changed_rows, changed, batch_size=500)
+                updated += len(changed_rows)
+
+            stale = list(existing.keys()) if delete_stale else list()
+            if stale:
+                self.forget_rows(model, stale)
+        logger.info(f"Synced {model.__name__} in {region}: {len(new_rows)} new, {updated} changed, "
+                    f"{len(rows) - len(new_rows) - updated - len(locked)} unchanged, {len(locked)} locked, {len(stale)} gone")
+        return stale
+
+    def forget_rows(self, model, pks):
+        """
+        Delete instances we no longer manage along with their Ec2DbInfo. An instance whose Ec2DbInfo
+        a running rule has locked is left for a later sync.
+        """
+        with transaction.atomic():
+            db_infos = Ec2DbInfo.objects.filter(instance_id__in=pks, type=self.SERVICE_TYPE)
+            unlocked = set(db_infos.select_for_update(skip_locked=True).values_list("instance_id", flat=True))
+            locked = set(db_infos.values_list("instance_id", flat=True)) - unlocked
+            Ec2DbInfo.objects.filter(instance_id__in=unlocked, type=self.SERVICE_TYPE).delete()
+            _, deleted = model.objects.filter(pk__in=set(pks) - locked).delete()
+        deleted = deleted.get(model._meta.label, 0)
+        logger.info(f"Forgot {deleted} {model.__name__} rows: {sorted(pks)}")
+        return deleted
+
     def check_instance_status(self, instance_id):
         pass
 
@@ -67,15 +231,10 @@ class AWSServices:
         # TODO check streaming status after we confirm that its running.
         # TODO To be run on replica
         try:
-            for i in range(0, 6):
-                data = self.check_instance_status(instance)
-                status = self.check_instance_running(data)
-                if status:
-                    return status
-                time.sleep(20)
-        except Exception as e:
-            print(str(e))
-            pass
+            return Waiter(f"{instance} to be available", timeout=settings.INSTANCE_STATUS_TIMEOUT, initial=5, maximum=20)\
+                .wait(lambda: self.check_instance_running(self.check_instance_status(instance)))
+        except WaitTimeout as e:
+            logger.warn(str(e))
         return None
 
     def update_last_sync_time(self):
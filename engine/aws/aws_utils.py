@@ -2,7 +2,8 @@ import botocore
 import boto3
 from engine.aws.ec_wrapper import EC2Service
 from engine.aws.rds_wrapper import RDSService
-from engine.models import DbCredentials, RDS, EC2
+from engine.credentials import CredentialsProvider
+from engine.models import RDS, EC2
 from webapp.models import Settings, AWS_REGION
 
 
@@ -38,11 +39,7 @@ class AWSUtil:
 
     @staticmethod
     def get_aws_credentials():
-        try:
-            creds = DbCredentials.objects.get(name="aws")
-        except Exception as e:
-            creds = None
-        return creds
+        return CredentialsProvider().get("aws")
 
     @staticmethod
     def update_aws_region_list():
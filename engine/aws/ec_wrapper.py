@@ -1,23 +1,37 @@
 import botocore
 import time
 from engine.aws.aws_services import AWSServices
-from engine.models import AllEc2InstancesData, EC2, Ec2DbInfo, ClusterInfo, DbCredentials, AllEc2InstanceTypes
-from engine.postgres_wrapper import PostgresData
+from engine.concurrency import run_concurrently
+from engine.credentials import CredentialsProvider
+from engine.hooks import HookRunner, HookError, CALL_FOR_HELP, DOWNSIZE_PROGNOSTICATION
+from engine.instance_catalog import InstanceTypeCatalog
+from engine.models import AllEc2InstancesData, EC2, Ec2DbInfo, AllEc2InstanceTypes
+from engine.postgres_wrapper import PostgresData, PostgresConnectionPool
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
 from engine.singleton import Singleton
 from webapp.models import Settings as SettingsModal
-import os
-import subprocess
 import logging
 logger = logging.getLogger(__name__)
 
+# The AllEc2InstancesData columns we fill from describe_instances
+EC2_DATA_FIELDS = ["region", "name", "instanceType", "keyName", "launchTime", "availabilityZone", "privateDnsName",
+                   "privateIpAddress", "publicDnsName", "publicIpAddress", "state", "vpcId", "subnetId", "architecture",
+                   "blockDeviceMapping", "ebsOptimized", "securityGroups", "tags", "virtualizationType", "cpuOptions"]
+
+# EC2 state names and the codes describe_instances reports for them
+EC2_STATE_CODES = {"pending": 0, "running": 16, "shutting-down": 32, "terminated": 48, "stopping": 64, "stopped": 80}
+
+# EC2 states after which the instance is gone for good
+EC2_GONE_STATES = ("shutting-down", "terminated")
+
 
 class NeedFallbackInstanceError(Exception):
     pass
 
 
 class EC2Service(AWSServices, metaclass=Singleton):
-    ec2_client_region_dict = dict()
     SERVICE_TYPE = EC2
 
     def __init__(self):
@@ -29,15 +43,15 @@ class EC2Service(AWSServices, metaclass=Singleton):
     def create_connection(self, db, expect_errors=False):
         host = db.instance_object.privateIpAddress
         db_name = db.cluster.databaseName if db.cluster else "postgres"
-        try:
-            credentials = DbCredentials.objects.get(name="ec2")
+        credentials = CredentialsProvider().get("ec2")
+        if credentials is not None:
             username = credentials.user_name
             password = credentials.password
-        except Exception:
+        else:
             logger.debug("Failed to find ec2 credentials, so we're going to hope libpq finds a way to auth")
             username = None
             password = None
-        return PostgresData(host, username, password, db_name, expect_errors=expect_errors)
+        return PostgresData(host, username, password, db_name, expect_errors=expect_errors, pool=PostgresConnectionPool())
 
     def get_all_regions(self):
         regions = self.ec2_client.describe_regions()
@@ -86,7 +100,7 @@ class EC2Service(AWSServices, metaclass=Singleton):
 
         return all_instance_types
 
-    def scale_instance(self, instance, new_instance_type, fallback_instances=None, cluster_name_to_prognosticate=None):
+    def scale_instance(self, instance, new_instance_type, fallback_instances=None, cluster_name_to_prognosticate=None, record_instance_type=True):
         """
             scale up and down the ec2 instances
         """
@@ -94,36 +108,36 @@ class EC2Service(AWSServices, metaclass=Singleton):
         previous_instance_type = instance.instanceType
         logger.info(f"scaling instance {ec2_instance_id} from {previous_instance_type} to {new_instance_type}")
         try:
-            self.__scale_instance(ec2_instance_id, new_instance_type, cluster_name_to_prognosticate)
+            self.__scale_instance(ec2_instance_id, new_instance_type, cluster_name_to_prognosticate, record_instance_type)
         except (botocore.exceptions.WaiterError, NeedFallbackInstanceError):
             logger.debug(f"Oh noes! It's fallback instance time!")
             for fallback_instance in fallback_instances:
                 try:
                     logger.info(f"Setting fallback instance type {fallback_instance}.")
-                    self.__scale_instance(ec2_instance_id, fallback_instance, cluster_name_to_prognosticate)
+                    self.__scale_instance(ec2_instance_id, fallback_instance, cluster_name_to_prognosticate, record_instance_type)
                     return True
                 except Exception as e:
                     logger.error(f"Failed to set fallback instance type {fallback_instance} because {str(e)}.")
             logger.error(f"No more fallback instance types to try! Reverting to type {previous_instance_type}")
             self.page_for_help(ec2_instance_id, "Pygmy failed to restart replica after resize", "Please make sure all replicas are running at an appropriate size, and that CNAMEs are appropriate after streaming has caught up")
-            self.__scale_instance(ec2_instance_id, previous_instance_type, cluster_name_to_prognosticate)
+            self.__scale_instance(ec2_instance_id, previous_instance_type, cluster_name_to_prognosticate, record_instance_type)
             return False
         except Exception as e:
             # Change the instance type to previous
             logger.error(f"failed in scaling ec2 instance because {str(e)}; reverting instance type")
-            self.__scale_instance(ec2_instance_id, previous_instance_type, cluster_name_to_prognosticate)
+            self.__scale_instance(ec2_instance_id, previous_instance_type, cluster_name_to_prognosticate, record_instance_type)
             return False
 
         # Looks like we made it to the end
         return True
 
-    def __scale_instance(self, ec2_instance_id, proposed_instance_type, cluster_name_to_prognosticate):
+    def __scale_instance(self, ec2_instance_id, proposed_instance_type, cluster_name_to_prognosticate, record_instance_type=True):
         """
            scale up and down the ec2 instances
        """
         if cluster_name_to_prognosticate is not None:
             # See if our proposed instance type matches our prognostication
-            new_instance_type = self.prognosticate(cluster_name_to_prognosticate, proposed_instance_type).decode().rstrip()
+            new_instance_type = self.prognosticate(cluster_name_to_prognosticate, proposed_instance_type)
         else:
             # If we don't have a cluster name to prognosticate, just take what we're given.
             new_instance_type = proposed_instance_type
@@ -151,13 +165,18 @@ class EC2Service(AWSServices, metaclass=Singleton):
         # Record the new instance size.
         # Not _technically_ necessary, as it will refresh on the next run anyway,
         # but if anybody looks at the db in the meantime, it wouldn't otherwise represent reality.
-        try:
-            logger.debug(f"Recording new instance size of {new_instance_type}.")
-            resizedNode = Ec2DbInfo.objects.get(instance_id=ec2_instance_id)
-            resizedNode.last_instance_type = new_instance_type
-            resizedNode.save()
-        except Exception:
-            logger.warning(f"Failed to record new instance size, so we'll just keep going and pick it up when the next run starts.")
+        # When we're one of several resizes running at once, the rule's row locks belong to another thread,
+        # so trying to record it here would only block; leave it for the next run.
+        if record_instance_type:
+            try:
+                logger.debug(f"Recording new instance size of {new_instance_type}.")
+                resizedNode = Ec2DbInfo.objects.get(instance_id=ec2_instance_id)
+                resizedNode.last_instance_type = new_instance_type
+                resizedNode.save()
+            except Exception:
+                logger.warning(f"Failed to record new instance size, so we'll just keep going and pick it up when the next run starts.")
+        else:
+            logger.debug(f"Not recording new instance size of {new_instance_type}; the next run will pick it up.")
 
         # Try to start the instance.
         # Thanks to the eventual consistency of EC2, this might (transiently) fail, so retry a few times before giving up.
@@ -202,107 +221,93 @@ class EC2Service(AWSServices, metaclass=Singleton):
 
         full_details = f"Instance: {instance}, region: {region}. {extra_info}"
 
-        script_path = os.path.join(settings.BASE_DIR, "scripts", "call-for-help.sh")
-
         try:
             logger.info(f"Calling for help regarding {instance} because ({details})")
-            subprocess.run([script_path, host, details, full_details], check=True)
-            logger.debug(f"running {script_path} {host} {details} {full_details} succeeded")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"running {script_path} {host} {details} {full_details} returned: {e.returncode} ({e.output})")
-            raise Exception("Call for help failed")
-        except Exception as e:
-            if hasattr(e, 'message'):
-                message = e.message
-            else:
-                message = e
-            logger.error(f"running {script_path} {host} {details} {full_details} returned generic error: {message}")
+            HookRunner().run(CALL_FOR_HELP, [host, details, full_details])
+            logger.debug(f"running {CALL_FOR_HELP} {host} {details} {full_details} succeeded")
+        except HookError as e:
+            logger.error(f"running {CALL_FOR_HELP} {host} {details} {full_details} returned: {e.returncode} ({e.output}): {e}")
             raise Exception("Call for help failed")
 
     def prognosticate(self, cluster_name, proposed_instance_type):
         """
         See if our site logic trumps our configured logic
         """
-        script_path = os.path.join(settings.BASE_DIR, "scripts", "downsize-prognostication.sh")
-
         try:
             logger.info(f"Prognosticating {cluster_name} against proposed type {proposed_instance_type}")
-            value = subprocess.check_output([script_path, cluster_name, proposed_instance_type])
+            value = HookRunner().run(DOWNSIZE_PROGNOSTICATION, [cluster_name, proposed_instance_type]).rstrip()
             if len(value) > 0:
-                logger.debug(f"running {script_path} {cluster_name} {proposed_instance_type} succeeded; actual size will be {value}")
+                logger.debug(f"running {DOWNSIZE_PROGNOSTICATION} {cluster_name} {proposed_instance_type} succeeded; actual size will be {value}")
                 return value
             else:
-                logger.debug(f"running {script_path} {cluster_name} {proposed_instance_type} succeeded with no output?; actual size will be {proposed_instance_type}")
+                logger.debug(f"running {DOWNSIZE_PROGNOSTICATION} {cluster_name} {proposed_instance_type} succeeded with no output?; actual size will be {proposed_instance_type}")
                 return proposed_instance_type
-        except subprocess.CalledProcessError as e:
-            logger.error(f"running {script_path} {cluster_name} {proposed_instance_type} returned: {e.returncode} ({e.output}); returning proposed_instance_type")
-            return proposed_instance_type
-        except Exception as e:
-            if hasattr(e, 'message'):
-                message = e.message
-            else:
-                message = e
-            logger.error(f"running {script_path} {cluster_name} {proposed_instance_type} returned generic error: {message}; returning proposed_instance_type")
+        except HookError as e:
+            logger.error(f"running {DOWNSIZE_PROGNOSTICATION} {cluster_name} {proposed_instance_type} returned: {e.returncode} ({e.output}): {e}; returning proposed_instance_type")
             return proposed_instance_type
 
         logger.error(f"somehow got to the end of prognosticating without coming to a decision; returning proposed_instance_type")
         return proposed_instance_type
 
-    def get_instances(self, extra_filters=None, update_sync_time=True, force_cluster_id=None):
-        all_instances = dict()
+    def get_filters(self, extra_filters=None, running_only=True):
+        """
+        The describe_instances filters selecting the instances we manage, only the running ones unless not running_only
+        """
         TAG_KEY_NAME = SettingsModal.objects.get(name="EC2_INSTANCE_POSTGRES_TAG_KEY_NAME")
         TAG_KEY_VALUE = SettingsModal.objects.get(name="EC2_INSTANCE_POSTGRES_TAG_KEY_VALUE")
         filters = [
             {
                 'Name': 'tag:{}'.format(TAG_KEY_NAME.value),
                 'Values': [TAG_KEY_VALUE.value, ]
-            },
-            {
-                'Name': 'instance-state-name',
-                'Values': ['running']
             }]
+        if running_only:
+            filters.append({'Name': 'instance-state-name', 'Values': ['running']})
         if len(settings.EC2_INSTANCE_VPC_MENU) > 0:
             filters.extend([{'Name': 'vpc-id', 'Values': settings.EC2_INSTANCE_VPC_MENU}])
         if extra_filters is not None:
             filters.extend(extra_filters)
+        return filters
 
+    def get_instances(self, extra_filters=None, update_sync_time=True, force_cluster_id=None):
+        all_instances = dict()
+        # A full sync also looks at the stopped instances, so only the ones AWS no longer has or
+        # reports terminated are forgotten, not a replica a rule or an operator stopped
+        filters = self.get_filters(extra_filters, running_only=extra_filters is not None)
+        stopped = list()
         logger.debug(f"Looking to get instances to match the filters {filters}")
 
-        # First describe instances
-        for region in AWSServices.get_enabled_regions():
-            all_pg_ec2_instances = self.ec2_client_region_dict[region].describe_instances(
-                Filters=filters
-            )
-
-            while True:
-                # For handling pagination
-                for reservation in all_pg_ec2_instances.get("Reservations", []):
-                    for instance in reservation.get("Instances", []):
-                        logger.debug(f"found instance {instance['InstanceId']} ({instance['InstanceType']})")
-                        all_instances[instance["InstanceId"]] = dict({
-                            "instance_id": instance["InstanceId"],
-                            "region": region,
-                            "instance_type": instance["InstanceType"],
-                            "image_id": instance["ImageId"],
-                            "state": instance["State"],
-                            "vpc_id": instance["VpcId"],
-                            "availability_zone": instance["Placement"]["AvailabilityZone"],
-                            "ip": dict({
-                                "private_ip": instance["PrivateIpAddress"],
-                                "public_ip": instance.get("PublicIpAddress", "")
-                            }),
-                            "tags": instance["Tags"],
-                            "launch_time": instance["LaunchTime"]
-                        })
-                        self.save_data(instance, region=region)
-
-                if all_pg_ec2_instances.get("NextToken", None) is None:
-                    break
-
-                all_pg_ec2_instances = self.ec2_client.describe_instances(
-                    Filters=filters,
-                    NextToken=all_pg_ec2_instances.get("NextToken")
-                )
+        # First describe instances, all enabled regions at once
+        regions = AWSServices.get_enabled_regions()
+        for region, region_instances, error in run_concurrently(lambda region: self.describe_region(region, filters),
+                                                                regions, settings.AWS_REGION_SCAN_MAX_WORKERS):
+            if error is not None:
+                # Leave what we know about this region alone until we can see it again
+                logger.error(f"Failed to describe instances in {region}, skipping it: {error}")
+                continue
+            region_instances = [instance for instance in region_instances if instance["State"]["Name"] not in EC2_GONE_STATES]
+            for instance in region_instances:
+                if instance["State"]["Name"] != "running":
+                    stopped.append(instance["InstanceId"])
+                    continue
+                logger.debug(f"found instance {instance['InstanceId']} ({instance['InstanceType']})")
+                all_instances[instance["InstanceId"]] = dict({
+                    "instance_id": instance["InstanceId"],
+                    "region": region,
+                    "instance_type": instance["InstanceType"],
+                    "image_id": instance["ImageId"],
+                    "state": instance["State"],
+                    "vpc_id": instance["VpcId"],
+                    "availability_zone": instance["Placement"]["AvailabilityZone"],
+                    "ip": dict({
+                        "private_ip": instance["PrivateIpAddress"],
+                        "public_ip": instance.get("PublicIpAddress", "")
+                    }),
+                    "tags": instance["Tags"],
+                    "launch_time": instance["LaunchTime"]
+                })
+            self.save_region_data(region_instances, region, delete_stale=extra_filters is None)
+        if stopped:
+            self.mark_disconnected(stopped)
 
         if update_sync_time:
             logger.debug("updating last sync time")
@@ -310,82 +315,176 @@ class EC2Service(AWSServices, metaclass=Singleton):
             logger.debug("last sync time updated")
 
         # Update Cluster Info for the instances we've selected
-        for instance in AllEc2InstancesData.objects.filter(instanceId__in=all_instances.keys()):
-            self.check_cluster_info(instance, force_cluster_id)
+        instances = list(AllEc2InstancesData.objects.filter(instanceId__in=all_instances.keys()))
+        self.discover_topology(instances, force_cluster_id)
         return all_instances
 
-    def check_cluster_info(self, instance, force_cluster_id):
-        logger.debug(f"Checking cluster info for instance {instance.instanceId} ({instance.instanceType})")
-        try:
-            db = Ec2DbInfo.objects.get(instance_id=instance.instanceId)
-        except Ec2DbInfo.DoesNotExist:
-            logger.info(f"Instance {instance.instanceId} appears new to us")
-            # Because we don't have this yet, go ahead and create it. In the unlikely event that it fails,
-            # we'll just fail to run for now.
-            db, created = Ec2DbInfo.objects.get_or_create(instance_id=instance.instanceId, type=EC2, last_instance_type=instance.instanceType)
-        except Exception as e:
-            logger.warn(f"Failed to get ec2dbinfo for {instance.instanceId} because {e}")
-            return
-        db.instance_object = instance
-        logger.debug(f"Found Ec2DbInfo record with cluster_id {db.cluster_id}")
+    def refresh_instances(self, instance_ids, region):
+        """
+        Re-read just these instances of a region, e.g. after a state-change event. The running ones are saved
+        and probed, the stopped ones saved and marked disconnected, and the missing or terminated ones forgotten.
+        """
+        found = self.describe_region(region, self.get_filters([{'Name': 'instance-id', 'Values': list(instance_ids)}],
+                                                              running_only=False))
+        found = [instance for instance in found if instance["State"]["Name"] not in EC2_GONE_STATES]
+        self.save_region_data(found, region)
+        gone = set(instance_ids) - set(instance["InstanceId"] for instance in found)
+        if gone:
+            self.forget_rows(AllEc2InstancesData, gone)
+        stopped = [instance["InstanceId"] for instance in found if instance["State"]["Name"] != "running"]
+        if stopped:
+            self.mark_disconnected(stopped)
+        instances = list(AllEc2InstancesData.objects.filter(instanceId__in=[instance["InstanceId"] for instance in found
+                                                                            if instance["State"]["Name"] == "running"]))
+        self.discover_topology(instances)
+        return instances, gone
+
+    def set_instance_state(self, instance_ids, state):
+        """
+        Record a state an instance passed into without describing it again. Instances that
+        are not running can't be probed, so they are marked disconnected until they are back.
+        """
+        with transaction.atomic():
+            updated = AllEc2InstancesData.objects.filter(instanceId__in=instance_ids)\
+                .update(state={"Code": EC2_STATE_CODES.get(state), "Name": state}, lastUpdated=timezone.now())
+            Ec2DbInfo.objects.filter(instance_id__in=instance_ids, type=EC2).update(isConnected=False)
+        return updated
+
+    def mark_disconnected(self, instance_ids):
+        """
+        Mark the Ec2DbInfo of instances that are not running disconnected, skipping
+        the ones a running rule has locked, as it is the one stopping and starting them
+        """
+        with transaction.atomic():
+            unlocked = Ec2DbInfo.objects.select_for_update(skip_locked=True)\
+                .filter(instance_id__in=instance_ids, type=EC2, isConnected=True)
+            return Ec2DbInfo.objects.filter(id__in=list(unlocked.values_list("id", flat=True))).update(isConnected=False)
+
+    def describe_region(self, region, filters):
+        """
+        Every instance in a region matching filters, across all pages
+        """
+        started = time.monotonic()
+        client = self.ec2_client_region_dict[region]
+        instances = list()
+        response = client.describe_instances(Filters=filters)
+        while True:
+            # For handling pagination
+            for reservation in response.get("Reservations", []):
+                instances.extend(reservation.get("Instances", []))
+
+            if response.get("NextToken", None) is None:
+                break
+
+            response = client.describe_instances(
+                Filters=filters,
+                NextToken=response.get("NextToken")
+            )
+        logger.debug(f"Described {len(instances)} instances in {region} in {time.monotonic() - started:.3f}s")
+        return instances
+
+    def get_db_info_map(self, instances):
+        """
+        Ec2DbInfo rows for instances, keyed by instance id, fetched with one query.
+        Rows for instances that are new to us are created in one insert.
+        """
+        db_infos = Ec2DbInfo.objects.select_related("cluster").in_bulk([instance.instanceId for instance in instances], field_name="instance_id")
+        missing = [Ec2DbInfo(instance_id=instance.instanceId, type=EC2, last_instance_type=instance.instanceType)
+                   for instance in instances if instance.instanceId not in db_infos]
+        if missing:
+            logger.info(f"Instances {[db.instance_id for db in missing]} appear new to us")
+            for db in Ec2DbInfo.objects.bulk_create(missing):
+                db_infos[db.instance_id] = db
+        return db_infos
+
+    def probe_topology(self, db):
+        """
+        Ask a node whether it is a primary, and if so which replicas stream from it.
+        Returns (is_primary, replica_ips).
+        """
+        conn = self.create_connection(db)
         try:
-            if len(settings.EC2_INSTANCE_VPC_MENU) > 0:
-                if instance.vpcId not in settings.EC2_INSTANCE_VPC_MENU:
-                    logger.info(f"Ignoring {instance.instanceId} because we don't care about VPC {instance.vpcId}")
-                    return
-            conn = self.create_connection(db)
-            db.isPrimary = conn.is_ec2_postgres_instance_primary()
-            db.isConnected = True
+            is_primary = conn.is_ec2_postgres_instance_primary()
+            replicas = conn.get_all_slave_servers() if is_primary else list()
+        finally:
+            conn.close()
+        return is_primary, replicas
 
+    def discover_topology(self, instances, force_cluster_id=None):
+        """
+        Work out which instances are primaries and which replicas belong to them.
+        Every node is probed concurrently, the primary -> replica graph is built in memory
+        with an IP -> instance index, and the cluster assignments are written in one batch.
+        """
+        started = time.monotonic()
+        db_infos = self.get_db_info_map(instances)
+        probed = list()
+        for instance in instances:
+            if len(settings.EC2_INSTANCE_VPC_MENU) > 0 and instance.vpcId not in settings.EC2_INSTANCE_VPC_MENU:
+                logger.info(f"Ignoring {instance.instanceId} because we don't care about VPC {instance.vpcId}")
+                continue
+            db_infos[instance.instanceId].instance_object = instance
+            probed.append(instance)
+
+        probes = run_concurrently(lambda instance: self.probe_topology(db_infos[instance.instanceId]), probed,
+                                  settings.TOPOLOGY_PROBE_MAX_WORKERS)
+
+        graph = dict()
+        for instance, result, error in probes:
+            db = db_infos[instance.instanceId]
+            if error is not None:
+                logger.error(f"Ruh oh, looks like we found an exception checking out {instance.instanceId}: {error}")
+                db.isPrimary = False
+                db.isConnected = False
+                continue
+            db.isPrimary, replicas = result
+            db.isConnected = True
             if db.isPrimary:
                 logger.debug(f"This cluster's primary node is currently {instance.instanceId}")
-                db.cluster = self.get_or_create_cluster(instance, instance.privateIpAddress)
-                replicas = conn.get_all_slave_servers()
-                self.update_replica_cluster_info(instance.privateIpAddress, replicas)
+                graph[instance] = replicas
             else:
                 logger.debug(f"Instance {instance.instanceId} isn't a primary node")
                 if force_cluster_id is not None:
                     logger.debug(f"Forcing cluster to be {force_cluster_id}")
                     db.cluster_id = force_cluster_id
-        except Exception as e:
-            logger.error(f"Ruh oh, looks like we found an exception checking out {instance.instanceId}: {e}")
-            db.isPrimary = False
-            db.isConnected = False
-        finally:
-            db.save()
+
+        # Replicas may be instances we didn't just sync, so index everything they point at by IP in one query
+        replica_ips = set(ip for replicas in graph.values() for ip in replicas)
+        by_ip = dict((instance.privateIpAddress, instance) for instance in instances)
+        missing_ips = replica_ips - set(by_ip.keys())
+        if missing_ips:
+            extra = list(AllEc2InstancesData.objects.filter(privateIpAddress__in=missing_ips))
+            by_ip.update((instance.privateIpAddress, instance) for instance in extra)
+            db_infos.update(self.get_db_info_map([instance for instance in extra if instance.instanceId not in db_infos]))
+
+        for primary, replicas in graph.items():
+            cluster = self.get_or_create_cluster(primary, primary.privateIpAddress)
+            db_infos[primary.instanceId].cluster = cluster
+            for ip in replicas:
+                logger.debug(f"updating replica info for node {ip}")
+                replica = by_ip.get(ip)
+                if replica is None:
+                    logger.info(f"{ip} doesn't seem to be an instance we know about; skipping")
+                    continue
+                db_info = db_infos[replica.instanceId]
+                db_info.cluster = cluster
+                db_info.instance_object = replica
+
+        now = timezone.now()
+        for db in db_infos.values():
+            db.lastUpdated = now
+        with transaction.atomic():
+            Ec2DbInfo.objects.bulk_update(list(db_infos.values()),
+                                          ["isPrimary", "isConnected", "cluster", "instance_type", "lastUpdated"],
+                                          batch_size=500)
+        logger.info(f"Discovered topology of {len(instances)} instances ({len(graph)} primaries) in {time.monotonic() - started:.3f}s")
+        return graph
 
     def get_tag_map(self, instance):
         return dict((tag['Key'], tag['Value']) for tag in instance.tags)
 
-    def update_replica_cluster_info(self, private_dns_name, replicas):
-        for node in replicas:
-            logger.debug(f"updating replica info for node {node}")
-            try:
-                instance = AllEc2InstancesData.objects.get(privateIpAddress=node)
-            except AllEc2InstancesData.DoesNotExist:
-                logger.info(f"{node} doesn't seem to be an instance we know about; skipping")
-                return
-            try:
-                db_info = Ec2DbInfo.objects.get(instance_id=instance.instanceId)
-            except Ec2DbInfo.DoesNotExist:
-                logger.info(f"Instance {instance.instanceId} appears new to us")
-                # Because we don't have this yet, go ahead and create it. In the unlikely event that it fails,
-                # we'll just fail to run for now.
-                db_info, created = Ec2DbInfo.objects.get_or_create(instance_id=instance.instanceId, type=EC2, last_instance_type=instance.instanceType)
-            except Exception as e:
-                logger.warn(f"Failed to retrieve ec2dbinfo for {instance.instanceId} because {e}")
-                return
-            db_info.cluster = ClusterInfo.objects.get(primaryNodeIp=private_dns_name, type=EC2)
-            db_info.content_object = instance
-            db_info.save()
-
-    def save_data(self, instance, region=settings.DEFAULT_REGION):
-        try:
-            db = AllEc2InstancesData.objects.get(instanceId=instance["InstanceId"], region=region)
-        except AllEc2InstancesData.DoesNotExist:
-            db = AllEc2InstancesData()
-            db.instanceId = instance["InstanceId"]
-            db.region = region
+    def fill_data(self, db, instance, region):
+        db.region = region
         db.name = next((tag["Value"] for tag in instance["Tags"] if tag["Key"] == "Name"), None)
         db.instanceType = instance["InstanceType"]
         db.keyName = instance["KeyName"]
@@ -405,8 +504,28 @@ class EC2Service(AWSServices, metaclass=Singleton):
         db.tags = instance["Tags"]
         db.virtualizationType = instance["VirtualizationType"]
         db.cpuOptions = instance.get("CpuOptions", {})
+
+    def save_data(self, instance, region=settings.DEFAULT_REGION):
+        try:
+            db = AllEc2InstancesData.objects.get(instanceId=instance["InstanceId"], region=region)
+        except AllEc2InstancesData.DoesNotExist:
+            db = AllEc2InstancesData()
+            db.instanceId = instance["InstanceId"]
+        self.fill_data(db, instance, region)
         db.save()
 
+    def save_region_data(self, instances, region, delete_stale=False):
+        """
+        Bring the stored instances of a region in line with what describe_instances found,
+        touching only what changed. Stale rows are only deleted when we looked at the whole region.
+        """
+        rows = list()
+        for instance in instances:
+            db = AllEc2InstancesData(instanceId=instance["InstanceId"])
+            self.fill_data(db, instance, region)
+            rows.append(db)
+        return self.sync_region_rows(AllEc2InstancesData, region, rows, EC2_DATA_FIELDS, delete_stale)
+
     def save_instance_types(self):
         try:
             all_instances = self.get_instance_types()
@@ -420,10 +539,5 @@ class EC2Service(AWSServices, metaclass=Singleton):
         except Exception as e:
             print(str(e))
             print(instance)
-
-    def clear_db(self):
-        try:
-            Ec2DbInfo.objects.filter(types="EC2").delete()
-            AllEc2InstancesData.objects.all().delete()
-        except Exception:
-            pass
+        finally:
+            InstanceTypeCatalog().invalidate(EC2)
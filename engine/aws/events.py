@@ -0,0 +1,118 @@
+import json
+import logging
+from collections import OrderedDict, defaultdict
+from django.conf import settings
+from engine.aws.aws_services import AWSServices
+from engine.aws.ec_wrapper import EC2Service, EC2_GONE_STATES
+from engine.aws.rds_wrapper import RDSService
+from engine.models import EC2, RDS, AllEc2InstancesData
+from webapp.models import Settings
+logger = logging.getLogger(__name__)
+
+# EventBridge detail-types we know how to apply
+EC2_STATE_CHANGE = "EC2 Instance State-change Notification"
+RDS_INSTANCE_EVENT = "RDS DB Instance Event"
+
+
+class InventoryEvents:
+    """
+    Keep the inventory up to date from EC2 instance state-change and RDS instance events,
+    so only the instances named in the events are read from AWS and written.
+    Events are EventBridge events, optionally wrapped in an SNS notification.
+    """
+
+    @staticmethod
+    def load(text):
+        """
+        Read events from a JSON list, a single JSON event, or one JSON event per line
+        """
+        text = text.strip()
+        if not text:
+            return list()
+        try:
+            events = json.loads(text)
+        except ValueError:
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+        return events if isinstance(events, list) else [events]
+
+    @staticmethod
+    def parse(event):
+        """
+        Returns (service type, region, instance id, state, time) for an event we care about, otherwise None.
+        RDS events carry no state, so theirs is None, and time is None for events without one.
+        """
+        if not isinstance(event, dict):
+            return None
+        if event.get("Type") == "Notification" and isinstance(event.get("Message"), str):
+            try:
+                event = json.loads(event["Message"])
+            except ValueError:
+                return None
+        detail = event.get("detail") or dict()
+        region = event.get("region") or settings.DEFAULT_REGION
+        if event.get("detail-type") == EC2_STATE_CHANGE and detail.get("instance-id"):
+            return EC2, region, detail["instance-id"], detail.get("state"), event.get("time")
+        if event.get("detail-type") == RDS_INSTANCE_EVENT and detail.get("SourceIdentifier"):
+            return RDS, region, detail["SourceIdentifier"], None, event.get("time")
+        return None
+
+    @staticmethod
+    def latest(events):
+        """
+        The newest state of every instance named in events, in the order the events happened.
+        An event without a time is taken to have happened with the timed event before it in the feed,
+        so it keeps its place among the timed events (events before the first timed one come first).
+        """
+        parsed = list()
+        last_time = ""
+        for position, event in enumerate(events):
+            found = InventoryEvents.parse(event)
+            if found is None:
+                logger.debug(f"Ignoring event {event}")
+                continue
+            last_time = found[4] or last_time
+            parsed.append(((last_time, position), found))
+
+        latest = OrderedDict()
+        for _, (service_type, region, instance_id, state, _) in sorted(parsed, key=lambda item: item[0]):
+            latest.pop((service_type, region, instance_id), None)
+            latest[(service_type, region, instance_id)] = state
+        return latest
+
+    @staticmethod
+    def apply(events):
+        """
+        Apply a batch of events. Instances are grouped by region so each region is described once,
+        and every instance is only handled for its latest event.
+        """
+        latest = InventoryEvents.latest(events)
+        enabled = dict((setting.name, setting.value == "True") for setting in Settings.objects.filter(name__in=["ec2", "rds"]))
+        regions = set(AWSServices.get_enabled_regions())
+
+        refresh = defaultdict(list)
+        states = defaultdict(list)
+        gone = list()
+        ignored = 0
+        for (service_type, region, instance_id), state in latest.items():
+            if not enabled.get(service_type.lower(), False) or region not in regions:
+                logger.debug(f"Ignoring event for {instance_id} because we don't sync {service_type} in {region}")
+                ignored += 1
+            elif service_type == EC2 and state in EC2_GONE_STATES:
+                gone.append(instance_id)
+            elif service_type == EC2 and state is not None and state != "running":
+                states[state].append(instance_id)
+            else:
+                refresh[(service_type, region)].append(instance_id)
+
+        result = dict({"events": len(events), "instances": len(latest), "ignored": ignored, "updated": 0, "removed": 0})
+        if gone:
+            result["removed"] += EC2Service().forget_rows(AllEc2InstancesData, gone)
+        for state, instance_ids in states.items():
+            result["updated"] += EC2Service().set_instance_state(instance_ids, state)
+        for (service_type, region), instance_ids in refresh.items():
+            service = EC2Service() if service_type == EC2 else RDSService()
+            rows, forgotten = service.refresh_instances(instance_ids, region)
+            result["updated"] += len(rows)
+            result["removed"] += len(forgotten)
+        logger.info(f"Applied {len(events)} events: {result}")
+        return result
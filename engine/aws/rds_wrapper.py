@@ -1,14 +1,21 @@
 from engine.aws.aws_services import AWSServices
+from engine.concurrency import run_concurrently
+from engine.credentials import CredentialsProvider
+from engine.instance_catalog import InstanceTypeCatalog
 from engine.models import RdsInstances, Ec2DbInfo, ClusterInfo, RDS, AllRdsInstanceTypes, DbCredentials
-from engine.postgres_wrapper import PostgresData
+from engine.postgres_wrapper import PostgresData, PostgresConnectionPool
 from django.conf import settings
 from engine.singleton import Singleton
 import logging
 log = logging.getLogger("db")
 
+# The RdsInstances columns we fill from describe_db_instances
+RDS_DATA_FIELDS = ["region", "dbInstanceClass", "dbName", "engine", "dbInstanceStatus", "dbEndpoint", "dbStorage",
+                   "dbVpcSecurityGroups", "masterUsername", "preferredBackupWindow", "availabilityZone",
+                   "dBParameterGroups", "engineVersion", "licenseModel", "publiclyAccessible", "tagList"]
+
 
 class RDSService(AWSServices, metaclass=Singleton):
-    rds_client_region_dict = dict()
     SERVICE_TYPE = RDS
 
     def __init__(self):
@@ -17,13 +24,15 @@ class RDSService(AWSServices, metaclass=Singleton):
     def get_all_regions(self):
         regions = self.ec2_client.describe_regions()
 
-    def create_connection(self, db):
-        credentials = DbCredentials.objects.get(name="rds")
+    def create_connection(self, db, expect_errors=False):
+        credentials = CredentialsProvider().get("rds")
+        if credentials is None:
+            raise DbCredentials.DoesNotExist("No rds credentials")
         host = db.instance_object.dbEndpoint["Address"]
         username = db.instance_object.masterUsername
         db_name = db.instance_object.dbName
         password = credentials.password
-        return PostgresData(host, username, password, db_name)
+        return PostgresData(host, username, password, db_name, expect_errors=expect_errors, pool=PostgresConnectionPool())
 
     def check_instance_status(self, instance):
         response = self.rds_client.describe_db_instances(DBInstanceIdentifier=instance.dbInstanceIdentifier)
@@ -47,51 +56,95 @@ class RDSService(AWSServices, metaclass=Singleton):
         self.rds_client.start_db_instance(DBInstanceIdentifier=instance.dbInstanceIdentifier)
         return self.wait_till_status_up(instance)
 
-    def get_instances(self):
-        all_instances = dict()
+    def get_filters(self, extra_filters=None):
+        """
+        The describe_db_instances filters selecting the instances we manage
+        """
         filters = [{
             'Name': 'engine',
             'Values': [
                 'postgres',
             ]},
         ]
+        if extra_filters is not None:
+            filters.extend(extra_filters)
+        return filters
 
-        for region in AWSServices.get_enabled_regions():
-            # First describe instance
-            all_pg_instances = self.rds_client_region_dict[region].describe_db_instances(
-                Filters=filters,
-                MaxRecords=100
-            )
+    def get_instances(self):
+        all_instances = dict()
+        filters = self.get_filters()
 
-            while True:
-                for instance in all_pg_instances.get("DBInstances", []):
-                    slave_identifier = instance.get("ReadReplicaSourceDBInstanceIdentifier", None)
-                    rds = self.save_data(instance, region)
-                    db_info, created = Ec2DbInfo.objects.get_or_create(instance_id=rds.dbInstanceIdentifier, type=RDS)
-                    db_info.instance_object = rds
-                    if slave_identifier is None:
-                        db_info.isPrimary = True
-                        db_info.cluster = self.get_or_create_cluster(instance, rds.dbInstanceIdentifier, databaseName=rds.dbName)
-                    else:
-                        cluster, created = ClusterInfo.objects.get_or_create(primaryNodeIp=slave_identifier, type=RDS)
-                        db_info.cluster = cluster
-                        db_info.isPrimary = False
-                    db_info.isConnected = True
-                    db_info.last_instance_type = rds.dbInstanceClass
-                    db_info.save()
-
-                if all_pg_instances.get("NextToken", None) is None:
-                    break
-
-                all_pg_instances = self.rds_client.describe_db_instances(
-                    Filters=filters,
-                    MaxResults=100,
-                    NextToken=all_pg_instances.get("NextToken")
-                )
+        # First describe instances, all enabled regions at once
+        regions = AWSServices.get_enabled_regions()
+        for region, region_instances, error in run_concurrently(lambda region: self.describe_region(region, filters),
+                                                                regions, settings.AWS_REGION_SCAN_MAX_WORKERS):
+            if error is not None:
+                # Leave what we know about this region alone until we can see it again
+                log.error(f"Failed to describe db instances in {region}, skipping it: {error}")
+                continue
+
+            rows = [self.build_data(instance, region) for instance in region_instances]
+            self.sync_region_rows(RdsInstances, region, rows, RDS_DATA_FIELDS)
+            for instance, rds in zip(region_instances, rows):
+                self.save_db_info(instance, rds)
 
         self.update_last_sync_time()
         return all_instances
 
+    def save_db_info(self, instance, rds):
+        """
+        Link a db instance to its cluster: primaries get their own, read replicas join their source's
+        """
+        slave_identifier = instance.get("ReadReplicaSourceDBInstanceIdentifier", None)
+        db_info, created = Ec2DbInfo.objects.get_or_create(instance_id=rds.dbInstanceIdentifier, type=RDS)
+        db_info.instance_object = rds
+        if slave_identifier is None:
+            db_info.isPrimary = True
+            db_info.cluster = self.get_or_create_cluster(instance, rds.dbInstanceIdentifier, databaseName=rds.dbName)
+        else:
+            cluster, created = ClusterInfo.objects.get_or_create(primaryNodeIp=slave_identifier, type=RDS)
+            db_info.cluster = cluster
+            db_info.isPrimary = False
+        db_info.isConnected = True
+        db_info.last_instance_type = rds.dbInstanceClass
+        db_info.save()
+        return db_info
+
+    def refresh_instances(self, identifiers, region):
+        """
+        Re-read just these db instances of a region, e.g. after an RDS event.
+        The ones we still manage are saved; the ones that are gone are forgotten.
+        """
+        found = self.describe_region(region, self.get_filters([{'Name': 'db-instance-id', 'Values': list(identifiers)}]))
+        rows = [self.build_data(instance, region) for instance in found]
+        self.sync_region_rows(RdsInstances, region, rows, RDS_DATA_FIELDS, delete_stale=False)
+        for instance, rds in zip(found, rows):
+            self.save_db_info(instance, rds)
+        gone = set(identifiers) - set(rds.dbInstanceIdentifier for rds in rows)
+        if gone:
+            self.forget_rows(RdsInstances, gone)
+        return rows, gone
+
+    def describe_region(self, region, filters):
+        """
+        Every db instance in a region matching filters, across all pages
+        """
+        client = self.rds_client_region_dict[region]
+        instances = list()
+        response = client.describe_db_instances(Filters=filters, MaxRecords=100)
+        while True:
+            instances.extend(response.get("DBInstances", []))
+
+            if response.get("Marker", None) is None:
+                break
+
+            response = client.describe_db_instances(
+                Filters=filters,
+                MaxRecords=100,
+                Marker=response.get("Marker")
+            )
+        return instances
+
     def get_instance_types(self):
         all_instance_types = []
         describe_instance_type_resp = self.rds_client.describe_orderable_db_instance_options(
@@ -117,7 +170,7 @@ class RDSService(AWSServices, metaclass=Singleton):
     def get_tag_map(self, instance):
         return dict((tag['Key'], tag['Value'].lower()) for tag in instance.get("TagList"))
 
-    def save_data(self, instance, region=settings.DEFAULT_REGION):
+    def build_data(self, instance, region=settings.DEFAULT_REGION):
         rds = RdsInstances()
         rds.dbInstanceIdentifier = instance["DBInstanceIdentifier"]
         rds.region = region
@@ -136,10 +189,14 @@ class RDSService(AWSServices, metaclass=Singleton):
         rds.licenseModel = instance["LicenseModel"]
         rds.publiclyAccessible = instance["PubliclyAccessible"]
         rds.tagList = instance["TagList"]
+        return rds
+
+    def save_data(self, instance, region=settings.DEFAULT_REGION):
+        rds = self.build_data(instance, region)
         rds.save()
         return rds
 
-    def scale_instance(self, instance, new_instance_type, fallback_instances=None):
+    def scale_instance(self, instance, new_instance_type, fallback_instances=None, cluster_name_to_prognosticate=None, record_instance_type=True):
         """
             scale up and down the rds instance
         """
@@ -224,14 +281,5 @@ class RDSService(AWSServices, metaclass=Singleton):
         except Exception as e:
             print(str(e))
             return
-
-    def clear_db(self):
-        try:
-            all_db_info = Ec2DbInfo.objects.filter(types="RDS")
-            all_db_info.delete()
-            all_db_info.save()
-            rds_instances = RdsInstances.objects.all()
-            rds_instances.delete()
-            rds_instances.save()
-        except Exception as e:
-            pass
+        finally:
+            InstanceTypeCatalog().invalidate(RDS)
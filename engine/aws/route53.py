@@ -0,0 +1,86 @@
+import logging
+from collections import OrderedDict
+from django.conf import settings
+from engine.aws.aws_services import AWSServices
+from engine.waiter import Waiter, wait_all
+logger = logging.getLogger(__name__)
+
+
+class Route53Batch:
+    """
+    Collect the DNS changes of a rule run and make them with one ChangeResourceRecordSets call per
+    hosted zone, then wait once for all of them to be INSYNC, instead of a script and a wait per record.
+
+    Records are UPSERTed like scripts/route53.example does. When a record is changed more than once
+    the last change wins. submit returns the error (or None) of every record added, in order.
+    """
+    def __init__(self, comment="Pygmy Update"):
+        self.comment = comment
+        # [(zone name, dns name, record type, target)] in the order they were added
+        self.records = list()
+
+    def __repr__(self):
+        return "<Route53Batch records:%s>" % len(self.records)
+
+    @property
+    def client(self):
+        # Route53 is global, so any region's client will do
+        return AWSServices.get_client("route53", settings.DEFAULT_REGION)
+
+    @staticmethod
+    def fqdn(name):
+        return name if name.endswith(".") else name + "."
+
+    def add(self, zone_name, dns_name, record_type, target):
+        self.records.append((self.fqdn(zone_name), self.fqdn(dns_name), record_type, target))
+
+    def get_zone_id(self, zone_name):
+        zones = self.client.list_hosted_zones_by_name(DNSName=zone_name, MaxItems="1").get("HostedZones", [])
+        if not zones or zones[0]["Name"] != zone_name:
+            raise Exception(f"No hosted zone named {zone_name}")
+        return zones[0]["Id"]
+
+    def changes_by_zone(self):
+        zones = OrderedDict()
+        for zone_name, dns_name, record_type, target in self.records:
+            changes = zones.setdefault(zone_name, OrderedDict())
+            changes.pop((dns_name, record_type), None)
+            changes[(dns_name, record_type)] = dict({
+                "Action": "UPSERT",
+                "ResourceRecordSet": {
+                    "Name": dns_name,
+                    "Type": record_type,
+                    "TTL": settings.DNS_RECORD_TTL,
+                    "ResourceRecords": [{"Value": target}]
+                }
+            })
+        return zones
+
+    def is_in_sync(self, change_id):
+        return self.client.get_change(Id=change_id)["ChangeInfo"]["Status"] == "INSYNC"
+
+    def submit(self):
+        errors = dict()
+        submitted = OrderedDict()
+        for zone_name, changes in self.changes_by_zone().items():
+            try:
+                response = self.client.change_resource_record_sets(HostedZoneId=self.get_zone_id(zone_name), ChangeBatch={
+                    "Comment": self.comment,
+                    "Changes": list(changes.values())
+                })
+                submitted[zone_name] = response["ChangeInfo"]["Id"]
+                logger.info(f"Submitted {len(changes)} DNS changes to {zone_name} as {submitted[zone_name]}")
+            except Exception as e:
+                logger.error(f"Changing {len(changes)} DNS records in {zone_name} failed: {e}")
+                errors[zone_name] = e
+
+        waits = [(Waiter(f"DNS change {change_id} in {zone_name}", timeout=settings.DNS_CHANGE_TIMEOUT), lambda change_id=change_id: self.is_in_sync(change_id))
+                 for zone_name, change_id in submitted.items()]
+        for zone_name, (result, error) in zip(submitted, wait_all(waits, len(waits))):
+            if error is not None:
+                logger.error(f"DNS changes to {zone_name} did not sync: {error}")
+                errors[zone_name] = error
+
+        results = [errors.get(zone_name) for zone_name, _, _, _ in self.records]
+        logger.info(f"{results.count(None)} of {len(results)} DNS records updated in {len(submitted)} change batches")
+        return results
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from engine.models import Blackout, ClusterInfo, ExceptionData
+from engine.singleton import Singleton
+logger = logging.getLogger(__name__)
+
+
+def parse_dates(dates):
+    """
+    The days in "2021-04-06, 2021-04-03" or ["2021-04-06", "2021-04-03"], where an item can also be
+    a range like "2021-05-01/2021-05-07" (both ends included), sorted and without duplicates.
+    Raises ValueError for anything that isn't a date or a range.
+    """
+    if isinstance(dates, str):
+        dates = dates.split(",")
+    days = set()
+    for item in dates:
+        item = str(item).strip()
+        if not item:
+            continue
+        start, _, end = item.partition("/")
+        start = datetime.strptime(start.strip(), "%Y-%m-%d").date()
+        end = datetime.strptime(end.strip(), "%Y-%m-%d").date() if end else start
+        if end < start:
+            raise ValueError(f"{item} ends before it starts")
+        days.update(start + timedelta(days=offset) for offset in range((end - start).days + 1))
+    return sorted(days)
+
+
+class BlackoutCalendar(metaclass=Singleton):
+    """
+    The exception dates, as Blackout rows per (day, cluster). Adding dates writes ExceptionData and its Blackout rows
+    with a query per table however many days are added, and the clusters blacked out on a day are read once and kept
+    for BLACKOUT_CACHE_TTL seconds. Writes through this class invalidate it; other processes see them after the TTL.
+    A day with an ExceptionData but no Blackout rows, saved before they existed, gets its rows the first time it is read.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # date -> (frozenset of cluster ids, loaded_at)
+        self.days = dict()
+
+    def __repr__(self):
+        return "<BlackoutCalendar days:%s>" % sorted(str(day) for day in self.days)
+
+    def clusters_on(self, day=None):
+        """
+        The ids of the clusters blacked out on day (today by default)
+        """
+        day = day or timezone.now().date()
+        cached = self.days.get(day)
+        if cached is not None and time.monotonic() - cached[1] < settings.BLACKOUT_CACHE_TTL:
+            return cached[0]
+        clusters = frozenset(Blackout.objects.filter(exception_date=day).values_list("cluster_id", flat=True))
+        if not clusters:
+            clusters = self.backfill(day)
+        with self.lock:
+            now = time.monotonic()
+            self.days = dict((cached_day, entry) for cached_day, entry in self.days.items()
+                             if now - entry[1] < settings.BLACKOUT_CACHE_TTL)
+            self.days[day] = (clusters, now)
+        logger.debug(f"{len(clusters)} clusters are blacked out on {day}")
+        return clusters
+
+    def backfill(self, day):
+        """
+        The clusters ExceptionData.clusters lists for day, writing their missing Blackout rows
+        """
+        exc = ExceptionData.objects.filter(exception_date=day).first()
+        if exc is None or not exc.clusters:
+            return frozenset()
+        known = set(ClusterInfo.objects.filter(id__in=[int(cluster["id"]) for cluster in exc.clusters]).values_list("id", flat=True))
+        if known:
+            logger.warning(f"Exception date {day} had no blackout rows, writing them for clusters {sorted(known)}")
+            Blackout.objects.bulk_create([Blackout(exception=exc, exception_date=day, cluster_id=cluster_id) for cluster_id in known],
+                                         ignore_conflicts=True)
+        return frozenset(known)
+
+    def is_blacked_out(self, cluster_id, day=None):
+        return cluster_id in self.clusters_on(day)
+
+    def add(self, days, clusters, replace=False):
+        """
+        Black clusters out on every one of days, as well as the clusters already listed for a day, or instead of them
+        with replace. clusters are {"id": ..., "value": ...} as ExceptionData.clusters lists them; unknown ids are dropped.
+        Returns the ExceptionData of the days.
+        """
+        days = sorted(set(days))
+        if not days:
+            return list()
+        clusters = dict((int(cluster["id"]), cluster) for cluster in clusters)
+        known = set(ClusterInfo.objects.filter(id__in=list(clusters)).values_list("id", flat=True))
+        clusters = list(cluster for cluster_id, cluster in clusters.items() if cluster_id in known)
+        with transaction.atomic():
+            ExceptionData.objects.bulk_create([ExceptionData(exception_date=day) for day in days], ignore_conflicts=True)
+            exceptions = list(ExceptionData.objects.select_for_update().filter(exception_date__in=days).order_by("exception_date"))
+            now = timezone.now()
+            for exc in exceptions:
+                listed = clusters if replace else exc.clusters + clusters
+                exc.clusters = list(dict((int(cluster["id"]), cluster) for cluster in listed).values())
+                exc.updated_on = now
+            ExceptionData.objects.bulk_update(exceptions, ["clusters", "updated_on"])
+            if replace:
+                Blackout.objects.filter(exception_date__in=days).exclude(cluster_id__in=known).delete()
+            Blackout.objects.bulk_create([Blackout(exception=exc, exception_date=exc.exception_date, cluster_id=cluster_id)
+                                          for exc in exceptions for cluster_id in known], ignore_conflicts=True)
+        logger.info(f"Blacked out {len(known)} clusters on {len(days)} days from {days[0]} to {days[-1]}")
+        self.invalidate()
+        return exceptions
+
+    def delete(self, exception_id):
+        ExceptionData.objects.get(id=exception_id).delete()
+        self.invalidate()
+
+    def rebuild(self):
+        """
+        Write the Blackout rows again from ExceptionData.clusters, e.g. for exception dates saved before they existed
+        """
+        known = set(ClusterInfo.objects.values_list("id", flat=True))
+        with transaction.atomic():
+            Blackout.objects.all().delete()
+            blackouts = Blackout.objects.bulk_create([Blackout(exception=exc, exception_date=exc.exception_date, cluster_id=int(cluster["id"]))
+                                                      for exc in ExceptionData.objects.all()
+                                                      for cluster in exc.clusters if int(cluster["id"]) in known], ignore_conflicts=True)
+        self.invalidate()
+        return len(blackouts)
+
+    def invalidate(self):
+        with self.lock:
+            self.days = dict()
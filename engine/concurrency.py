@@ -0,0 +1,44 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections
+logger = logging.getLogger(__name__)
+
+
+def close_db_connections(func):
+    """
+    Wrap func so that any django db connections opened
+    by a worker thread are closed once it is done
+    """
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            connections.close_all()
+    return wrapper
+
+
+def run_concurrently(func, items, max_workers):
+    """
+    Call func for every item using at most max_workers threads.
+
+    Returns a list of (item, result, exception) tuples in the same
+    order as items. Exceptions are handed back rather than raised so
+    that one bad item doesn't hide the results of the others.
+    With a single worker everything runs inline in the calling thread.
+    """
+    items = list(items)
+    max_workers = max(1, min(int(max_workers), len(items))) if items else 1
+
+    def call(item, worker):
+        try:
+            return item, worker(item), None
+        except Exception as e:
+            return item, None, e
+
+    if max_workers == 1:
+        return [call(item, func) for item in items]
+
+    worker = close_db_connections(func)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(call, item, worker) for item in items]
+        return [future.result() for future in futures]
@@ -0,0 +1,58 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from engine.models import DbCredentials
+from engine.singleton import Singleton
+logger = logging.getLogger(__name__)
+
+
+class CredentialsProvider(metaclass=Singleton):
+    """
+    The DbCredentials rows, decrypted once and kept for CREDENTIALS_CACHE_TTL seconds, so a rule run
+    doesn't read and decrypt the same secret for every node it connects to and every hook it runs.
+    Saving a secret in this process should call invalidate; other processes see it after the TTL.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name = None
+        self.by_description = None
+        self.loaded_at = None
+
+    def __repr__(self):
+        return "<CredentialsProvider secrets:%s>" % (None if self.by_name is None else sorted(self.by_name))
+
+    def load(self):
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at >= settings.CREDENTIALS_CACHE_TTL:
+                secrets = list(DbCredentials.objects.all().order_by("id"))
+                self.by_name = dict((secret.name, secret) for secret in secrets)
+                self.by_description = dict((secret.description, secret) for secret in secrets)
+                self.loaded_at = time.monotonic()
+                logger.debug(f"Loaded {len(secrets)} secrets")
+            return self.by_name, self.by_description
+
+    def get(self, name):
+        """
+        The secret with this name, or None
+        """
+        return self.load()[0].get(name)
+
+    def get_by_description(self, description):
+        return self.load()[1].get(description)
+
+    def aws_env(self):
+        """
+        The environment our scripts get to talk to AWS with the stored AWS secrets, if there are any
+        """
+        secret = self.get_by_description("AWS Secrets")
+        if secret is None:
+            return dict()
+        return dict({
+            "AWS_ACCESS_KEY_ID": secret.user_name,
+            "AWS_SECRET_ACCESS_KEY": secret.password
+        })
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded_at = None
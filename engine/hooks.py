@@ -0,0 +1,213 @@
+import atexit
+import itertools
+import json
+import logging
+import os
+import queue
+import subprocess
+import threading
+from django.conf import settings
+from django.utils.module_loading import import_string
+from engine.singleton import Singleton
+logger = logging.getLogger(__name__)
+
+# The hooks pygmy calls, each of which is scripts/<name>.sh unless PYGMY_HOOKS says otherwise
+DNS_CHANGE = "dns-change"
+PRE_RESIZE = "pre-resize"
+POST_STREAMING = "post-streaming"
+CALL_FOR_HELP = "call-for-help"
+DOWNSIZE_PROGNOSTICATION = "downsize-prognostication"
+
+
+class HookError(Exception):
+    """
+    A hook failed. returncode and output are what the script or worker reported, if anything.
+    """
+    def __init__(self, message, returncode=None, output=None):
+        super(HookError, self).__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+
+class HookWorker:
+    """
+    A long-lived hook process. Every request is one JSON line on its stdin,
+    {"id": 1, "hook": "pre-resize", "args": ["i-123"], "env": {...}}, answered by one JSON line on its stdout,
+    {"id": 1, "ok": true, "output": "..."} or {"id": 1, "ok": false, "returncode": 1, "output": "..."}.
+    A worker handles one request at a time.
+    """
+    def __init__(self, command):
+        self.command = command
+        self.ids = itertools.count(1)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        logger.info(f"Started hook worker {command} as pid {self.process.pid}")
+
+    def __repr__(self):
+        return "<HookWorker command:%s pid:%s>" % (self.command, self.process.pid)
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def call(self, name, args, env):
+        request_id = next(self.ids)
+        try:
+            self.process.stdin.write(json.dumps(dict({"id": request_id, "hook": name, "args": list(args), "env": env})) + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except (OSError, ValueError) as e:
+            raise self.broken(f"failed: {e}")
+        if not line:
+            raise self.broken("closed its output")
+        try:
+            reply = json.loads(line)
+        except ValueError:
+            raise self.broken(f"answered {line!r}")
+        if reply.get("id") != request_id:
+            raise self.broken(f"answered request {reply.get('id')} instead of {request_id}")
+        if not reply.get("ok"):
+            raise HookError(f"{name} hook failed", reply.get("returncode"), reply.get("output"))
+        return reply.get("output") or ""
+
+    def broken(self, problem):
+        """
+        Once a worker is out of step with us nothing it says can be trusted, so it is stopped and replaced
+        """
+        if self.alive:
+            self.process.kill()
+            self.process.wait()
+        logger.warning(f"Hook worker {self.command} {problem}")
+        return HookError(f"Hook worker {self.command} {problem}")
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except Exception:
+            self.process.kill()
+
+
+class WorkerPool:
+    """
+    Up to size HookWorkers running command, started when they are first needed
+    """
+    def __init__(self, command, size=1):
+        self.command = command
+        self.size = max(1, int(size))
+        self.idle = queue.LifoQueue()
+        self.started = 0
+        self.lock = threading.Lock()
+        self.workers = list()
+
+    def __repr__(self):
+        return "<WorkerPool command:%s started:%s size:%s>" % (self.command, self.started, self.size)
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                if self.started < self.size:
+                    self.started += 1
+                    try:
+                        worker = HookWorker(self.command)
+                    except Exception as e:
+                        self.started -= 1
+                        raise HookError(f"Could not start hook worker {self.command}: {e}")
+                    self.workers.append(worker)
+                    return worker
+            # Every worker is busy; wait for one, or for a dead one to make room for a new one
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+    def release(self, worker):
+        if worker.alive:
+            self.idle.put(worker)
+        else:
+            # Let the next caller start a fresh one
+            with self.lock:
+                self.workers.remove(worker)
+                self.started -= 1
+
+    def call(self, name, args, env):
+        worker = self.acquire()
+        try:
+            return worker.call(name, args, env)
+        finally:
+            self.release(worker)
+
+    def close(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = list()
+            self.started = 0
+            self.idle = queue.LifoQueue()
+
+
+class HookRunner(metaclass=Singleton):
+    """
+    Run pygmy's hooks the way PYGMY_HOOKS says to. Each hook can be:
+    - {"callable": "dotted.path"}: a python function called in-process as func(*args, env=env), returning its output
+    - {"worker": ["command", ...], "processes": n}: sent to long-lived worker processes, see HookWorker
+    - {"script": "path"}, or nothing: the script, run once per call with args as its arguments (scripts/<name>.sh by default)
+    Every kind returns the hook's output as a string and raises HookError when the hook fails.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pools = dict()
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return "<HookRunner pools:%s>" % self.pools
+
+    @staticmethod
+    def get_spec(name):
+        return getattr(settings, "PYGMY_HOOKS", dict()).get(name) or dict()
+
+    def run(self, name, args, env=None):
+        args = [str(arg) for arg in args]
+        spec = self.get_spec(name)
+        if "callable" in spec:
+            return self.run_callable(name, spec["callable"], args, env)
+        if "worker" in spec:
+            return self.get_pool(name, spec).call(name, args, env)
+        return self.run_script(name, spec.get("script") or os.path.join(settings.BASE_DIR, "scripts", f"{name}.sh"), args, env)
+
+    @staticmethod
+    def run_callable(name, path, args, env):
+        try:
+            output = import_string(path)(*args, env=env)
+        except HookError:
+            raise
+        except Exception as e:
+            raise HookError(f"{name} hook failed: {e}", output=str(e))
+        return "" if output is None else str(output)
+
+    @staticmethod
+    def run_script(name, script_path, args, env):
+        try:
+            return subprocess.check_output([script_path] + args, env=env).decode()
+        except subprocess.CalledProcessError as e:
+            raise HookError(f"{name} hook failed", e.returncode, e.output)
+        except OSError as e:
+            raise HookError(f"{name} hook failed: {e}")
+
+    def get_pool(self, name, spec):
+        with self.lock:
+            pool = self.pools.get(name)
+            if pool is None or pool.command != spec["worker"]:
+                if pool is not None:
+                    pool.close()
+                pool = self.pools[name] = WorkerPool(spec["worker"], spec.get("processes", 1))
+            return pool
+
+    def close(self):
+        with self.lock:
+            for pool in self.pools.values():
+                pool.close()
+            self.pools = dict()
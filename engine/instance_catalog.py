@@ -0,0 +1,86 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from django.conf import settings
+from engine.models import EC2, RDS, AllEc2InstanceTypes, AllRdsInstanceTypes
+from engine.singleton import Singleton
+logger = logging.getLogger(__name__)
+
+
+def instance_family(instance_type):
+    """
+    m5 for m5.large and for db.m5.large
+    """
+    parts = instance_type.split(".")
+    return parts[1] if parts[0] == "db" and len(parts) > 2 else parts[0]
+
+
+class Catalog:
+    """
+    The instance types of one service, as the rule forms want them and indexed for lookups.
+    vCPU and memory are only known for EC2 types.
+    """
+    def __init__(self, rows):
+        self.types = sorted(instance_type for instance_type, _, _ in rows)
+        # What the autocomplete on the rule forms reads
+        self.json = json.dumps([dict({"instance_type": instance_type, "value": instance_type, "data": instance_type})
+                                for instance_type in self.types])
+        self.by_family = defaultdict(list)
+        self.by_vcpus = defaultdict(list)
+        self.by_memory = defaultdict(list)
+        for instance_type, vcpus, memory in sorted(rows, key=lambda row: (row[1] or 0, row[2] or 0, row[0])):
+            self.by_family[instance_family(instance_type)].append(instance_type)
+            if vcpus is not None:
+                self.by_vcpus[vcpus].append(instance_type)
+            if memory is not None:
+                self.by_memory[memory].append(instance_type)
+        self.loaded_at = time.monotonic()
+
+    def __repr__(self):
+        return "<Catalog types:%s families:%s>" % (len(self.types), len(self.by_family))
+
+    def family(self, instance_type):
+        """
+        The types in the same family, smallest first
+        """
+        return list(self.by_family.get(instance_family(instance_type), ()))
+
+
+class InstanceTypeCatalog(metaclass=Singleton):
+    """
+    The AllEc2InstanceTypes and AllRdsInstanceTypes tables, read once per process and kept for
+    INSTANCE_TYPE_CATALOG_TTL seconds, so rendering a form doesn't read and serialize them again.
+    Saving instance types in this process invalidates it; other processes pick changes up after the TTL.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.catalogs = dict()
+
+    def __repr__(self):
+        return "<InstanceTypeCatalog %s>" % self.catalogs
+
+    @staticmethod
+    def load_rows(service_type):
+        if service_type == EC2:
+            return [(instance_type, vcpu.get("DefaultVCpus"), memory.get("SizeInMiB")) for instance_type, vcpu, memory in
+                    AllEc2InstanceTypes.objects.values_list("instance_type", "virtual_cpu_info", "memory_info")]
+        return [(instance_type, None, None) for instance_type in AllRdsInstanceTypes.objects.values_list("instance_type", flat=True)]
+
+    def get(self, service_type):
+        catalog = self.catalogs.get(service_type)
+        if catalog is not None and time.monotonic() - catalog.loaded_at < settings.INSTANCE_TYPE_CATALOG_TTL:
+            return catalog
+        with self.lock:
+            catalog = self.catalogs.get(service_type)
+            if catalog is None or time.monotonic() - catalog.loaded_at >= settings.INSTANCE_TYPE_CATALOG_TTL:
+                catalog = Catalog(self.load_rows(service_type))
+                logger.debug(f"Loaded {len(catalog.types)} {service_type} instance types")
+                self.catalogs[service_type] = catalog
+            return catalog
+
+    def invalidate(self, service_type=None):
+        with self.lock:
+            for cached in ([service_type] if service_type else [EC2, RDS]):
+                self.catalogs.pop(cached, None)
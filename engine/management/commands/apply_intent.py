@@ -57,4 +57,4 @@ class Command(BaseCommand):
             logger.info(f"running {python_path} {manage_path} {rule_id} returned generic error: {message}")
 
         # Now that we've completed our intent, remove it from cron
-        CronUtil.delete_cron_intent(rule_id)
+        CronUtil.delete_cron_intent(rule_id, sanitized_instance_id)
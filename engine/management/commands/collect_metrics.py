@@ -0,0 +1,38 @@
+import logging
+import time
+from django.conf import settings
+from django.core.management import BaseCommand
+from engine.rules.metrics_helper import MetricsHelper
+
+logger = logging.getLogger(__name__)
+
+# How often, in seconds, to downsample and prune stored samples
+MAINTENANCE_INTERVAL = 3600
+
+
+class Command(BaseCommand):
+    help = "Sample load, replication lag and connections from every node and store them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Take a single round of samples and exit")
+        parser.add_argument('--interval', type=int, default=None,
+                            help="Seconds between samples (defaults to METRICS_COLLECT_INTERVAL)")
+
+    def handle(self, *args, **kwargs):
+        interval = kwargs['interval'] or settings.METRICS_COLLECT_INTERVAL
+        last_maintenance = None
+        while True:
+            started = time.monotonic()
+            try:
+                MetricsHelper.collect()
+                if last_maintenance is None or started - last_maintenance >= MAINTENANCE_INTERVAL:
+                    MetricsHelper.downsample()
+                    MetricsHelper.prune()
+                    last_maintenance = started
+            except Exception as e:
+                logger.exception(e)
+                logger.error("Failed: collecting metrics")
+
+            if kwargs['once']:
+                return
+            time.sleep(max(0, interval - (time.monotonic() - started)))
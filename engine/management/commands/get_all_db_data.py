@@ -17,7 +17,6 @@ class Command(BaseCommand):
             if ec2_sync.value == 'True':
                 logger.info("Getting EC2 instance from AWS started")
                 ec2_service = EC2Service()
-                ec2_service.clear_db()
                 ec2_service.get_instances()
                 logger.info("EC2 instances successfully")
             else:
@@ -27,7 +26,6 @@ class Command(BaseCommand):
             if rds_sync.value == 'True':
                 logger.info("Started: Getting RDS info")
                 rds_service = RDSService()
-                rds_service.clear_db()
                 rds_service.get_instances()
                 logger.info("Completed: RDS info")
             else:
@@ -0,0 +1,27 @@
+import logging
+import sys
+from django.core.management import BaseCommand
+from engine.aws.events import InventoryEvents
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Apply recorded EC2 state-change and RDS instance events to the inventory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help="A JSON list of events or one JSON event per line; - reads stdin")
+
+    def handle(self, *args, **kwargs):
+        try:
+            if kwargs['file'] == '-':
+                text = sys.stdin.read()
+            else:
+                with open(kwargs['file']) as events_file:
+                    text = events_file.read()
+            result = InventoryEvents.apply(InventoryEvents.load(text))
+            self.stdout.write(str(result))
+        except Exception as e:
+            logger.exception(e)
+            logger.error("Failed: ingesting events")
+            print("Exception: " + str(e))
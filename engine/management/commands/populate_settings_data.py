@@ -3,6 +3,7 @@ from django.core.management import BaseCommand
 from engine.aws.ec_wrapper import EC2Service
 from engine.aws.aws_utils import AWSUtil
 from users.models import User
+from engine.credentials import CredentialsProvider
 from engine.models import DbCredentials
 from webapp.models import Settings, SYNC, CONFIG, AWS_REGION
 
@@ -84,6 +85,7 @@ class Command(BaseCommand):
                     secret.save()
                 else:
                     print("Use set_secrets command to reset the aws/postgres secrets")
+        CredentialsProvider().invalidate()
 
         # Create user
         Command.create_default_user()
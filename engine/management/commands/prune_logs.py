@@ -0,0 +1,30 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+from pygmy.models import Log
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Delete stored log records older than LOG_RETENTION_DAYS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Keep this many days of logs (defaults to LOG_RETENTION_DAYS)")
+
+    def handle(self, *args, **kwargs):
+        days = kwargs['days'] if kwargs['days'] is not None else settings.LOG_RETENTION_DAYS
+        cutoff = timezone.now() - timedelta(days=days)
+        deleted = 0
+        while True:
+            # Oldest first along the time index, a batch per statement
+            ids = list(Log.objects.filter(time__lt=cutoff).order_by("time").values_list("id", flat=True)[:settings.LOG_PRUNE_BATCH_SIZE])
+            if not ids:
+                break
+            batch, _ = Log.objects.filter(id__in=ids).delete()
+            deleted += batch
+        logger.info(f"Pruned {deleted} log records from before {cutoff}")
+        self.stdout.write(f"Pruned {deleted} log records")
@@ -0,0 +1,14 @@
+import logging
+from django.core.management import BaseCommand
+from engine.blackouts import BlackoutCalendar
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Write the per-cluster blackout rows again from the stored exception dates"
+
+    def handle(self, *args, **kwargs):
+        count = BlackoutCalendar().rebuild()
+        logger.info(f"Rebuilt {count} blackouts")
+        self.stdout.write(f"Rebuilt {count} blackouts")
@@ -0,0 +1,89 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from engine.blackouts import BlackoutCalendar
+from engine.models import Rules
+from engine.rules.cronutils import CronUtil
+from engine.management.commands.apply_rule import Command as ApplyRuleCommand
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Run rules and their retries on schedule from a single long-lived process"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="How many rules may run at once (defaults to SCHEDULER_MAX_WORKERS)")
+
+    def handle(self, *args, **kwargs):
+        if CronUtil.uses_crontab():
+            logger.warn("PYGMY_SCHEDULER is not \"daemon\", so rules in the crontab will also be run by cron")
+
+        workers = kwargs['workers'] or settings.SCHEDULER_MAX_WORKERS
+        running = dict()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                # Like cron, wake up at the top of every minute. Cron uses the local clock, so we do too.
+                now = datetime.now()
+                time.sleep(60 - now.second - now.microsecond / 1000000)
+                tick = datetime.now().replace(second=0, microsecond=0)
+
+                running = dict((rid, future) for rid, future in running.items() if not future.done())
+                close_old_connections()
+                try:
+                    due = self.due_rules(tick)
+                except Exception as e:
+                    logger.exception(f"Could not work out which rules are due: {e}")
+                    continue
+
+                for rule in due:
+                    if rule.id in running:
+                        logger.info(f"Not starting rule {rule.id} ({rule.name}) because its last run hasn't finished")
+                        continue
+                    logger.info(f"Starting rule {rule.id} ({rule.name})")
+                    running[rule.id] = pool.submit(self.run_rule, rule.id)
+
+    @staticmethod
+    def due_rules(when):
+        due = list()
+        blackouts = BlackoutCalendar()
+        for rule in Rules.objects.all().order_by("id"):
+            try:
+                if CronUtil.is_due(rule, when) or Command.is_retry_due(rule):
+                    # check_exception_date would fail the run anyway, so don't start it
+                    if blackouts.is_blacked_out(rule.cluster_id):
+                        logger.info(f"Not starting rule {rule.id} ({rule.name}) because its cluster is blacked out today")
+                        continue
+                    due.append(rule)
+            except Exception as e:
+                logger.error(f"Skipping rule {rule.id} because its schedule {rule.run_at} can't be read: {e}")
+        return due
+
+    @staticmethod
+    def is_retry_due(rule):
+        """
+        A rule that failed with retries left is run again every retry_after minutes,
+        which is what the retry crontab entry would do
+        """
+        retry = rule.rule.get("retry", None) if isinstance(rule.rule, dict) else None
+        if not retry or rule.attempts == 0 or rule.last_run is None or rule.working_pid is not None:
+            return False
+        if int(rule.attempts) > int(retry.get("retry_max") or 0):
+            return False
+        return timezone.now() - rule.last_run >= timedelta(minutes=int(retry.get("retry_after") or 15))
+
+    @staticmethod
+    def run_rule(rid):
+        close_old_connections()
+        try:
+            ApplyRuleCommand().try_rule(rid)
+        except Exception as e:
+            logger.exception(f"Rule {rid} failed: {e}")
+        finally:
+            close_old_connections()
@@ -1,5 +1,6 @@
 import logging
 from django.core.management import BaseCommand
+from engine.credentials import CredentialsProvider
 from engine.models import DbCredentials
 
 logger = logging.getLogger(__name__)
@@ -25,5 +26,6 @@ class Command(BaseCommand):
         db_secret.user_name = db_username
         db_secret.password = db_pwd
         db_secret.save()
+        CredentialsProvider().invalidate()
 
         print("Done")
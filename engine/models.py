@@ -92,6 +92,16 @@ class DbCredentials(models.Model):
     password = SecureField(max_length=255)
 
 
+class Ec2DbInfoQuerySet(models.QuerySet):
+
+    def with_instances(self):
+        """
+        Load the cluster and the EC2/RDS instance behind every row up front: one query for the
+        rows and one per instance table, however many rows there are
+        """
+        return self.select_related("cluster", "instance_type").prefetch_related("instance_object")
+
+
 class Ec2DbInfo(models.Model):
     instance_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, null=True)
     instance_id = models.CharField(max_length=255, unique=True)
@@ -104,10 +114,42 @@ class Ec2DbInfo(models.Model):
     type = models.CharField(choices=CLUSTER_TYPES, max_length=30)
     last_instance_type = models.CharField(max_length=64, null=False)
 
+    objects = Ec2DbInfoQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["cluster", "isPrimary"]),
+        ]
+
     def __repr__(self):
         return "<Ec2DbInfo instance_type:%s instance_id:%s instance_object:%s isPrimary:%s cluster:%s dbName:%s isConnected:%s lastUpdated:%s type:%s last_instance_type:%s>" % (self.instance_type, self.instance_id, self.instance_object, self.isPrimary, self.cluster, self.dbName, self.isConnected, self.lastUpdated, self.type, self.last_instance_type)
 
 
+class NodeMetricSample(models.Model):
+    """
+    Load, lag and connection samples taken from each node by the
+    collect_metrics command. Raw samples have a bucket_seconds of 0; once
+    they are old enough they are rolled up into one row per node per bucket.
+    """
+    node = models.ForeignKey(Ec2DbInfo, on_delete=models.CASCADE, related_name="metric_samples")
+    time = models.DateTimeField()
+    day = models.DateField()
+    load_avg = models.FloatField(null=True)
+    replication_lag = models.IntegerField(null=True)
+    active_connections = models.IntegerField(null=True)
+    streaming = models.BooleanField(null=True)
+    bucket_seconds = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["node", "time"]),
+            models.Index(fields=["day", "bucket_seconds"]),
+        ]
+
+    def __repr__(self):
+        return "<NodeMetricSample node:%s time:%s load_avg:%s replication_lag:%s active_connections:%s streaming:%s bucket_seconds:%s>" % (self.node_id, self.time, self.load_avg, self.replication_lag, self.active_connections, self.streaming, self.bucket_seconds)
+
+
 class AllEc2InstanceTypes(models.Model):
     """
     Simple DB to store all instances.
@@ -281,6 +323,12 @@ class ActionLogs(models.Model):
     extra_data = models.TextField(null=True)
     status = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # Actions are listed newest id first, for every rule or one
+            models.Index(fields=["rule", "id"]),
+        ]
+
 
 def is_valid_date(data):
     try:
@@ -306,6 +354,23 @@ class ExceptionData(models.Model):
     updated_on = models.DateTimeField(auto_now=True)
 
 
+class Blackout(models.Model):
+    """
+    One row per cluster listed in an ExceptionData, so whether a cluster
+    is blacked out on a day is a lookup on the (exception_date, cluster)
+    unique index. Written by engine.blackouts.BlackoutCalendar together
+    with ExceptionData.clusters
+    """
+    exception = models.ForeignKey(ExceptionData, on_delete=models.CASCADE, related_name="blackouts")
+    exception_date = models.DateField(null=False)
+    cluster = models.ForeignKey(ClusterInfo, on_delete=models.CASCADE, related_name="blackouts")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["exception_date", "cluster"], name="unique_blackout_date_cluster")
+        ]
+
+
 class DNSData(models.Model):
     """
     All DNS data per cluster will be stored
@@ -332,6 +397,10 @@ class DNSData(models.Model):
             models.UniqueConstraint(fields=["cluster", "tag_role"],
                                     name="unique_cluster_role")
         ]
+        indexes = [
+            models.Index(fields=["match_type", "instance"]),
+            models.Index(fields=["match_type", "cluster"]),
+        ]
 
 
 class ClusterManagement(models.Model):
@@ -342,4 +411,6 @@ class ClusterManagement(models.Model):
     fallback_instances_scale_up = models.JSONField(null=True)
     fallback_instances_scale_down = models.JSONField(null=True)
     check_active_users = models.JSONField(null=True)
+    max_parallel_resizes = models.IntegerField(default=1)
+    min_in_service_replicas = models.IntegerField(default=0)
     cluster_id = models.OneToOneField(ClusterInfo, on_delete=models.CASCADE, related_name="load_management")
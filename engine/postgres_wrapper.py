@@ -1,20 +1,139 @@
 import psycopg2
 import logging
+import threading
+import time
+from django.conf import settings
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from engine.singleton import Singleton
 logger = logging.getLogger(__name__)
 
 
+def connect(DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT=5432):
+    if DB_USER and DB_PASS:
+        return psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS, port=DB_PORT)
+    # Assume libpq will do the needful to find a working username and password, such as with pgpass
+    return psycopg2.connect(host=DB_HOST, database=DB_NAME, port=DB_PORT)
+
+
+class PostgresConnectionPool(metaclass=Singleton):
+    """
+    Process wide pool of connections to the postgres nodes we
+    monitor, keyed by (host, db, user, port). Idle connections are
+    health checked before being handed out again and evicted once
+    they have been idle for too long.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = dict()
+
+    def acquire(self, DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT=5432):
+        key = (DB_HOST, DB_NAME, DB_USER, DB_PORT)
+        while True:
+            with self.lock:
+                self.evict_expired()
+                entries = self.idle.get(key)
+                entry = entries.pop() if entries else None
+            if entry is None:
+                break
+            conn, released_at = entry
+            if self.is_healthy(conn, released_at):
+                logger.debug(f"Reusing pooled connection to {DB_HOST}/{DB_NAME}")
+                return key, conn
+            logger.debug(f"Discarding unhealthy pooled connection to {DB_HOST}/{DB_NAME}")
+            self.discard(conn)
+        return key, connect(DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT)
+
+    def release(self, key, conn):
+        if conn.closed or conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            self.discard(conn)
+            return
+        with self.lock:
+            entries = self.idle.setdefault(key, list())
+            entries.append((conn, time.monotonic()))
+            while len(entries) > settings.POSTGRES_POOL_MAX_IDLE_PER_NODE:
+                self.discard(entries.pop(0)[0])
+
+    def is_healthy(self, conn, released_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - released_at < settings.POSTGRES_POOL_HEALTH_CHECK_AFTER:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            return True
+        except Exception as e:
+            logger.debug(f"Pooled connection failed its health check: {e}")
+            return False
+
+    def evict_expired(self):
+        """
+        Close connections that have sat idle for longer than
+        POSTGRES_POOL_MAX_IDLE_TIME. Expects the pool lock to be held.
+        """
+        cutoff = time.monotonic() - settings.POSTGRES_POOL_MAX_IDLE_TIME
+        for key, entries in list(self.idle.items()):
+            fresh = [entry for entry in entries if entry[1] >= cutoff]
+            for conn, released_at in entries:
+                if released_at < cutoff:
+                    self.discard(conn)
+            if fresh:
+                self.idle[key] = fresh
+            else:
+                del self.idle[key]
+
+    def evict(self, DB_HOST=None):
+        """
+        Close every idle connection, or only those to DB_HOST
+        """
+        with self.lock:
+            for key in list(self.idle.keys()):
+                if DB_HOST is None or key[0] == DB_HOST:
+                    for conn, released_at in self.idle.pop(key):
+                        self.discard(conn)
+
+    @staticmethod
+    def discard(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class NodeSnapshot:
+    """
+    The metrics we check a node against, collected in a single round trip
+    """
+    def __init__(self, in_recovery, replication_lag, load_avg, active_connections, streaming,
+                 usernames=None, user_connections=None):
+        self.in_recovery = in_recovery
+        self.replication_lag = replication_lag
+        self.load_avg = load_avg
+        self.active_connections = active_connections
+        self.streaming = streaming
+        self.usernames = usernames
+        self.user_connections = user_connections
+
+    def __repr__(self):
+        return "<NodeSnapshot in_recovery:%s lag:%s load:%s connections:%s streaming:%s user_connections:%s>" % (
+            self.in_recovery, self.replication_lag, self.load_avg, self.active_connections, self.streaming,
+            self.user_connections)
+
+
 class PostgresData:
     """
     Interact with postgres data using DB host and password
     """
-    def __init__(self, DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT=5432, expect_errors=False):
+    def __init__(self, DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT=5432, expect_errors=False, pool=None):
+        self.pool = pool
+        self.pool_key = None
         try:
             logger.debug(f"Connecting to Postgres {DB_HOST}/{DB_NAME}")
-            if DB_USER and DB_PASS:
-                self.conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, user=DB_USER, password=DB_PASS, port=DB_PORT)
+            if pool is not None:
+                self.pool_key, self.conn = pool.acquire(DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT)
             else:
-                # Assume libpq will do the needful to find a working username and password, such as with pgpass
-                self.conn = psycopg2.connect(host=DB_HOST, database=DB_NAME, port=DB_PORT)
+                self.conn = connect(DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT)
             self.cursor = self.conn.cursor()
             self.conn.set_session(autocommit=True)
         except Exception as e:
@@ -26,20 +145,20 @@ class PostgresData:
                 logger.info(f"Got not-unexpected error connecting to {DB_HOST}/{DB_NAME}")
                 raise e
 
-    def execute_and_return_data(self, query, expect_errors=False):
+    def execute_and_return_data(self, query, expect_errors=False, params=None):
         if expect_errors is True and self is None:
             return None
 
         try:
             result = []
-            self.cursor.execute(query)
+            self.cursor.execute(query, params)
             raw = self.cursor.fetchall()
 
             for line in raw:
                 result.append(line)
             return result
         except Exception as e:
-            if self.conn.closed() is False:
+            if not self.conn.closed:
                 self.conn.close()
             if expect_errors is False:
                 logger.exception(e)
@@ -111,6 +230,15 @@ class PostgresData:
         query = "SELECT EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp()))::INT replica_lag_in_seconds"
         return self.execute_and_return_data(query)[0][0]
 
+    def get_wal_position(self):
+        """
+        Return how far into the WAL this node is, in bytes:
+        the write position on a primary, the replay position on a replica
+        """
+        query = "SELECT pg_wal_lsn_diff(CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "\
+                "ELSE pg_current_wal_lsn() END, '0/0')::bigint"
+        return self.execute_and_return_data(query)[0][0]
+
     def get_streaming_status(self, expect_errors=False):
         """
         Return streaming status
@@ -168,6 +296,38 @@ class PostgresData:
         else:
             return 0
 
+    def get_node_snapshot(self, usernames=None):
+        """
+        Collect recovery state, replication lag, load avg, active connections,
+        streaming status and (optionally) connections for specific users
+        with one query, so checking a node costs a single round trip
+        """
+        params = list()
+        user_query = "NULL::bigint"
+        if usernames:
+            user_query = "(SELECT count(*) FROM pg_stat_activity WHERE state in ('active', 'idle in transaction') AND ({}))".format(
+                " or ".join("usename like %s" for _ in usernames))
+            params = list(usernames)
+        query = "SELECT pg_is_in_recovery(), "\
+                "EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp()))::INT, "\
+                "(SELECT load_avg_ten_minutes FROM pg_sys_load_avg_info()), "\
+                "(SELECT count(*) FROM pg_stat_activity WHERE datname != 'postgres' "\
+                "GROUP BY datname, usename, application_name, state LIMIT 1), "\
+                "(SELECT status FROM pg_stat_wal_receiver LIMIT 1), "\
+                "{}".format(user_query)
+        row = self.execute_and_return_data(query, params=params)[0]
+        snapshot = NodeSnapshot(in_recovery=row[0], replication_lag=row[1], load_avg=row[2],
+                                active_connections=row[3] or 0, streaming=(str(row[4]) == "streaming"),
+                                usernames=usernames, user_connections=row[5])
+        logger.debug(f"Result of get node snapshot: {snapshot}")
+        return snapshot
+
     def close(self):
+        """
+        Hand the connection back to its pool if it came from one
+        """
         self.cursor.close()
-        self.conn.close()
+        if self.pool is not None:
+            self.pool.release(self.pool_key, self.conn)
+        else:
+            self.conn.close()
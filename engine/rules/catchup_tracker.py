@@ -0,0 +1,84 @@
+import logging
+import time
+from collections import deque
+from django.conf import settings
+logger = logging.getLogger(__name__)
+
+
+class CatchupTracker:
+    """
+    Follow a replica catching up with its primary by sampling the primary's WAL write position and
+    the replica's replay position. Unlike the replay timestamp, the byte lag means something on an
+    idle primary too, and from the last window seconds of samples we can tell how fast the replica
+    applies WAL, how fast the primary writes it, and so when the replica should have caught up.
+    """
+    def __init__(self, primary, replica, window=None):
+        self.primary = primary
+        self.replica = replica
+        self.window = window or settings.REPLICA_CATCHUP_WINDOW
+        # (monotonic time, primary written bytes, replica replayed bytes)
+        self.samples = deque()
+
+    def __repr__(self):
+        return "<CatchupTracker replica:%s lag:%s>" % (self.replica.instance.instanceId, self.lag_bytes)
+
+    def sample(self):
+        """
+        Take one sample of both positions and return the byte lag
+        """
+        try:
+            # Read the replica first, so the lag can only ever be overestimated
+            replayed = self.replica.db_conn().get_wal_position()
+            written = self.primary.db_conn().get_wal_position()
+        except Exception:
+            # Drop the connections, so the next sample reconnects
+            self.replica.release_conn()
+            self.primary.release_conn()
+            raise
+        if replayed is None or written is None:
+            raise Exception(f"{self.replica.instance.instanceId} has not replayed any WAL yet")
+
+        now = time.monotonic()
+        self.samples.append((now, written, replayed))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+        return self.lag_bytes
+
+    @property
+    def lag_bytes(self):
+        if not self.samples:
+            return None
+        return max(0, self.samples[-1][1] - self.samples[-1][2])
+
+    def rates(self):
+        """
+        (apply rate, write rate) in bytes per second over the window, or (None, None) with fewer than two samples
+        """
+        if len(self.samples) < 2:
+            return None, None
+        (first, first_written, first_replayed), (last, last_written, last_replayed) = self.samples[0], self.samples[-1]
+        elapsed = last - first
+        if elapsed <= 0:
+            return None, None
+        return (last_replayed - first_replayed) / elapsed, (last_written - first_written) / elapsed
+
+    def eta(self):
+        """
+        Seconds until the replica should have caught up, or None if it isn't gaining on the primary
+        """
+        lag = self.lag_bytes
+        if lag == 0:
+            return 0
+        apply_rate, write_rate = self.rates()
+        if apply_rate is None or apply_rate <= write_rate:
+            return None
+        return lag / (apply_rate - write_rate)
+
+    def is_caught_up(self, max_lag_bytes):
+        lag = self.sample()
+        apply_rate, write_rate = self.rates()
+        eta = self.eta()
+        logger.info(f"{self.replica.instance.instanceId} is {lag} bytes behind"
+                    + (f", applying {apply_rate:.0f} B/s against {write_rate:.0f} B/s written" if apply_rate is not None else "")
+                    + (f", caught up in about {eta:.0f}s" if eta is not None else ""))
+        return lag <= max_lag_bytes
@@ -10,14 +10,89 @@ logger = logging.getLogger(__name__)
 
 cron_lock_id = '42'
 
+CRON_FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+CRON_NAMES = [
+    None,
+    None,
+    None,
+    dict((name, number + 1) for number, name in enumerate(["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"])),
+    dict((name, number) for number, name in enumerate(["sun", "mon", "tue", "wed", "thu", "fri", "sat"])),
+]
+
 
 class CronUtil:
 
+    @staticmethod
+    def uses_crontab():
+        """
+        With PYGMY_SCHEDULER = "daemon" the run_scheduler command runs rules and their retries,
+        so we keep them out of the crontab
+        """
+        return settings.PYGMY_SCHEDULER != "daemon"
+
+    @staticmethod
+    def parse_cron_field(field, index):
+        """
+        Expand one field of a cron expression (e.g. "*/15", "1-5", "mon,wed") into the set of values it matches
+        """
+        low, high = CRON_FIELD_RANGES[index]
+        names = CRON_NAMES[index] or dict()
+        values = set()
+        for part in field.lower().split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = [int(names.get(value, value)) for value in part.split("-")]
+            else:
+                start = int(names.get(part, part))
+                end = high if step > 1 else start
+            values.update(range(start, end + 1, step))
+        if index == 4 and 7 in values:
+            # Both 0 and 7 are Sunday
+            values.add(0)
+        return values
+
+    @staticmethod
+    def cron_matches(expression, when):
+        """
+        Does a five field cron expression fire at the minute of datetime when?
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Invalid cron expression {expression}")
+        minute, hour, dom, month, dow = [CronUtil.parse_cron_field(field, index) for index, field in enumerate(fields)]
+        if when.minute not in minute or when.hour not in hour or when.month not in month:
+            return False
+        dom_matches = when.day in dom
+        dow_matches = (when.weekday() + 1) % 7 in dow
+        # As in cron, if both day fields are restricted then either may match
+        if fields[2] != "*" and fields[4] != "*":
+            return dom_matches or dow_matches
+        return dom_matches and dow_matches
+
+    @staticmethod
+    def is_due(rule, when):
+        """
+        Should rule run at the minute of datetime when? Mirrors the crontab entries create_cron writes.
+        """
+        if rule.run_type == DAILY:
+            hour, minute = rule.run_at[0].split(":")[:2]
+            return (not hour or int(hour) == when.hour) and (not minute or int(minute) == when.minute)
+        return any(CronUtil.cron_matches(this_time, when) for this_time in rule.run_at)
+
     @staticmethod
     def create_cron(rule):
         with advisory_lock(cron_lock_id) as acquired:
             cron = CronTab(user=getpass.getuser())
             cron.remove_all(comment="rule_{}".format(str(rule.id)))
+            if not CronUtil.uses_crontab():
+                logger.debug(f"Not adding rule {rule.id} to the crontab because the scheduler daemon runs it")
+                cron.write()
+                return
 
             # Run at
             if rule.run_type == DAILY:
@@ -40,12 +115,18 @@ class CronUtil:
 
             cron.write()
 
+    @staticmethod
+    def build_intent_comment(rule_id, instance):
+        # Replicas of a wave are resized at the same time, so each one has an intent of its own
+        return f"intent_{rule_id}_{instance}"
+
+    @staticmethod
     def create_cron_intent(rule_id, instance):
         with advisory_lock(cron_lock_id) as acquired:
             cron = CronTab(user=getpass.getuser())
-            cron.remove_all(comment="intent_{}".format(str(rule_id)))
+            cron.remove_all(comment=CronUtil.build_intent_comment(rule_id, instance))
             job = cron.new(command="{0}/venv/bin/python {0}/manage.py apply_intent {1} {2}".format(settings.BASE_DIR, rule_id, instance),
-                           comment="intent_{}".format(rule_id))
+                           comment=CronUtil.build_intent_comment(rule_id, instance))
 
             # Run on reboot, in case we have crashed.
             job.every_reboot()
@@ -73,7 +154,9 @@ class CronUtil:
             retry_rule_comment = CronUtil.build_retry_rule_comment(rule.id)
             try:
                 # Update Crontab jobs
-                if int(attempt) == 1:
+                if int(attempt) == 1 and not CronUtil.uses_crontab():
+                    logger.debug("leaving our retry to the scheduler daemon")
+                elif int(attempt) == 1:
                     with advisory_lock(cron_lock_id) as acquired:
                         cron = CronTab(user=getpass.getuser())
                         logger.debug("making an entry for our first retry")
@@ -116,12 +199,12 @@ class CronUtil:
             cron.write()
 
     @staticmethod
-    def delete_cron_intent(rule_id):
+    def delete_cron_intent(rule_id, instance):
         if sys.platform == "win32":
             return
         with advisory_lock(cron_lock_id) as acquired:
             cron = CronTab(user=getpass.getuser())
-            cron.remove_all(comment="intent_{}".format(rule_id))
+            cron.remove_all(comment=CronUtil.build_intent_comment(rule_id, instance))
             cron.write()
 
     @staticmethod
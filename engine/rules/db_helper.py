@@ -1,15 +1,18 @@
-import json
 import logging
-import time
-from django.db.models import F
-from engine.models import EC2, Ec2DbInfo, AllRdsInstanceTypes, AllEc2InstanceTypes
+import psycopg2
+from django.conf import settings
+from engine.models import EC2, RDS, Ec2DbInfo
 from engine.aws.aws_utils import AWSUtil
+from engine.instance_catalog import InstanceTypeCatalog
 from engine.rules.cronutils import CronUtil
+from engine.rules.metrics_helper import MetricsHelper
+from engine.waiter import Waiter, wait_all
 logger = logging.getLogger(__name__)
 
 
 class DbHelper:
     conn = None
+    snapshot = None
 
     def __init__(self, db: Ec2DbInfo):
         self.db_info = db
@@ -26,35 +29,93 @@ class DbHelper:
 
     def db_conn(self, force=False, expect_errors=False):
         if force or not self.conn:
+            self.release_conn()
             self.conn = self.aws.create_connection(self.db_info, expect_errors)
         return self.conn
 
+    def release_conn(self):
+        """
+        Hand our connection back to the pool so other checks can reuse it
+        """
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception as e:
+                logger.debug(f"Error releasing connection to {self.instance.instanceId}: {e}")
+            self.conn = None
+
+    def get_snapshot(self, usernames=None, force=False):
+        """
+        Metrics for this node, fetched once and shared by every check of a rule evaluation.
+        Asking for connection counts of different users takes a new snapshot.
+        """
+        if force or self.snapshot is None or (usernames is not None and self.snapshot.usernames != usernames):
+            stored = None
+            if settings.RULES_USE_STORED_METRICS and not force and usernames is None:
+                stored = MetricsHelper.latest_snapshot(self.db_info)
+            self.snapshot = stored or self.db_conn().get_node_snapshot(usernames)
+        return self.snapshot
+
+    def get_metric(self, rule, field):
+        """
+        The value a rule clause is checked against. That is the live snapshot value unless
+        the clause has an agg and window, e.g. {"agg": "p95", "window": "30m"}, in which case
+        it is that aggregate over the samples stored by collect_metrics.
+        """
+        if not rule.get("agg"):
+            return getattr(self.get_snapshot(), field)
+        value, samples = MetricsHelper.aggregate(self.db_info, field, rule.get("agg"), rule.get("window", "5m"))
+        logger.info(f"{rule.get('agg')} of {field} over {rule.get('window', '5m')} is {value} ({samples} samples)")
+        return value
+
     @classmethod
     def from_id(cls, instance_id):
         instance = Ec2DbInfo.objects.get(id=instance_id)
         return cls(instance)
 
+    def is_replica_streaming(self):
+        """
+        One look at whether the replica is back and streaming. The connection is kept between looks;
+        a look that fails drops it, so the next one reconnects.
+        """
+        try:
+            if self.db_conn(expect_errors=True).get_streaming_status(expect_errors=True):
+                return True
+            logger.info(f"Replica {self.instance.instanceId} not yet streaming")
+        except psycopg2.Error as e:
+            logger.info(f"Replica {self.instance.instanceId} not yet accepting connections: {e}")
+            self.release_conn()
+        return False
+
+    def streaming_waiter(self):
+        # is_replica_streaming counts the replica not being up yet as a miss; anything else it raises fails the wait
+        return Waiter(f"{self.instance.instanceId} to stream", timeout=settings.REPLICA_STREAMING_TIMEOUT, retry_on=())
+
     def wait_till_replica_streaming(self):
-        logger.info(f"Waiting for db on instance {self.instance.instanceId} to come alive")
-        is_alive = False
-        while is_alive is False:
-            try:
-                logging.debug("Checking if db is alive")
-                is_alive = self.new_db_conn(expect_errors=True).is_alive(expect_errors=True)
-                time.sleep(5)
-            except Exception:
-                logger.info("Replica not yet accepting connections")
-                time.sleep(5)
-
-        logger.info(f"Waiting till db on instance {self.instance.instanceId} has begun streaming")
-        while self.db_conn().get_streaming_status(expect_errors=True) is False:
-            logger.info("Replica not yet streaming; sleeping for 5 seconds")
-            time.sleep(5)
+        logger.info(f"Waiting till db on instance {self.instance.instanceId} is alive and streaming")
+        try:
+            self.streaming_waiter().wait(self.is_replica_streaming)
+        finally:
+            self.release_conn()
+        logger.info(f"Db on instance {self.instance.instanceId} is streaming")
+
+    @staticmethod
+    def wait_till_all_streaming(helpers):
+        """
+        Wait for several replicas at once from this thread.
+        Returns an exception per helper, None for those that are streaming.
+        """
+        logger.info(f"Waiting till {[helper.instance.instanceId for helper in helpers]} are alive and streaming")
+        results = wait_all([(helper.streaming_waiter(), helper.is_replica_streaming) for helper in helpers],
+                           settings.RULE_PROBE_MAX_WORKERS)
+        for helper in helpers:
+            helper.release_conn()
+        return [error for result, error in results]
 
     def check_replication_lag(self, rule_json, any_conditions):
         replication_lag_rule = rule_json.get("replicationLag", None)
         if replication_lag_rule:
-            replication_lag = self.db_conn().get_replication_lag()
+            replication_lag = self.get_metric(replication_lag_rule, "replication_lag")
             if replication_lag is None:
                 raise Exception("Could not get replication lag")
             else:
@@ -74,7 +135,7 @@ class DbHelper:
     def check_average_load(self, rule_json, any_conditions, offset=0):
         rule = rule_json.get("averageLoad", None)
         if rule:
-            avg_load = self.db_conn().get_system_load_avg()
+            avg_load = self.get_metric(rule, "load_avg")
             if avg_load is None:
                 raise Exception("Could not get system load avg")
             else:
@@ -94,7 +155,7 @@ class DbHelper:
         rule = rule_json.get("checkConnection", None)
         if rule:
             if connections is None:
-                active_connections = self.db_conn().count_all_active_connections()
+                active_connections = self.get_metric(rule, "active_connections")
             else:
                 active_connections = connections
 
@@ -132,9 +193,9 @@ class DbHelper:
         return self.table.get_instances_types()
 
     def count_user_connections(self, users):
-        return self.db_conn().count_specific_active_connections(users)
+        return self.get_snapshot(users).user_connections
 
-    def update_instance_type(self, instance_type, rule_id, fallback_instances=[], cluster_name_to_prognosticate=None):
+    def update_instance_type(self, instance_type, rule_id, fallback_instances=[], cluster_name_to_prognosticate=None, record_instance_type=True):
         if instance_type == self.instance.instanceType:
             logger.info(f"Not going to change instance type because {self.instance.instanceType} == {instance_type}")
             # even though we didn't actually make a change, we're in the same state as if we had, so return True
@@ -145,10 +206,10 @@ class DbHelper:
         # Mark our intent to resize an cluster member
         CronUtil.create_cron_intent(rule_id, self.instance.instanceId)
 
-        if self.aws.scale_instance(self.instance, instance_type, fallback_instances, cluster_name_to_prognosticate):
+        if self.aws.scale_instance(self.instance, instance_type, fallback_instances, cluster_name_to_prognosticate, record_instance_type):
             # Remove our intent, now that it is over.
             # (The rule might still be in progress, but if we were to restart at this moment it should be close enough to idempotent.)
-            CronUtil.delete_cron_intent(rule_id)
+            CronUtil.delete_cron_intent(rule_id, self.instance.instanceId)
         else:
             # Scaling the instance failed
             # We tried as hard as we could, so there's nothing more to do, but we need to let our callers know
@@ -162,7 +223,7 @@ class DbHelper:
         return self.table.get_endpoint_address(self.instance)
 
     def get_system_load_avg(self):
-        return self.db_conn().get_system_load_avg()
+        return self.get_snapshot().load_avg
 
 
 class EC2DBHelper:
@@ -171,8 +232,7 @@ class EC2DBHelper:
 
     @staticmethod
     def get_instances_types():
-        return json.dumps(list(AllEc2InstanceTypes.objects.all().values('instance_type').annotate(
-            value=F('instance_type'), data=F('instance_type'))))
+        return InstanceTypeCatalog().get(EC2).json
 
     @staticmethod
     def get_endpoint_address(instance):
@@ -190,8 +250,7 @@ class RDSDBHelper:
 
     @staticmethod
     def get_instances_types():
-        return json.dumps(list(AllRdsInstanceTypes.objects.all().values('instance_type').annotate(
-            value=F('instance_type'), data=F('instance_type'))))
+        return InstanceTypeCatalog().get(RDS).json
 
     @staticmethod
     def get_endpoint_address(instance):
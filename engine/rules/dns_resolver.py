@@ -0,0 +1,56 @@
+import logging
+from django.conf import settings
+from django.db.models import Q
+from engine.models import DNSData, MATCH_INSTANCE, MATCH_ROLE
+logger = logging.getLogger(__name__)
+
+
+class DNSResolver:
+    """
+    Find the DNS entry of the replicas of a cluster. All of the cluster's entries are read
+    with one query the first time one is needed, instead of one or two queries per replica.
+    An entry matching the instance wins over one matching its role tag.
+    """
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.by_instance = None
+        self.by_role = None
+
+    def __repr__(self):
+        return "<DNSResolver cluster:%s entries:%s>" % (self.cluster.id, None if self.by_instance is None else len(self.by_instance) + len(self.by_role))
+
+    def load(self):
+        if self.by_instance is None:
+            entries = DNSData.objects.filter(Q(match_type=MATCH_INSTANCE, instance__cluster=self.cluster)
+                                             | Q(match_type=MATCH_ROLE, cluster=self.cluster))
+            self.by_instance = dict()
+            self.by_role = dict()
+            for entry in entries:
+                if entry.match_type == MATCH_INSTANCE:
+                    self.by_instance[entry.instance_id] = entry
+                else:
+                    self.by_role[entry.tag_role] = entry
+            logger.debug(f"Loaded {len(self.by_instance)} instance and {len(self.by_role)} role dns entries for cluster {self.cluster.id}")
+
+    def resolve(self, helper):
+        """
+        The DNSData entry for the replica behind helper, or None
+        """
+        self.load()
+        dns_entry = self.by_instance.get(helper.db_info.id)
+        if dns_entry is not None:
+            logger.debug(f"Found dns match of {dns_entry.dns_name} for instance {helper.instance.instanceId}")
+            return dns_entry
+        logger.debug(f"{helper.instance.instanceId} does not have an instance match dns entry")
+
+        # If we don't have an instance match for this instance, maybe we have a role match?
+        role = helper.aws.get_tag_map(helper.instance).get(settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME, None)
+        if not role:
+            logger.debug(f"{helper.instance.instanceId} does not have a {settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME} tag for role matching")
+            return None
+        dns_entry = self.by_role.get(role)
+        if dns_entry is None:
+            logger.debug(f"{helper.instance.instanceId} has role tag {settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME}={role} but cluster {self.cluster.id} has no role match dns entry")
+        else:
+            logger.debug(f"Found dns match of {dns_entry.dns_name} for role {role}")
+        return dns_entry
@@ -0,0 +1,153 @@
+import logging
+import re
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.postgres.aggregates import BoolAnd
+from django.db import transaction
+from django.db.models import Aggregate, Avg, Count, Max, Min, DateTimeField, FloatField, Func
+from django.utils import timezone
+from engine.aws.aws_utils import AWSUtil
+from engine.concurrency import run_concurrently
+from engine.models import Ec2DbInfo, NodeMetricSample
+from engine.postgres_wrapper import NodeSnapshot
+logger = logging.getLogger(__name__)
+
+WINDOW_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+class EpochBucket(Func):
+    """
+    Round a timestamp down to the start of its bucket_seconds long bucket
+    """
+    template = "to_timestamp(floor(extract(epoch from %(expressions)s) / %(bucket_seconds)s) * %(bucket_seconds)s)"
+    output_field = DateTimeField()
+
+
+class Percentile(Aggregate):
+    """
+    Continuous percentile of an expression, e.g. Percentile("load_avg", percentile=0.95)
+    """
+    function = "percentile_cont"
+    name = "Percentile"
+    template = "%(function)s(%(percentile)s) WITHIN GROUP (ORDER BY %(expressions)s)"
+    output_field = FloatField()
+
+
+class MetricsHelper:
+
+    @staticmethod
+    def parse_window(window):
+        """
+        Turn a window like "90s", "30m", "2h" or "1d" into seconds. A bare number is minutes.
+        """
+        match = re.fullmatch(r"\s*(\d+)\s*([smhd]?)\s*", str(window))
+        if not match:
+            raise Exception(f"Invalid window {window}")
+        return int(match.group(1)) * WINDOW_UNITS[match.group(2) or "m"]
+
+    @staticmethod
+    def get_aggregate(agg, field):
+        agg = str(agg).lower()
+        if agg in ("mean", "avg"):
+            return Avg(field)
+        if agg == "max":
+            return Max(field)
+        if agg == "min":
+            return Min(field)
+        match = re.fullmatch(r"p(\d{1,2})", agg)
+        if match:
+            return Percentile(field, percentile=int(match.group(1)) / 100)
+        raise Exception(f"Unsupported aggregate {agg}")
+
+    @staticmethod
+    def aggregate(db, field, agg, window):
+        """
+        Aggregate one metric of a node over the raw samples in the last window.
+        Only the window is read, through the (node, time) index.
+        Returns (value, sample_count); value is None when there were no samples.
+        """
+        since = timezone.now() - timedelta(seconds=MetricsHelper.parse_window(window))
+        result = NodeMetricSample.objects.filter(node=db, bucket_seconds=0, time__gte=since)\
+            .aggregate(value=MetricsHelper.get_aggregate(agg, field), samples=Count(field))
+        logger.debug(f"{agg} of {field} on {db.instance_id} over {window}: {result['value']} from {result['samples']} samples")
+        return result["value"], result["samples"]
+
+    @staticmethod
+    def latest_snapshot(db):
+        """
+        The newest raw sample of a node as a NodeSnapshot, if it is recent enough to trust
+        """
+        oldest = timezone.now() - timedelta(seconds=settings.METRICS_MAX_SAMPLE_AGE)
+        sample = NodeMetricSample.objects.filter(node=db, bucket_seconds=0, time__gte=oldest).order_by("-time").first()
+        if sample is None:
+            return None
+        logger.debug(f"Using stored sample from {sample.time} for {db.instance_id}")
+        return NodeSnapshot(in_recovery=not db.isPrimary, replication_lag=sample.replication_lag,
+                            load_avg=sample.load_avg, active_connections=sample.active_connections,
+                            streaming=sample.streaming)
+
+    @staticmethod
+    def sample_node(db):
+        conn = AWSUtil.get_aws_service(db.type).create_connection(db)
+        try:
+            snapshot = conn.get_node_snapshot()
+        finally:
+            conn.close()
+        now = timezone.now()
+        return NodeMetricSample(node=db, time=now, day=now.date(), load_avg=snapshot.load_avg,
+                                replication_lag=snapshot.replication_lag,
+                                active_connections=snapshot.active_connections, streaming=snapshot.streaming)
+
+    @staticmethod
+    def collect():
+        """
+        Take one sample of every connected node and store them all in one insert
+        """
+        # Load the instances here, the worker threads can't share this thread's connection
+        nodes = list(Ec2DbInfo.objects.with_instances().filter(isConnected=True, cluster__isnull=False))
+        samples = list()
+        for db, sample, error in run_concurrently(MetricsHelper.sample_node, nodes, settings.RULE_PROBE_MAX_WORKERS):
+            if error is not None:
+                logger.warn(f"Could not sample {db.instance_id}: {error}")
+            else:
+                samples.append(sample)
+        NodeMetricSample.objects.bulk_create(samples)
+        logger.info(f"Stored {len(samples)} of {len(nodes)} node samples")
+        return samples
+
+    @staticmethod
+    def downsample(today=None):
+        """
+        Roll raw samples older than METRICS_DOWNSAMPLE_AFTER_DAYS into one row per node
+        per METRICS_DOWNSAMPLE_BUCKET seconds, a day at a time
+        """
+        today = today or timezone.now().date()
+        bucket_seconds = settings.METRICS_DOWNSAMPLE_BUCKET
+        cutoff = today - timedelta(days=settings.METRICS_DOWNSAMPLE_AFTER_DAYS)
+        days = NodeMetricSample.objects.filter(day__lt=cutoff, bucket_seconds=0).values_list("day", flat=True).distinct()
+        for day in list(days):
+            with transaction.atomic():
+                raw = NodeMetricSample.objects.filter(day=day, bucket_seconds=0)
+                rollups = raw.annotate(bucket=EpochBucket("time", bucket_seconds=bucket_seconds))\
+                    .values("node_id", "bucket")\
+                    .annotate(load=Avg("load_avg"), lag=Max("replication_lag"),
+                              connections=Max("active_connections"), all_streaming=BoolAnd("streaming"))
+                NodeMetricSample.objects.bulk_create(
+                    NodeMetricSample(node_id=row["node_id"], time=row["bucket"], day=day, load_avg=row["load"],
+                                     replication_lag=row["lag"], active_connections=row["connections"],
+                                     streaming=row["all_streaming"], bucket_seconds=bucket_seconds)
+                    for row in rollups)
+                deleted, _ = raw.delete()
+            logger.info(f"Downsampled {deleted} samples from {day} into {bucket_seconds}s buckets")
+
+    @staticmethod
+    def prune(today=None):
+        """
+        Drop whole days of samples older than METRICS_RETENTION_DAYS
+        """
+        today = today or timezone.now().date()
+        cutoff = today - timedelta(days=settings.METRICS_RETENTION_DAYS)
+        deleted, _ = NodeMetricSample.objects.filter(day__lt=cutoff).delete()
+        if deleted:
+            logger.info(f"Pruned {deleted} samples from before {cutoff}")
+        return deleted
@@ -1,13 +1,19 @@
 import logging
-import os
-import subprocess
 import sys
+import time
 from django.conf import settings
 from django.utils import timezone
-from django.core.exceptions import ObjectDoesNotExist
 from engine.rules.db_helper import DbHelper
-from engine.models import Rules, RDS, Ec2DbInfo, ExceptionData, SCALE_DOWN, EC2, DbCredentials, DNSData, DAILY, CRON, SCALE_UP
+from engine.rules.catchup_tracker import CatchupTracker
+from engine.rules.dns_resolver import DNSResolver
+from engine.models import Rules, RDS, Ec2DbInfo, SCALE_DOWN, EC2, DAILY, CRON, SCALE_UP
 from engine.rules.cronutils import CronUtil
+from engine.blackouts import BlackoutCalendar
+from engine.concurrency import run_concurrently
+from engine.credentials import CredentialsProvider
+from engine.aws.route53 import Route53Batch
+from engine.hooks import HookRunner, HookError, DNS_CHANGE, PRE_RESIZE, POST_STREAMING
+from engine.waiter import Waiter, wait_all
 logger = logging.getLogger(__name__)
 
 
@@ -22,13 +28,15 @@ class RuleHelper:
         self.cluster_type = rule.cluster.type
         self.new_instance_type = self.rule_json.get("rds_default_type") if self.rule.cluster.type == RDS else self.rule_json.get("ec2_default_type")
         self.new_instance_role_types = self.rule_json.get("rds_role_types") if self.rule.cluster.type == RDS else self.rule_json.get("ec2_role_types")
-        self.secondary_dbs = Ec2DbInfo.objects.filter(cluster=self.rule.cluster, isPrimary=False)
-        self.primary_dbs = Ec2DbInfo.objects.filter(cluster=self.rule.cluster, isPrimary=True)
+        self.secondary_dbs = Ec2DbInfo.objects.with_instances().filter(cluster=self.rule.cluster, isPrimary=False)
+        self.primary_dbs = Ec2DbInfo.objects.with_instances().filter(cluster=self.rule.cluster, isPrimary=True)
         self._is_cluster_managed = hasattr(self.rule.cluster, "load_management")
         self.cluster_mgmt = self.rule.cluster.load_management if self._is_cluster_managed else None
         self.is_reverse = True if self.rule.parent_rule else False
         self.fallback_instances = list()
         self._db_avg_load = dict()
+        self._primary_address = None
+        self.dns_resolver = DNSResolver(self.cluster)
         if self.cluster_mgmt:
             self.fallback_instances = self.cluster_mgmt.fallback_instances_scale_up if self.action == SCALE_UP else self.cluster_mgmt.fallback_instances_scale_down
 
@@ -37,6 +45,12 @@ class RuleHelper:
         rule = Rules.objects.get(id=rule_id)
         return cls(rule)
 
+    def primary_db(self):
+        """
+        The cluster's primary, loaded once with its instance for the life of this helper
+        """
+        return next(iter(self.primary_dbs), None)
+
     @classmethod
     def add_rule_db(cls, data, rule_db=None):
         if not rule_db:
@@ -58,6 +72,7 @@ class RuleHelper:
                     "value": data.get("replicationLag", None)
                 })
             })
+            cls.add_window(new_rule["replicationLag"], data, "replicationLag")
 
         # Set Connection check
         enableCheckConnection = data.get("enableCheckConnection", None)
@@ -68,6 +83,7 @@ class RuleHelper:
                     "value": data.get("checkConnection", None)
                 })
             })
+            cls.add_window(new_rule["checkConnection"], data, "checkConnection")
 
         # Set Average Load check
         enableAverageLoad = data.get("enableAverageLoad", None)
@@ -78,6 +94,7 @@ class RuleHelper:
                     "value": data.get("averageLoad", None)
                 })
             })
+            cls.add_window(new_rule["averageLoad"], data, "averageLoad")
 
         # Set Retry settings
         enableRetry = data.get("enableRetry", None)
@@ -109,6 +126,17 @@ class RuleHelper:
         cls.create_reverse_rule(data, rule_db)
         return rule_db
 
+    @staticmethod
+    def add_window(clause, data, key):
+        """
+        Optionally check a clause against an aggregate of stored samples rather
+        than the live value, e.g. averageLoadAgg=p95 and averageLoadWindow=30m
+        """
+        agg = data.get(key + "Agg", None)
+        if agg:
+            clause["agg"] = agg
+            clause["window"] = data.get(key + "Window", "5m")
+
     @classmethod
     def create_reverse_rule(cls, data, parent_rule):
         reverse_enable = data.get("enableReverse", None)
@@ -153,19 +181,11 @@ class RuleHelper:
         return False
 
     def check_exception_date(self):
-        try:
-            exception_date_data = ExceptionData.objects.get(exception_date=timezone.now().date())
-            # Check existing cluster is present in exception or not
-            for cluster in exception_date_data.clusters:
-                if self.cluster.id == cluster["id"]:
-                    msg = "{} is listed as exception date for this cluster. Hence not applying rule".format(
-                        str(timezone.now().date()))
-                    logger.error(msg)
-                    raise Exception("Rule execution on Cluster: {} is excluded for date: {}".format(
-                        self.cluster.name, timezone.now().date()))
-            return True
-        except ExceptionData.DoesNotExist:
-            pass
+        today = timezone.now().date()
+        if BlackoutCalendar().is_blacked_out(self.cluster.id, today):
+            logger.error(f"{today} is listed as exception date for this cluster. Hence not applying rule")
+            raise Exception("Rule execution on Cluster: {} is excluded for date: {}".format(self.cluster.name, today))
+        return True
 
     def apply_rule(self, attempt):
         # Check rule is Reverse Rule or not
@@ -175,87 +195,60 @@ class RuleHelper:
             self.__apply_rule(attempt)
 
     def __apply_rule(self, attempt):
-        db_instances = dict()
-        db_avg_load = dict()
-        db_successes = dict()
         all_good = False
         incomplete = False
         # If we're scaling up because of load, then that same load calculation should push all replicas to scale up, and don't have to check each one.
         forced_scaleup = False
+        primary_helper = None
         if self.action == SCALE_UP:
             try:
-                primary_helper = DbHelper(self.primary_dbs[0])
+                primary_helper = DbHelper(self.primary_db())
                 primary_helper.check_average_load(self.rule_json, self.any_conditions)
                 logger.info("Scaling up entire cluster because load is too high")
                 forced_scaleup = True
             except Exception:
                 logger.debug("Not enough load to scale up all replicas; checking each for replication lag and connection counts")
+            finally:
+                if primary_helper is not None:
+                    primary_helper.release_conn()
         try:
-            for db in self.secondary_dbs:
-                db_successes[db.id] = 0
-                helper = DbHelper(db)
-                logger.debug(f"Adding instance {db.instance_id} ({helper.instance.instanceType}) to secondaries")
-
-                if forced_scaleup:
-                    # Simulate a successful check of both lag and connection count, so that this node is added
-                    # regardless of if we're in ANY or ALL rule conditions
-                    db_successes[db.id] += 2
-                else:
-                    try:
-                        helper.check_replication_lag(self.rule_json, self.any_conditions)
-                        db_successes[db.id] += 1
-                    except Exception:
-                        if self.any_conditions:
-                            logger.debug(f"{db.instance_id} failed a replication lag check but we are using OR logic ({db_successes[db.id]} other successes)")
-                        else:
-                            logger.warn(f"skipping {db.instance_id} because it failed a replication lag check")
-                            next
-                    try:
-                        if self._is_cluster_managed:
-                            self.check_specific_connections(helper)
-                        else:
-                            helper.check_connections(self.rule_json, self.any_conditions)
-                        db_successes[db.id] += 1
-                    except Exception:
-                        if self.any_conditions:
-                            logger.debug(f"{db.instance_id} failed a connection count check but we are using OR logic ({db_successes[db.id]} other successes)")
-                        else:
-                            logger.warn(f"skipping {db.instance_id} because it failed an active connection count check")
-                            next
-                if (self.any_conditions and db_successes[db.id] > 0) or db_successes[db.id] == 2:
-                    db_instances[db.id] = helper
-                    db_avg_load[db.id] = helper.get_system_load_avg()
+            db_instances, db_avg_load, db_successes = self.probe_secondaries(forced_scaleup)
             if len(db_instances) == 0:
                 if self.any_conditions:
                     raise Exception("No secondaries passed replication or active connection count checks.")
                 else:
                     raise Exception("No secondaries passed replication and active connection count checks.")
 
-            logger.debug(f"Primary DB is {self.primary_dbs[0].instance_id}")
+            logger.debug(f"Primary DB is {self.primary_db().instance_id}")
             # Check cluster load
             if self._is_cluster_managed and self.cluster_mgmt.avg_load:
                 logger.debug(f"Dealing with managed cluster")
-                primary_helper = DbHelper(self.primary_dbs[0])
+                primary_helper = primary_helper or DbHelper(self.primary_db())
                 aggregated_avg_load = primary_helper.get_system_load_avg()
+                primary_helper.release_conn()
                 logger.info(f"Discovered primary to have load average of {aggregated_avg_load}")
 
                 changed_replicas = 0
-                for id, replica_avg_load in db_avg_load.items():
-                    logger.info(f"Working on {db_instances[id].instance.instanceId} with a load of {replica_avg_load} using aggregated primary load of {aggregated_avg_load}")
-                    actual_new_instance_type = self.new_instance_type
-                    if self.new_instance_role_types is not None:
-                        # We seem to think specific cluster roles should have instance sizes that aren't the default.
-                        # See if _this_ instance has such an exception, and, if so, use it.
-                        tags = db_instances[id].aws.get_tag_map(db_instances[id].instance)
-                        role = tags.get(settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME, None)
-                        logger.debug(f"Looking for exception instance size for role {role}")
-                        for item in self.new_instance_role_types:
-                            combo = item.split(':')
-                            if combo[0] == role:
-                                logger.debug(f"Rule says role {role} should have a type of {combo[1]} instead of {actual_new_instance_type}, so using that instead")
-                                actual_new_instance_type = combo[1]
-                                break
-                    try:
+                pending = list(db_avg_load.items())
+                wave_size = self.get_wave_size()
+                while pending:
+                    wave = list()
+                    while pending and len(wave) < wave_size:
+                        id, replica_avg_load = pending.pop(0)
+                        logger.info(f"Working on {db_instances[id].instance.instanceId} with a load of {replica_avg_load} using aggregated primary load of {aggregated_avg_load}")
+                        actual_new_instance_type = self.new_instance_type
+                        if self.new_instance_role_types is not None:
+                            # We seem to think specific cluster roles should have instance sizes that aren't the default.
+                            # See if _this_ instance has such an exception, and, if so, use it.
+                            tags = db_instances[id].aws.get_tag_map(db_instances[id].instance)
+                            role = tags.get(settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME, None)
+                            logger.debug(f"Looking for exception instance size for role {role}")
+                            for item in self.new_instance_role_types:
+                                combo = item.split(':')
+                                if combo[0] == role:
+                                    logger.debug(f"Rule says role {role} should have a type of {combo[1]} instead of {actual_new_instance_type}, so using that instead")
+                                    actual_new_instance_type = combo[1]
+                                    break
                         try:
                             db_instances[id].check_average_load(self.rule_json, self.any_conditions, aggregated_avg_load)
                             logger.info(f"combined load of {str(round(aggregated_avg_load + replica_avg_load,2))} compares auspiciously with a managed target load of {str(self.cluster_mgmt.avg_load)}")
@@ -265,64 +258,50 @@ class RuleHelper:
                                 logger.debug(f"Load check failed, but we are running in logical OR mode and have {db_successes[id]} other check successes. Continuing!")
                             else:
                                 logger.info(f"Not going to resize because combined load of {str(round(aggregated_avg_load + replica_avg_load,2))} compares poorly with a managed target load of {str(self.cluster_mgmt.avg_load)}")
-                                raise e
-
-                        # We are good to proceed.
-                        if self.action == SCALE_DOWN:
-                            # If we are going to downsize, update our DNS entries before we downsize,
-                            # so that we can get load off of our replica(s) before resizing.
-                            self.update_dns_entries(db_instances[id])
-                            self.run_pre_resize_script(db_instances[id].instance.instanceId)
-                            if db_instances[id].update_instance_type(actual_new_instance_type, self.rule.id, self.fallback_instances, self.cluster.name):
-                                aggregated_avg_load += replica_avg_load
-                            else:
-                                logger.warning(f"Instance {db_instances[id].instance.instanceId} couldn't resize for downscaling")
-                                incomplete = True
-
-                            # Because we're scaling down and have moved load off of this node,
-                            # we don't need to wait for the client's sake that streaming has resumed before continuing.
-                            # But for the post-streaming script, which might get used to re-enable monitoring,
-                            # we should wait to make sure the replication is working again before we run it.
-                            db_instances[id].wait_till_replica_streaming()
-                            self.run_post_streaming_script(db_instances[id].instance.instanceId)
-
-                        else:
-                            # If we are going to upsize, update our DNS entry after we upsize,
-                            # so that we can make sure the upsized instance is ready to rock before it
-                            # sees any new clients.
-                            self.run_pre_resize_script(db_instances[id].instance.instanceId)
-                            if db_instances[id].update_instance_type(actual_new_instance_type, self.rule.id, self.fallback_instances, None):
-                                # We need to make sure streaming has resumed before we say we are ready for clients
-                                db_instances[id].wait_till_replica_streaming()
-
-                                # Now that replication is working, we should be go to run the post-streaming script.
-                                self.run_post_streaming_script(db_instances[id].instance.instanceId)
-
-                                self.update_dns_entries(db_instances[id])
-                                aggregated_avg_load -= replica_avg_load
-                            else:
-                                logger.warning(f"Instance {db_instances[id].instance.instanceId} couldn't resize for upscaling")
-                                incomplete = True
-                                # Even though we couldn't upsize - and therefore will not be modifying dns - we should still
-                                # make sure streaming is back and mthe post-streaming script is run to get monitoring re-enabled
-                                db_instances[id].wait_till_replica_streaming()
-                                self.run_post_streaming_script(db_instances[id].instance.instanceId)
-
+                                logger.info(f"Not going to resize because {e}")
+                                continue
+
+                        # We are good to proceed. Assume the resize will work, so that the next replica
+                        # in this wave is judged against the load we expect the cluster to end up with.
+                        load_shift = replica_avg_load if self.action == SCALE_DOWN else -replica_avg_load
+                        aggregated_avg_load += load_shift
+                        wave.append((db_instances[id], actual_new_instance_type, load_shift))
+
+                    for (helper, new_instance_type, load_shift), resized, error in self.resize_wave(wave):
+                        if error is not None:
+                            logger.info(f"Not going to resize because {error}")
+                            aggregated_avg_load -= load_shift
+                            continue
+                        if not resized:
+                            incomplete = True
+                            aggregated_avg_load -= load_shift
                         changed_replicas += 1
-                    except Exception as e:
-                        logger.info(f"Not going to resize because {e}")
 
                 if changed_replicas == 0:
                     raise Exception("Failed to resize any replicas.")
             else:
-                logger.info(f"Managed cluster flag is {self._is_cluster_managed} and avg_load is {self.cluster_mgmt.avg_load}")
-                for id, helper in db_instances.items():
-                    helper.check_average_load(self.rule_json, self.any_conditions)
-                    helper.check_connections(self.rule_json, self.any_conditions)
-                    if helper.update_instance_type(self.new_instance_type, self.rule.id, self.fallback_instances, None):
-                        self.update_dns_entries(helper)
-                    else:
-                        logger.warning(f"Not updating DNS for {helper.instance.instanceId} because resize failed")
+                logger.info(f"Managed cluster flag is {self._is_cluster_managed} and avg_load is {getattr(self.cluster_mgmt, 'avg_load', None)}")
+                helpers = list(db_instances.values())
+                wave_size = self.get_wave_size()
+                for start in range(0, len(helpers), wave_size):
+                    wave = helpers[start:start + wave_size]
+                    for helper in wave:
+                        helper.check_average_load(self.rule_json, self.any_conditions)
+                        helper.check_connections(self.rule_json, self.any_conditions)
+                    record_instance_type = len(wave) == 1
+                    resizes = run_concurrently(lambda helper: helper.update_instance_type(self.new_instance_type, self.rule.id, self.fallback_instances, None, record_instance_type),
+                                               wave, len(wave))
+                    resized_helpers = list()
+                    for helper, resized, error in resizes:
+                        if error is not None:
+                            raise error
+                        if resized:
+                            resized_helpers.append(helper)
+                        else:
+                            logger.warning(f"Not updating DNS for {helper.instance.instanceId} because resize failed")
+                    for error in self.update_all_dns_entries(resized_helpers):
+                        if error is not None:
+                            raise error
             if incomplete:
                 raise Exception("Failed to resize all instances")
             else:
@@ -334,6 +313,181 @@ class RuleHelper:
             if not all_good:
                 CronUtil.set_retry_cron(self.rule, attempt)
 
+    def probe_secondaries(self, forced_scaleup=False):
+        """
+        Check every secondary of the cluster, using up to RULE_PROBE_MAX_WORKERS
+        concurrent probes, and return the replicas that passed along with their
+        load averages and check success counts, in secondary order.
+        """
+        db_instances = dict()
+        db_avg_load = dict()
+        db_successes = dict()
+        helpers = list()
+        for db in self.secondary_dbs:
+            helper = DbHelper(db)
+            logger.debug(f"Adding instance {db.instance_id} ({helper.instance.instanceType}) to secondaries")
+            helpers.append(helper)
+
+        started = time.monotonic()
+        probes = run_concurrently(lambda helper: self.probe_replica(helper, forced_scaleup), helpers,
+                                  settings.RULE_PROBE_MAX_WORKERS)
+        logger.info(f"Probed {len(helpers)} secondaries in {time.monotonic() - started:.3f}s")
+        # Hand the probe connections back to the pool; resizing can take a long time
+        # and anything that needs a connection afterwards will check one out again.
+        for helper in helpers:
+            helper.release_conn()
+
+        for helper, result, error in probes:
+            if error is not None:
+                raise error
+            successes, avg_load = result
+            db_successes[helper.db_info.id] = successes
+            if avg_load is not None:
+                db_instances[helper.db_info.id] = helper
+                db_avg_load[helper.db_info.id] = avg_load
+        return db_instances, db_avg_load, db_successes
+
+    def probe_replica(self, helper, forced_scaleup=False):
+        """
+        Run the replication lag and connection count checks against one replica,
+        and if it passes, fetch its load average.
+        Returns (successes, avg_load), where avg_load is None if the replica didn't pass.
+        """
+        db = helper.db_info
+        successes = 0
+        timings = dict()
+        started = time.monotonic()
+        if forced_scaleup:
+            # Simulate a successful check of both lag and connection count, so that this node is added
+            # regardless of if we're in ANY or ALL rule conditions
+            successes += 2
+        else:
+            step = time.monotonic()
+            # One round trip for every metric the checks below look at
+            users = self.cluster_mgmt.check_active_users if self._is_cluster_managed else None
+            try:
+                helper.get_snapshot(users or None)
+            except Exception as e:
+                logger.warn(f"Could not take a metric snapshot of {db.instance_id}: {e}")
+            timings["snapshot"] = time.monotonic() - step
+            step = time.monotonic()
+            try:
+                helper.check_replication_lag(self.rule_json, self.any_conditions)
+                successes += 1
+            except Exception:
+                if self.any_conditions:
+                    logger.debug(f"{db.instance_id} failed a replication lag check but we are using OR logic ({successes} other successes)")
+                else:
+                    logger.warn(f"skipping {db.instance_id} because it failed a replication lag check")
+            timings["lag"] = time.monotonic() - step
+            step = time.monotonic()
+            try:
+                if self._is_cluster_managed:
+                    self.check_specific_connections(helper)
+                else:
+                    helper.check_connections(self.rule_json, self.any_conditions)
+                successes += 1
+            except Exception:
+                if self.any_conditions:
+                    logger.debug(f"{db.instance_id} failed a connection count check but we are using OR logic ({successes} other successes)")
+                else:
+                    logger.warn(f"skipping {db.instance_id} because it failed an active connection count check")
+            timings["connections"] = time.monotonic() - step
+
+        avg_load = None
+        if (self.any_conditions and successes > 0) or successes == 2:
+            step = time.monotonic()
+            avg_load = helper.get_system_load_avg()
+            timings["load"] = time.monotonic() - step
+        timing_details = ", ".join(f"{name} {elapsed:.3f}s" for name, elapsed in timings.items())
+        logger.info(f"Probe of {db.instance_id} took {time.monotonic() - started:.3f}s ({timing_details or 'no checks'})")
+        return successes, avg_load
+
+    def get_wave_size(self):
+        """
+        How many replicas we may resize at the same time. This is the cluster's
+        max_parallel_resizes, but never so many that fewer than min_in_service_replicas
+        secondaries would be left serving clients.
+        """
+        if not self.cluster_mgmt:
+            return 1
+        max_parallel_resizes = max(1, self.cluster_mgmt.max_parallel_resizes or 1)
+        min_in_service = self.cluster_mgmt.min_in_service_replicas or 0
+        can_be_out_of_service = self.secondary_dbs.count() - min_in_service
+        if can_be_out_of_service < 1:
+            raise Exception(f"Resizing any replica would leave fewer than {min_in_service} replicas in service")
+        return min(max_parallel_resizes, can_be_out_of_service)
+
+    def resize_wave(self, wave):
+        """
+        Resize a wave of (helper, instance_type, extra) replicas at the same time.
+
+        Each replica still goes through its own steps in order: when scaling down, its
+        DNS is moved away before it is touched; when scaling up, its DNS is only moved
+        back once it is streaming again and the post-streaming hook has run. The DNS changes
+        of the wave are made together, see update_all_dns_entries.
+        Returns a list of (item, resized, error) tuples in wave order.
+        """
+        outcome = dict()
+        if self.action == SCALE_DOWN:
+            # If we are going to downsize, update our DNS entries before we downsize,
+            # so that we can get load off of our replica(s) before resizing.
+            ready = list()
+            for item, error in zip(wave, self.update_all_dns_entries([item[0] for item in wave])):
+                if error is not None:
+                    outcome[item[0].db_info.id] = (False, error)
+                else:
+                    ready.append(item)
+        else:
+            ready = list(wave)
+
+        # Only the thread holding the rule's row locks may record new instance sizes;
+        # when resizing several replicas at once, leave that to the next sync.
+        record_instance_type = len(ready) == 1
+        resizes = run_concurrently(lambda item: self.resize_replica(item[0], item[1], record_instance_type), ready, len(ready))
+
+        # Whether or not the resize worked, the post-streaming script (which might get used to re-enable
+        # monitoring) should only run once replication is working again. When scaling up we also need
+        # streaming to have resumed before we say we are ready for clients.
+        # The whole wave is waited for at once, from this thread.
+        finished = [item[0] for item, resized, error in resizes if error is None]
+        streaming = dict((helper.db_info.id, error) for helper, error in zip(finished, DbHelper.wait_till_all_streaming(finished)))
+        hooks = run_concurrently(lambda helper: self.run_post_streaming_script(helper.instance.instanceId),
+                                 [helper for helper in finished if streaming[helper.db_info.id] is None], len(finished))
+        for helper, result, error in hooks:
+            streaming[helper.db_info.id] = error
+
+        for (helper, instance_type, extra), resized, error in resizes:
+            outcome[helper.db_info.id] = (resized, error if error is not None else streaming[helper.db_info.id])
+
+        if self.action == SCALE_UP:
+            # If we are going to upsize, update our DNS entries after we upsize,
+            # so that we can make sure the upsized instances are ready to rock before they
+            # see any new clients.
+            upsized = [helper for (helper, instance_type, extra), resized, error in resizes
+                       if resized and outcome[helper.db_info.id][1] is None]
+            for helper, error in zip(upsized, self.update_all_dns_entries(upsized)):
+                outcome[helper.db_info.id] = (True, error)
+
+        return [(item, ) + outcome[item[0].db_info.id] for item in wave]
+
+    def resize_replica(self, helper, instance_type, record_instance_type=True):
+        """
+        Resize a single replica after running the pre-resize hook. Waiting for it to stream
+        again and the post-streaming hook are left to resize_wave.
+        """
+        instance_id = helper.instance.instanceId
+        self.run_pre_resize_script(instance_id)
+        if self.action == SCALE_DOWN:
+            resized = helper.update_instance_type(instance_type, self.rule.id, self.fallback_instances, self.cluster.name, record_instance_type)
+            if not resized:
+                logger.warning(f"Instance {instance_id} couldn't resize for downscaling")
+        else:
+            resized = helper.update_instance_type(instance_type, self.rule.id, self.fallback_instances, None, record_instance_type)
+            if not resized:
+                logger.warning(f"Instance {instance_id} couldn't resize for upscaling")
+        return resized
+
     def reverse_rule(self, attempt):
         try:
             for db in self.secondary_dbs:
@@ -357,53 +511,113 @@ class RuleHelper:
             return not self.any_conditions
         return True
 
-    def update_dns_entries(self, helper):
+    def get_dns_change(self, helper, wait=True):
+        """
+        (dns name, zone name, target address, replica address) of the DNS change for this replica, or None if it has no DNS entry.
+        When scaling up, this waits for the replica to catch up first, unless wait is False because that's been done already.
+        """
         logger.info(f"updating dns entries for {self.action} of {helper.instance.instanceId}")
-
-        dns_entry = None
-        # See if there are any DNS entries for this node specifically
-        try:
-            logger.debug(f"Looking for instance match of instance {helper.instance.instanceId}")
-            dns_entry = DNSData.objects.get(match_type='MATCH_INSTANCE', instance=Ec2DbInfo.objects.get(instance_id=helper.instance.instanceId))
-            logger.debug(f"Found dns match of {dns_entry.dns_name}")
-        except ObjectDoesNotExist:
-            logger.debug(f"{helper.instance.instanceId} does not have an instance match dns entry")
-        except Exception as e:
-            logger.warn(f"{helper.instance.instanceId} found exception when looking for instance match dns entry: {e}")
-
-        if dns_entry is None:
-            # If we don't have an instance match for this instance, maybe we have a role match?
-            tags = helper.aws.get_tag_map(helper.instance)
-            role = tags.get(settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME, None)
-            if role:
-                logger.debug(f"{helper.instance.instanceId} has role tag {settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME}={role}; looking for role match in cluster {self.cluster.id}")
-                try:
-                    dns_entry = DNSData.objects.get(match_type='MATCH_ROLE', cluster=self.cluster, tag_role=role)
-                    logger.debug(f"Found dns match of {dns_entry.dns_name}")
-                except ObjectDoesNotExist:
-                    logger.debug(f"{helper.instance.instanceId} does not have an role match dns entry")
-            else:
-                logger.debug(f"{helper.instance.instanceId} does not have a {settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME} tag for role matching")
-
+        dns_entry = self.dns_resolver.resolve(helper)
         if dns_entry is None:
             logger.warn(f"not updating dns because {helper.db_info.id} has no dns_entry attribute")
+            return None
+        if self.action == SCALE_DOWN:
+            dns_address = self.get_primary_address()
         else:
-            dns_name = dns_entry.dns_name
-            zone_name = dns_entry.hosted_zone_name
-            if self.action == SCALE_DOWN:
-                dns_address = self.get_primary_address()
-            else:
-                dns_address = helper.get_endpoint_address()
-            self.run_dns_script(dns_name, zone_name, dns_address, helper.get_endpoint_address())
-
+            if wait:
+                self.wait_till_caught_up(helper)
+            dns_address = helper.get_endpoint_address()
+        return dns_entry.dns_name, dns_entry.hosted_zone_name, dns_address, helper.get_endpoint_address()
+
+    def update_dns_entries(self, helper, wait=True):
+        change = self.get_dns_change(helper, wait)
+        if change is not None:
+            self.run_dns_script(*change)
         return None
 
+    def update_all_dns_entries(self, helpers):
+        """
+        Update the DNS of several replicas, returning the error (or None) of each.
+        When scaling up, the replicas with a DNS entry to move wait to catch up together, and only
+        those that did are put back into DNS.
+        With DNS_UPDATER set to route53 the changes are made in one batch per hosted zone; otherwise
+        the dns-change hook runs for each replica in turn.
+        """
+        errors = dict()
+        if self.action != SCALE_DOWN:
+            waiting = list()
+            for helper in helpers:
+                try:
+                    if self.dns_resolver.resolve(helper) is not None:
+                        waiting.append(helper)
+                except Exception as e:
+                    errors[helper.db_info.id] = e
+            for helper, error in zip(waiting, self.wait_till_all_caught_up(waiting)):
+                if error is not None:
+                    logger.error(f"Not updating DNS for {helper.instance.instanceId} because it didn't catch up: {error}")
+                    errors[helper.db_info.id] = error
+        ready = [helper for helper in helpers if helper.db_info.id not in errors]
+
+        if settings.DNS_UPDATER != "route53":
+            for helper in ready:
+                try:
+                    self.update_dns_entries(helper, wait=False)
+                except Exception as e:
+                    errors[helper.db_info.id] = e
+            return [errors.get(helper.db_info.id) for helper in helpers]
+
+        batch = Route53Batch(f"Pygmy {self.action} for #Rule {self.rule.id}")
+        batched = list()
+        for helper in ready:
+            try:
+                change = self.get_dns_change(helper, wait=False)
+            except Exception as e:
+                errors[helper.db_info.id] = e
+                continue
+            if change is not None:
+                dns_name, zone_name, target_address, replica_address = change
+                logger.info(f"Changing DNS instance {dns_name} ({replica_address}) to point at {target_address}")
+                batch.add(zone_name, dns_name, "A" if self.cluster_type == EC2 else "CNAME", target_address)
+                batched.append(helper)
+        if batched:
+            for helper, error in zip(batched, batch.submit()):
+                errors[helper.db_info.id] = Exception(f"DNS change failed: {error}") if error is not None else None
+        return [errors.get(helper.db_info.id) for helper in helpers]
+
+    def wait_till_caught_up(self, helper):
+        """
+        Wait until a replica has replayed to within REPLICA_CATCHUP_MAX_LAG_BYTES of the primary
+        """
+        error = self.wait_till_all_caught_up([helper])[0]
+        if error is not None:
+            raise error
+
+    def wait_till_all_caught_up(self, helpers):
+        """
+        Wait for several replicas at once from this thread, each until it has replayed to within
+        REPLICA_CATCHUP_MAX_LAG_BYTES of the primary. Returns an exception per helper, None for those that caught up.
+        """
+        if not helpers or settings.REPLICA_CATCHUP_MAX_LAG_BYTES is None or self.primary_db() is None:
+            return [None] * len(helpers)
+        # The checks run on different threads, so every replica gets its own connection to the primary
+        trackers = [CatchupTracker(DbHelper(self.primary_db()), helper) for helper in helpers]
+        try:
+            results = wait_all([(Waiter(f"{tracker.replica.instance.instanceId} to catch up", timeout=settings.REPLICA_CATCHUP_TIMEOUT),
+                                 lambda tracker=tracker: tracker.is_caught_up(settings.REPLICA_CATCHUP_MAX_LAG_BYTES))
+                                for tracker in trackers], settings.RULE_PROBE_MAX_WORKERS)
+        finally:
+            for tracker in trackers:
+                tracker.primary.release_conn()
+                tracker.replica.release_conn()
+        return [error for result, error in results]
+
     def get_primary_address(self):
-        if self.primary_dbs.count() > 0:
-            helper = DbHelper(self.primary_dbs[0])
-            return helper.get_endpoint_address()
-        else:
-            logger.error("No primary db present for cluster {}".format(self.cluster.name))
+        if self._primary_address is None:
+            if self.primary_db() is not None:
+                self._primary_address = DbHelper(self.primary_db()).get_endpoint_address()
+            else:
+                logger.error("No primary db present for cluster {}".format(self.cluster.name))
+        return self._primary_address
 
     def run_dns_script(self, dns_name, zone_name, target_address, replica_address):
         """
@@ -417,91 +631,43 @@ class RuleHelper:
         else:
             RECORD_TYPE = "CNAME"
 
-        script_path = os.path.join(settings.BASE_DIR, "scripts", "dns-change.sh")
-
-        try:
-            DB_CRED = DbCredentials.objects.get(description="AWS Secrets")
-            env_var = dict({
-                "AWS_ACCESS_KEY_ID": DB_CRED.user_name,
-                "AWS_SECRET_ACCESS_KEY": DB_CRED.password
-            })
-        except Exception:
-            env_var = dict()
+        env_var = CredentialsProvider().aws_env()
 
         try:
             logger.info(f"Changing DNS instance {dns_name} ({replica_address}) to point at {target_address}")
-            test = subprocess.check_output([script_path, self.action, zone_name, dns_name, target_address, RECORD_TYPE, replica_address], env=env_var)
+            test = HookRunner().run(DNS_CHANGE, [self.action, zone_name, dns_name, target_address, RECORD_TYPE, replica_address], env=env_var)
             if len(test) > 0:
-                logger.info(f"running {script_path} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} succeeded with non-empty result of {test}")
-            else:
-                logger.debug(f"running {script_path} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} succeeded")
-        except subprocess.CalledProcessError as e:
-            logger.info(f"running {script_path} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} returned: {e.returncode} ({e.output})")
-            raise Exception("DNS change failed")
-        except Exception as e:
-            if hasattr(e, 'message'):
-                message = e.message
+                logger.info(f"running {DNS_CHANGE} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} succeeded with non-empty result of {test}")
             else:
-                message = e
-            logger.info(f"running {script_path} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} returned generic error: {message}")
+                logger.debug(f"running {DNS_CHANGE} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} succeeded")
+        except HookError as e:
+            logger.info(f"running {DNS_CHANGE} {self.action} {zone_name} {dns_name} {target_address} {RECORD_TYPE} {replica_address} returned: {e.returncode} ({e.output}): {e}")
             raise Exception("DNS change failed")
 
     def run_pre_resize_script(self, instance_id):
-        script_path = os.path.join(settings.BASE_DIR, "scripts", "pre-resize.sh")
-
-        try:
-            DB_CRED = DbCredentials.objects.get(description="AWS Secrets")
-            env_var = dict({
-                "AWS_ACCESS_KEY_ID": DB_CRED.user_name,
-                "AWS_SECRET_ACCESS_KEY": DB_CRED.password
-            })
-        except Exception:
-            env_var = dict()
+        env_var = CredentialsProvider().aws_env()
 
         try:
             logger.info(f"Running pre-resize hook for {instance_id}")
-            test = subprocess.check_output([script_path, instance_id], env=env_var)
+            test = HookRunner().run(PRE_RESIZE, [instance_id], env=env_var)
             if len(test) > 0:
-                logger.debug(f"running {script_path} {instance_id} succeeded with non-empty result of {test}")
+                logger.debug(f"running {PRE_RESIZE} {instance_id} succeeded with non-empty result of {test}")
             else:
-                logger.debug(f"running {script_path} {instance_id} succeeded")
-        except subprocess.CalledProcessError as e:
-            logger.warn(f"running {script_path} {instance_id} returned: {e.returncode} ({e.output})")
-            raise e
-        except Exception as e:
-            if hasattr(e, 'message'):
-                message = e.message
-            else:
-                message = e
-            logger.warn(f"running {script_path} {instance_id} returned generic error: {message}")
+                logger.debug(f"running {PRE_RESIZE} {instance_id} succeeded")
+        except HookError as e:
+            logger.warn(f"running {PRE_RESIZE} {instance_id} returned: {e.returncode} ({e.output}): {e}")
             raise e
 
     def run_post_streaming_script(self, instance_id):
-        script_path = os.path.join(settings.BASE_DIR, "scripts", "post-streaming.sh")
-
-        try:
-            DB_CRED = DbCredentials.objects.get(description="AWS Secrets")
-            env_var = dict({
-                "AWS_ACCESS_KEY_ID": DB_CRED.user_name,
-                "AWS_SECRET_ACCESS_KEY": DB_CRED.password
-            })
-        except Exception:
-            env_var = dict()
+        env_var = CredentialsProvider().aws_env()
 
         try:
             logger.info(f"Running post-streaming hook for {instance_id}")
-            test = subprocess.check_output([script_path, instance_id], env=env_var)
+            test = HookRunner().run(POST_STREAMING, [instance_id], env=env_var)
             if len(test) > 0:
-                logger.info(f"running {script_path} {instance_id} succeeded with non-empty result of {test}")
-            else:
-                logger.debug(f"running {script_path} {instance_id} succeeded")
-        except subprocess.CalledProcessError as e:
-            logger.warn(f"running {script_path} {instance_id} returned: {e.returncode} ({e.output})")
-            raise e
-        except Exception as e:
-            if hasattr(e, 'message'):
-                message = e.message
+                logger.info(f"running {POST_STREAMING} {instance_id} succeeded with non-empty result of {test}")
             else:
-                message = e
-            logger.warn(f"running {script_path} {instance_id} returned generic error: {message}")
+                logger.debug(f"running {POST_STREAMING} {instance_id} succeeded")
+        except HookError as e:
+            logger.warn(f"running {POST_STREAMING} {instance_id} returned: {e.returncode} ({e.output}): {e}")
             raise e
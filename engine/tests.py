@@ -1,18 +1,59 @@
-from unittest.mock import patch
-from django.test import TestCase
+import boto3
+import json
+import psycopg2
+import logging
+import os
+import sys
+import tempfile
+import threading
+from unittest.mock import patch, MagicMock
+from crontab import CronTab
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.conf import settings
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
-from moto import mock_ec2, mock_rds
+from datetime import datetime, timedelta
+from io import StringIO
+from moto import mock_ec2, mock_rds, mock_route53, mock_sts
 from engine.aws.ec_wrapper import EC2Service
 from engine.aws.rds_wrapper import RDSService
+from engine.aws.aws_services import AWSServices
+from engine.aws.events import InventoryEvents
+from engine.aws.route53 import Route53Batch
 from engine.models import AllEc2InstanceTypes, AllEc2InstancesData, RdsInstances, AllRdsInstanceTypes, ExceptionData, \
-    ClusterInfo
-from engine.postgres_wrapper import PostgresData
+    ClusterInfo, Ec2DbInfo, NodeMetricSample, SCALE_UP, SCALE_DOWN, Rules, ActionLogs, DbCredentials, DNSData, \
+    Blackout
+from engine.postgres_wrapper import PostgresData, PostgresConnectionPool, NodeSnapshot
+from engine.blackouts import BlackoutCalendar, parse_dates
+from engine.concurrency import run_concurrently
+from engine.instance_catalog import InstanceTypeCatalog
+from engine.credentials import CredentialsProvider
+from engine.hooks import HookRunner, HookError
+from engine.utils import CryptoUtil
+from engine.waiter import Waiter, WaitTimeout, wait_all
 from engine.rules.rules_helper import RuleHelper
+from engine.rules.db_helper import DbHelper
+from engine.rules.metrics_helper import MetricsHelper
+from engine.rules.catchup_tracker import CatchupTracker
+from engine.rules.dns_resolver import DNSResolver
+from pygmy.db_logger import DBHandler
+from pygmy.models import Log
 from pygmy.mock_data import MockData, MockRdsData, MockEc2Data, MockPostgresData, MockRuleData
 from engine.management.commands.populate_settings_data import Command
+from engine.management.commands.run_scheduler import Command as SchedulerCommand
+from engine.rules.cronutils import CronUtil
 from webapp.view.exceptions import ExceptionUtils
+from webapp.models import Settings, AWS_REGION
 
 
+# Discovery probes nodes on worker threads, but the mocked probes read the test's uncommitted rows,
+# so classes that run discovery probe in the test's own thread
+@override_settings(TOPOLOGY_PROBE_MAX_WORKERS=1)
 class AllEc2InstanceTypesTest(TestCase):
     mock_ec2 = mock_ec2()
     mock_rds = mock_rds()
@@ -24,7 +65,8 @@ class AllEc2InstanceTypesTest(TestCase):
 
         with patch.object(PostgresData, "__init__", new=MockPostgresData.define_value),\
              patch.object(PostgresData, "is_ec2_postgres_instance_primary", new=MockPostgresData.is_ec2_postgres_instance_primary),\
-             patch.object(PostgresData, "get_all_slave_servers", new=MockPostgresData.get_all_slave_servers):
+             patch.object(PostgresData, "get_all_slave_servers", new=MockPostgresData.get_all_slave_servers),\
+             patch.object(PostgresData, "close", new=MockPostgresData.close):
             Command.populate_settings(headless=True)
             MockEc2Data.create_ec2_instances()
             EC2Service().get_instances()
@@ -160,18 +202,13 @@ class AllEc2InstanceTypesTest(TestCase):
         rule = MockRuleData.create_ec2_scale_down_rule()
         rule_db = RuleHelper.add_rule_db(rule)
 
-        exc, created = ExceptionData.objects.get_or_create(exception_date=timezone.now().date())
-        exc.clusters = [{"value": rule_db.cluster.name, "id": rule_db.cluster.id}]
-        exc.save()
+        BlackoutCalendar().add([timezone.now().date()], [{"value": rule_db.cluster.name, "id": rule_db.cluster.id}])
 
-        try:
+        with self.assertRaises(Exception):
             RuleHelper.from_id(rule_db.id).check_exception_date()
-            self.assertTrue(False)
-        except Exception as e:
-            self.assertTrue(True)
 
     @patch.object(PostgresData, "__init__", new=MockPostgresData.define_value)
-    @patch.object(PostgresData, "get_system_load_avg", new=MockPostgresData.get_system_load_avg_20)
+    @patch.object(PostgresData, "get_node_snapshot", new=MockPostgresData.get_node_snapshot_20)
     @patch("engine.rules.cronutils.CronUtil.create_cron")
     def test_scale_down_with_minimum_load_avg(self, create_cron):
         """
@@ -188,7 +225,7 @@ class AllEc2InstanceTypesTest(TestCase):
             self.assertTrue(False)
 
     @patch.object(PostgresData, "__init__", new=MockPostgresData.define_value)
-    @patch.object(PostgresData, "get_system_load_avg", new=MockPostgresData.get_system_load_avg_40)
+    @patch.object(PostgresData, "get_node_snapshot", new=MockPostgresData.get_node_snapshot_40)
     @patch("engine.rules.cronutils.CronUtil.create_cron")
     @patch("engine.rules.cronutils.CronUtil.set_retry_cron")
     def test_scale_down_negative_load_avg(self, set_retry_cron, create_cron):
@@ -261,3 +298,1223 @@ class AllEc2InstanceTypesTest(TestCase):
             self.assertTrue(False)
         except ExceptionData.DoesNotExist:
             self.assertTrue(True)
+
+
+class RunConcurrentlyTest(SimpleTestCase):
+
+    def test_results_keep_item_order(self):
+        """
+        Results come back in the order items were given,
+        whether run inline or on a pool
+        """
+        for workers in [1, 4]:
+            results = run_concurrently(lambda x: x * 2, [3, 1, 2], workers)
+            self.assertEqual([(3, 6, None), (1, 2, None), (2, 4, None)], results)
+
+    def test_errors_are_isolated(self):
+        """
+        One failing item doesn't stop the others
+        """
+        def work(x):
+            if x == 2:
+                raise ValueError("bad item")
+            return x
+
+        results = run_concurrently(work, [1, 2, 3], 3)
+        self.assertEqual(1, results[0][1])
+        self.assertIsInstance(results[1][2], ValueError)
+        self.assertEqual(3, results[2][1])
+
+
+class WaiterTest(SimpleTestCase):
+
+    def test_delays_back_off_up_to_the_maximum(self):
+        waiter = Waiter("nothing", initial=1, maximum=5, jitter=0)
+        delays = waiter.delays()
+        self.assertEqual([1, 2, 4, 5, 5], [next(delays) for _ in range(5)])
+        jittered = Waiter("nothing", initial=4, maximum=4, jitter=0.5).delays()
+        for _ in range(20):
+            self.assertTrue(2 <= next(jittered) <= 4)
+
+    def test_wait_retries_misses_and_errors(self):
+        answers = iter([False, Exception("not yet"), None, "ready"])
+
+        def check():
+            answer = next(answers)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+
+        with patch("engine.waiter.time.sleep") as sleep:
+            self.assertEqual("ready", Waiter("answers", initial=1, maximum=2, jitter=0).wait(check))
+        self.assertEqual([1, 2, 2], [call.args[0] for call in sleep.call_args_list])
+
+    def test_wait_gives_up_at_the_deadline(self):
+        with self.assertRaises(WaitTimeout):
+            Waiter("never", timeout=0.05, initial=0.01, maximum=0.02).wait(lambda: False)
+
+    def test_waits_share_one_thread(self):
+        polls = dict(a=0, b=0)
+
+        async def check_a():
+            polls["a"] += 1
+            return polls["a"] >= 3
+
+        def check_b():
+            polls["b"] += 1
+            return polls["b"] >= 2 and "b"
+
+        def never():
+            return False
+
+        results = wait_all([(Waiter("a", initial=0.01, maximum=0.01), check_a),
+                            (Waiter("b", initial=0.01, maximum=0.01), check_b),
+                            (Waiter("never", timeout=0.05, initial=0.01, maximum=0.01), never)], 2)
+        self.assertEqual((True, None), results[0])
+        self.assertEqual(("b", None), results[1])
+        self.assertIsInstance(results[2][1], WaitTimeout)
+
+    def test_wait_only_retries_expected_errors(self):
+        def check():
+            raise TypeError("bug")
+
+        with patch("engine.waiter.time.sleep") as sleep, self.assertRaises(TypeError):
+            Waiter("bug", timeout=60, retry_on=ValueError).wait(check)
+        sleep.assert_not_called()
+        results = wait_all([(Waiter("bug", timeout=60, retry_on=()), check)], 1)
+        self.assertIsInstance(results[0][1], TypeError)
+
+
+class ReplicaStreamingTest(SimpleTestCase):
+
+    @staticmethod
+    def make_helper(service):
+        helper = DbHelper.__new__(DbHelper)
+        helper.db_info = MagicMock()
+        helper.aws = service.__new__(service)
+        helper.instance = helper.db_info.instance_object
+        return helper
+
+    def test_rds_replica_waits_until_streaming(self):
+        """
+        An RDS replica that refuses connections at first is waited for, reconnecting after every failed look
+        """
+        helper = self.make_helper(RDSService)
+        replica = MagicMock()
+        replica.get_streaming_status.side_effect = [False, True]
+        with patch.object(CredentialsProvider, "get", return_value=MagicMock(password="rds-secret")), \
+             patch("engine.aws.rds_wrapper.PostgresData", side_effect=[psycopg2.OperationalError("starting up"), replica]) as connect, \
+             patch("engine.waiter.time.sleep"):
+            helper.wait_till_replica_streaming()
+        self.assertEqual(2, connect.call_count)
+        self.assertTrue(all(call.kwargs["expect_errors"] for call in connect.call_args_list))
+        replica.close.assert_called_once()
+
+    def test_unexpected_errors_fail_the_wait(self):
+        """
+        Only the replica not being up yet is retried; a bug fails the wait right away for RDS and EC2 alike
+        """
+        for service in [RDSService, EC2Service]:
+            helper = self.make_helper(service)
+            with patch.object(CredentialsProvider, "get", return_value=MagicMock(password="secret")), \
+                 patch.object(service, "create_connection", side_effect=TypeError("bug")), \
+                 patch("engine.waiter.time.sleep") as sleep, self.assertRaises(TypeError):
+                helper.wait_till_replica_streaming()
+            sleep.assert_not_called()
+
+
+class CatchupTrackerTest(SimpleTestCase):
+
+    @staticmethod
+    def make_helper(positions):
+        helper = MagicMock()
+        helper.db_conn.return_value.get_wal_position.side_effect = positions
+        return helper
+
+    def test_lag_rate_and_eta(self):
+        # The primary writes 100 B/s and the replica applies 600 B/s
+        primary = self.make_helper([10000, 11000, 12000])
+        replica = self.make_helper([1000, 7000, 12000])
+        tracker = CatchupTracker(primary, replica, window=60)
+        with patch("engine.rules.catchup_tracker.time.monotonic", side_effect=[0, 10, 20]):
+            self.assertEqual(9000, tracker.sample())
+            self.assertIsNone(tracker.eta())
+            self.assertFalse(tracker.is_caught_up(1000))
+            self.assertEqual((600, 100), tracker.rates())
+            self.assertEqual(4000 / 500, tracker.eta())
+            self.assertTrue(tracker.is_caught_up(1000))
+        self.assertEqual(0, tracker.eta())
+
+    def test_old_samples_leave_the_window(self):
+        primary = self.make_helper([0, 100, 200, 300])
+        replica = self.make_helper([0, 0, 0, 0])
+        tracker = CatchupTracker(primary, replica, window=15)
+        with patch("engine.rules.catchup_tracker.time.monotonic", side_effect=[0, 10, 20, 30]):
+            for _ in range(4):
+                tracker.sample()
+        self.assertEqual([10, 20, 30], [sample[0] for sample in tracker.samples])
+        self.assertEqual((0, 10), tracker.rates())
+        # The replica is falling behind, so it has no ETA
+        self.assertIsNone(tracker.eta())
+
+    def test_failed_samples_drop_connections(self):
+        primary = self.make_helper([Exception("gone")])
+        replica = self.make_helper([100])
+        with self.assertRaises(Exception):
+            CatchupTracker(primary, replica).sample()
+        primary.release_conn.assert_called_once_with()
+        replica.release_conn.assert_called_once_with()
+
+
+class ResizeWaveTest(SimpleTestCase):
+
+    @staticmethod
+    def make_helper(secondaries, max_parallel_resizes, min_in_service_replicas):
+        helper = RuleHelper.__new__(RuleHelper)
+        helper.secondary_dbs = MagicMock()
+        helper.secondary_dbs.count.return_value = secondaries
+        helper.cluster_mgmt = MagicMock(max_parallel_resizes=max_parallel_resizes,
+                                        min_in_service_replicas=min_in_service_replicas)
+        helper.dns_resolver = MagicMock()
+        return helper
+
+    def test_wave_size_is_capped_by_in_service_minimum(self):
+        """
+        Never take so many replicas out that fewer than the minimum keep serving
+        """
+        self.assertEqual(4, self.make_helper(12, 4, 2).get_wave_size())
+        self.assertEqual(2, self.make_helper(4, 4, 2).get_wave_size())
+        self.assertEqual(1, self.make_helper(4, 1, 0).get_wave_size())
+
+    def test_wave_size_refuses_to_empty_cluster(self):
+        """
+        If no replica can be spared, refuse to resize at all
+        """
+        with self.assertRaises(Exception):
+            self.make_helper(2, 2, 2).get_wave_size()
+
+    def test_wave_waits_for_streaming_together(self):
+        """
+        Replicas are only put back into DNS once they stream, and a replica that never does fails on its own
+        """
+        helper = self.make_helper(4, 2, 0)
+        helper.action = SCALE_UP
+        fast, slow = MagicMock(), MagicMock()
+        fast.db_info.id, slow.db_info.id = 1, 2
+        wave = [(fast, "r5.large", 0), (slow, "r5.large", 0)]
+        with patch.object(RuleHelper, "resize_replica", return_value=True), \
+             patch.object(RuleHelper, "run_post_streaming_script") as post_streaming, \
+             patch.object(RuleHelper, "update_dns_entries") as update_dns_entries, \
+             patch.object(RuleHelper, "wait_till_all_caught_up", side_effect=lambda helpers: [None] * len(helpers)), \
+             patch.object(DbHelper, "wait_till_all_streaming", return_value=[None, WaitTimeout("slow")]) as wait:
+            results = helper.resize_wave(wave)
+        wait.assert_called_once_with([fast, slow])
+        post_streaming.assert_called_once_with(fast.instance.instanceId)
+        update_dns_entries.assert_called_once_with(fast, wait=False)
+        self.assertEqual((True, None), results[0][1:])
+        self.assertIsInstance(results[1][2], WaitTimeout)
+
+    @override_settings(REPLICA_CATCHUP_MAX_LAG_BYTES=0, REPLICA_CATCHUP_TIMEOUT=0.3, WAIT_BACKOFF_INITIAL=0.05, WAIT_BACKOFF_MAX=0.05)
+    def test_wave_catches_up_together(self):
+        """
+        The replicas of a wave wait to catch up at the same time, and only those that did go back into DNS
+        """
+        helper = self.make_helper(4, 3, 0)
+        helper.action = SCALE_UP
+        helper.primary_db = MagicMock()
+        replicas = [MagicMock() for n in range(3)]
+        for n, (replica, replayed) in enumerate(zip(replicas, [100, 0, 100])):
+            replica.db_info.id = n
+            replica.db_conn.return_value.get_wal_position.return_value = replayed
+        with patch("engine.rules.rules_helper.DbHelper") as primary, \
+             patch("engine.rules.rules_helper.wait_all", wraps=wait_all) as waits, \
+             patch.object(RuleHelper, "update_dns_entries") as update_dns_entries:
+            primary.return_value.db_conn.return_value.get_wal_position.return_value = 100
+            errors = helper.update_all_dns_entries(replicas)
+        waits.assert_called_once()
+        self.assertEqual(3, len(waits.call_args.args[0]))
+        self.assertEqual([replicas[0], replicas[2]], [call.args[0] for call in update_dns_entries.call_args_list])
+        self.assertEqual([None, None], [errors[0], errors[2]])
+        self.assertIsInstance(errors[1], WaitTimeout)
+        for replica in replicas:
+            replica.release_conn.assert_called_with()
+
+
+class PostgresConnectionPoolTest(SimpleTestCase):
+
+    @staticmethod
+    def make_pool():
+        pool = PostgresConnectionPool.__new__(PostgresConnectionPool)
+        pool.__init__()
+        return pool
+
+    @staticmethod
+    def make_conn():
+        return MagicMock(closed=0, **{"get_transaction_status.return_value": TRANSACTION_STATUS_IDLE})
+
+    def test_released_connections_are_reused(self):
+        """
+        A second checkout for the same node gets the released connection back
+        """
+        pool = self.make_pool()
+        with patch("engine.postgres_wrapper.connect", side_effect=lambda *args: self.make_conn()) as connect:
+            key, conn = pool.acquire("10.0.0.1", "user", "pass", "db")
+            pool.release(key, conn)
+            self.assertIs(conn, pool.acquire("10.0.0.1", "user", "pass", "db")[1])
+            self.assertIsNot(conn, pool.acquire("10.0.0.2", "user", "pass", "db")[1])
+            self.assertEqual(2, connect.call_count)
+
+    def test_closed_connections_are_not_pooled(self):
+        """
+        Connections that broke while in use are thrown away
+        """
+        pool = self.make_pool()
+        with patch("engine.postgres_wrapper.connect", side_effect=lambda *args: self.make_conn()):
+            key, conn = pool.acquire("10.0.0.1", "user", "pass", "db")
+            conn.closed = 2
+            pool.release(key, conn)
+            self.assertIsNot(conn, pool.acquire("10.0.0.1", "user", "pass", "db")[1])
+
+    def test_idle_connections_are_capped_per_node(self):
+        """
+        Only POSTGRES_POOL_MAX_IDLE_PER_NODE idle connections are kept for each node
+        """
+        pool = self.make_pool()
+        with patch("engine.postgres_wrapper.connect", side_effect=lambda *args: self.make_conn()), \
+                self.settings(POSTGRES_POOL_MAX_IDLE_PER_NODE=2):
+            checked_out = [pool.acquire("10.0.0.1", "user", "pass", "db") for _ in range(3)]
+            for key, conn in checked_out:
+                pool.release(key, conn)
+            self.assertEqual(2, len(pool.idle[checked_out[0][0]]))
+            checked_out[0][1].close.assert_called_once()
+
+
+class CronIntentTest(SimpleTestCase):
+
+    def test_each_replica_of_a_wave_has_its_own_intent(self):
+        """
+        Resizing a wave, every replica's intent stays in the crontab until that replica is done
+        """
+        tab = CronTab(tab="")
+        released = dict((instance_id, threading.Event()) for instance_id in ["i-1", "i-2"])
+        intents_written = threading.Barrier(3)
+
+        def scale_instance(instance, *args):
+            intents_written.wait(5)
+            return released[instance.instanceId].wait(5)
+
+        helpers = list()
+        for instance_id in released:
+            helper = DbHelper.__new__(DbHelper)
+            helper.instance = MagicMock(instanceId=instance_id, instanceType="r5.xlarge")
+            helper.aws = MagicMock()
+            helper.aws.scale_instance.side_effect = scale_instance
+            helpers.append(helper)
+
+        def intents():
+            return sorted(job.comment for job in tab)
+
+        def until(expected):
+            Waiter(f"intents {expected}", timeout=5, initial=0.01, maximum=0.01).wait(lambda: intents() == expected)
+
+        with patch("engine.rules.cronutils.CronTab", return_value=tab), patch.object(tab, "write"), \
+             patch("engine.rules.cronutils.advisory_lock"):
+            wave = threading.Thread(target=run_concurrently, args=(lambda helper: helper.update_instance_type("r5.large", 7), helpers, 2))
+            wave.start()
+            intents_written.wait(5)
+            self.assertEqual(["intent_7_i-1", "intent_7_i-2"], intents())
+            released["i-1"].set()
+            until(["intent_7_i-2"])
+            released["i-2"].set()
+            wave.join(5)
+            until([])
+
+
+class NodeSnapshotTest(SimpleTestCase):
+
+    def test_checks_share_one_snapshot(self):
+        """
+        Every check of a rule evaluation reads from a single snapshot query
+        """
+        helper = DbHelper.__new__(DbHelper)
+        helper.conn = MagicMock()
+        helper.conn.get_node_snapshot.side_effect = lambda usernames=None: NodeSnapshot(
+            in_recovery=True, replication_lag=1, load_avg=10, active_connections=5, streaming=True,
+            usernames=usernames, user_connections=3 if usernames else None)
+        rule_json = {
+            "replicationLag": {"op": "less", "value": 5},
+            "averageLoad": {"op": "less", "value": 20},
+            "checkConnection": {"op": "greater", "value": 2},
+        }
+        self.assertTrue(helper.check_replication_lag(rule_json, False))
+        self.assertTrue(helper.check_average_load(rule_json, False))
+        self.assertTrue(helper.check_connections(rule_json, False))
+        self.assertEqual(10, helper.get_system_load_avg())
+        self.assertEqual(1, helper.conn.get_node_snapshot.call_count)
+
+        self.assertEqual(3, helper.count_user_connections(["app"]))
+        self.assertEqual(3, helper.count_user_connections(["app"]))
+        self.assertEqual(2, helper.conn.get_node_snapshot.call_count)
+
+
+class MetricsHelperTest(TestCase):
+
+    def setUp(self):
+        self.node = Ec2DbInfo.objects.create(instance_id="i-metrics", type="EC2", last_instance_type="t2.small")
+
+    def add_sample(self, when, load, lag=0, connections=1):
+        return NodeMetricSample.objects.create(node=self.node, time=when, day=when.date(), load_avg=load,
+                                               replication_lag=lag, active_connections=connections, streaming=True)
+
+    def test_old_samples_are_downsampled(self):
+        """
+        Raw samples past the cutoff are rolled up into one row per bucket
+        """
+        start = timezone.now().replace(hour=3, minute=0, second=0, microsecond=0) - timezone.timedelta(days=10)
+        for minute, load in enumerate([1, 2, 3, 10]):
+            self.add_sample(start + timezone.timedelta(minutes=minute), load, lag=minute)
+        recent = self.add_sample(timezone.now(), 5)
+
+        with self.settings(METRICS_DOWNSAMPLE_AFTER_DAYS=7, METRICS_DOWNSAMPLE_BUCKET=900):
+            MetricsHelper.downsample()
+
+        rollup = NodeMetricSample.objects.get(bucket_seconds=900)
+        self.assertEqual(start, rollup.time)
+        self.assertEqual(4, rollup.load_avg)
+        self.assertEqual(3, rollup.replication_lag)
+        self.assertEqual(2, NodeMetricSample.objects.count())
+        self.assertTrue(NodeMetricSample.objects.filter(id=recent.id).exists())
+
+    def test_expired_samples_are_pruned(self):
+        self.add_sample(timezone.now() - timezone.timedelta(days=100), 1)
+        self.add_sample(timezone.now(), 1)
+        with self.settings(METRICS_RETENTION_DAYS=90):
+            self.assertEqual(1, MetricsHelper.prune())
+        self.assertEqual(1, NodeMetricSample.objects.count())
+
+    def test_rules_can_use_stored_samples(self):
+        """
+        With RULES_USE_STORED_METRICS a fresh sample is used instead of querying the node
+        """
+        self.add_sample(timezone.now(), 7, lag=2, connections=4)
+        helper = DbHelper.__new__(DbHelper)
+        helper.db_info = self.node
+        helper.conn = MagicMock()
+        with self.settings(RULES_USE_STORED_METRICS=True, METRICS_MAX_SAMPLE_AGE=60):
+            snapshot = helper.get_snapshot()
+        self.assertEqual(7, snapshot.load_avg)
+        self.assertEqual(2, snapshot.replication_lag)
+        helper.conn.get_node_snapshot.assert_not_called()
+
+    def test_windowed_clauses_aggregate_stored_samples(self):
+        """
+        Clauses with an agg and window are checked against stored samples, not the live value
+        """
+        for load in [1, 2, 3, 4, 50]:
+            self.add_sample(timezone.now(), load)
+        self.add_sample(timezone.now() - timezone.timedelta(hours=2), 100)
+        helper = DbHelper.__new__(DbHelper)
+        helper.db_info = self.node
+        helper.conn = MagicMock()
+
+        self.assertEqual(50, helper.get_metric({"agg": "max", "window": "30m"}, "load_avg"))
+        self.assertEqual(12, helper.get_metric({"agg": "mean", "window": "30m"}, "load_avg"))
+        self.assertEqual(100, helper.get_metric({"agg": "max", "window": "3h"}, "load_avg"))
+        self.assertTrue(helper.check_average_load({"averageLoad": {"agg": "p50", "window": "30m", "op": "less", "value": 4}}, False))
+        with self.assertRaises(Exception):
+            helper.check_average_load({"averageLoad": {"agg": "p95", "window": "30m", "op": "less", "value": 4}}, False)
+        helper.conn.get_node_snapshot.assert_not_called()
+
+
+class SchedulerTest(SimpleTestCase):
+
+    def test_cron_expressions(self):
+        monday_9_15 = datetime(2021, 3, 1, 9, 15)
+        self.assertTrue(CronUtil.cron_matches("*/15 9-17 * * mon-fri", monday_9_15))
+        self.assertTrue(CronUtil.cron_matches("15 9 1 3 *", monday_9_15))
+        self.assertFalse(CronUtil.cron_matches("*/15 9-17 * * 0,6", monday_9_15))
+        self.assertFalse(CronUtil.cron_matches("0 * * * *", monday_9_15))
+        # When both day fields are restricted, either one matching is enough
+        self.assertTrue(CronUtil.cron_matches("15 9 2 * 1", monday_9_15))
+        self.assertTrue(CronUtil.cron_matches("15 9 * * 7", datetime(2021, 3, 7, 9, 15)))
+
+    def test_rules_are_due_on_schedule(self):
+        daily = MagicMock(run_type="DAILY", run_at=["21:30"])
+        self.assertTrue(CronUtil.is_due(daily, datetime(2021, 3, 1, 21, 30)))
+        self.assertFalse(CronUtil.is_due(daily, datetime(2021, 3, 1, 21, 31)))
+        cron = MagicMock(run_type="CRON", run_at=["0 6 * * *", "30 18 * * *"])
+        self.assertTrue(CronUtil.is_due(cron, datetime(2021, 3, 1, 18, 30)))
+        self.assertFalse(CronUtil.is_due(cron, datetime(2021, 3, 1, 12, 0)))
+
+    def test_failed_rules_are_retried(self):
+        rule = MagicMock(rule={"retry": {"retry_after": 15, "retry_max": 3}}, attempts=1, working_pid=None,
+                         last_run=timezone.now() - timezone.timedelta(minutes=20))
+        self.assertTrue(SchedulerCommand.is_retry_due(rule))
+        rule.last_run = timezone.now() - timezone.timedelta(minutes=5)
+        self.assertFalse(SchedulerCommand.is_retry_due(rule))
+        rule.attempts = 0
+        rule.last_run = timezone.now() - timezone.timedelta(minutes=20)
+        self.assertFalse(SchedulerCommand.is_retry_due(rule))
+
+
+class AWSClientCacheTest(TestCase):
+
+    @mock_ec2
+    def test_region_clients_are_built_on_demand(self):
+        """
+        Setting up a service builds no clients; each region's client is built once and shared
+        """
+        AWSServices.clear_clients()
+        service = EC2Service.__new__(EC2Service)
+        service.__init__()
+        self.assertEqual(dict(), AWSServices._clients)
+
+        client = service.ec2_client_region_dict["eu-west-1"]
+        self.assertIs(client, service.ec2_client_region_dict["eu-west-1"])
+        self.assertIs(client, AWSServices.get_client("ec2", "eu-west-1"))
+        self.assertEqual([("ec2", "eu-west-1")], list(AWSServices._clients.keys()))
+
+    @mock_ec2
+    @mock_sts
+    def test_clients_follow_the_stored_secret(self):
+        """
+        A secret changed from another process is used once the credentials TTL is over, without clear_clients
+        """
+        AWSServices.clear_clients()
+        self.addCleanup(AWSServices.clear_clients)
+        self.addCleanup(CredentialsProvider().invalidate)
+        secret = DbCredentials.objects.create(name="aws", description="AWS Secrets", user_name="AKIAFIRST", password="first")
+        with self.settings(CREDENTIALS_CACHE_TTL=60):
+            CredentialsProvider().invalidate()
+            client = AWSServices.get_client("ec2", "eu-west-1")
+            self.assertEqual("AKIAFIRST", client._request_signer._credentials.access_key)
+            secret.user_name = "AKIASECOND"
+            secret.password = "second"
+            secret.save()
+            # Still within the TTL, the old credentials are kept
+            self.assertIs(client, AWSServices.get_client("ec2", "eu-west-1"))
+        with self.settings(CREDENTIALS_CACHE_TTL=0):
+            rotated = AWSServices.get_client("ec2", "eu-west-1")
+            self.assertIsNot(client, rotated)
+            self.assertEqual("AKIASECOND", rotated._request_signer._credentials.access_key)
+            self.assertIs(rotated, AWSServices.get_client("ec2", "eu-west-1"))
+
+
+class EC2SyncTest(TestCase):
+
+    def setUp(self):
+        self.mock_ec2 = mock_ec2()
+        self.mock_ec2.start()
+        self.addCleanup(self.mock_ec2.stop)
+        AWSServices.clear_clients()
+        Settings.objects.create(name="ec2", value="True")
+        Settings.objects.create(name="EC2_INSTANCE_POSTGRES_TAG_KEY_NAME", value="Role")
+        Settings.objects.create(name="EC2_INSTANCE_POSTGRES_TAG_KEY_VALUE", value="postgresql")
+        Settings.objects.create(name="AWS_us-east-1", description="us-east-1", value="True", type=AWS_REGION)
+        ec2 = boto3.resource("ec2", "us-east-1")
+        for name in ["primary", "secondry"]:
+            ec2.create_instances(ImageId='i-12345', MinCount=5, MaxCount=5, InstanceType="t3.small",
+                                 TagSpecifications=MockEc2Data.get_tags(name))
+
+    def sync(self):
+        # The mocked probes read the test's uncommitted rows, so they run in the test's own thread
+        with self.settings(TOPOLOGY_PROBE_MAX_WORKERS=1),\
+             patch.object(PostgresData, "__init__", new=MockPostgresData.define_value),\
+             patch.object(PostgresData, "is_ec2_postgres_instance_primary", new=MockPostgresData.is_ec2_postgres_instance_primary),\
+             patch.object(PostgresData, "get_all_slave_servers", new=MockPostgresData.get_all_slave_servers),\
+             patch.object(PostgresData, "close", new=MockPostgresData.close):
+            return EC2Service().get_instances()
+
+    def test_sync_upserts_instances(self):
+        """
+        Syncing twice updates the rows from the first sync rather than duplicating them
+        """
+        self.assertEqual(10, len(self.sync()))
+        self.assertEqual(10, AllEc2InstancesData.objects.count())
+        self.assertEqual(10, Ec2DbInfo.objects.count())
+        cluster = ClusterInfo.objects.get(name="ec2-testing-dummy")
+        self.assertEqual(5, Ec2DbInfo.objects.filter(isPrimary=False, cluster=cluster).count())
+
+        first_sync = dict(AllEc2InstancesData.objects.values_list("instanceId", "lastUpdated"))
+        self.sync()
+        self.assertEqual(10, AllEc2InstancesData.objects.count())
+        self.assertEqual(10, Ec2DbInfo.objects.count())
+        # Nothing changed, so nothing was rewritten
+        self.assertEqual(first_sync, dict(AllEc2InstancesData.objects.values_list("instanceId", "lastUpdated")))
+
+    def test_sync_applies_only_the_differences(self):
+        """
+        Changed instances get updated and instances that went away are removed
+        """
+        self.sync()
+        ec2 = boto3.client("ec2", "us-east-1")
+        changed, gone = sorted(AllEc2InstancesData.objects.values_list("instanceId", flat=True))[:2]
+        ec2.create_tags(Resources=[changed], Tags=[{"Key": "Owner", "Value": "dba"}])
+        ec2.terminate_instances(InstanceIds=[gone])
+        before = dict(AllEc2InstancesData.objects.values_list("instanceId", "lastUpdated"))
+
+        self.sync()
+        after = dict(AllEc2InstancesData.objects.values_list("instanceId", "lastUpdated"))
+        self.assertNotIn(gone, after)
+        self.assertFalse(Ec2DbInfo.objects.filter(instance_id=gone).exists())
+        self.assertIn({"Key": "Owner", "Value": "dba"}, AllEc2InstancesData.objects.get(instanceId=changed).tags)
+        self.assertLess(before[changed], after[changed])
+        self.assertEqual([changed], [instance_id for instance_id in after if after[instance_id] != before[instance_id]])
+
+    def test_sync_keeps_stopped_instances(self):
+        """
+        A stopped instance, e.g. a replica being resized, keeps its rows and DNS entries and is only marked disconnected
+        """
+        self.sync()
+        stopped = Ec2DbInfo.objects.filter(isPrimary=False).order_by("instance_id").first()
+        dns = DNSData.objects.create(hosted_zone_name="example.com", dns_name="replica.example.com",
+                                     match_type="MATCH_INSTANCE", instance=stopped)
+        boto3.client("ec2", "us-east-1").stop_instances(InstanceIds=[stopped.instance_id])
+
+        found = self.sync()
+        self.assertNotIn(stopped.instance_id, found)
+        self.assertEqual(10, AllEc2InstancesData.objects.count())
+        self.assertEqual("stopped", AllEc2InstancesData.objects.get(instanceId=stopped.instance_id).state["Name"])
+        self.assertFalse(Ec2DbInfo.objects.get(id=stopped.id).isConnected)
+        self.assertTrue(DNSData.objects.filter(id=dns.id).exists())
+
+    def test_failing_region_does_not_block_others(self):
+        """
+        A region that can't be described is skipped and its rows are left alone
+        """
+        self.sync()
+        Settings.objects.create(name="AWS_eu-west-1", description="eu-west-1", value="True", type=AWS_REGION)
+        elsewhere = AllEc2InstancesData.objects.first()
+        elsewhere.instanceId = "i-elsewhere"
+        elsewhere.region = "eu-west-1"
+        elsewhere.save()
+        describe_region = EC2Service.describe_region
+
+        def flaky_describe_region(service, region, filters):
+            if region == "eu-west-1":
+                raise Exception("throttled")
+            return describe_region(service, region, filters)
+
+        with patch.object(EC2Service, "describe_region", new=flaky_describe_region):
+            found = self.sync()
+        self.assertEqual(10, len(found))
+        self.assertEqual(11, AllEc2InstancesData.objects.count())
+        self.assertTrue(AllEc2InstancesData.objects.filter(instanceId="i-elsewhere").exists())
+
+
+class TopologyDiscoveryTest(TestCase):
+    """
+    Discovery with the probes on worker threads. The mocked nodes answer from memory,
+    as worker threads can't read the test's uncommitted rows.
+    """
+    # ip -> (name, is_primary, replica ips); 10.0.9.9 refuses connections
+    nodes = {
+        "10.0.0.1": ("a", True, ["10.0.0.2", "10.0.0.3"]),
+        "10.0.0.2": ("a", False, []),
+        "10.0.0.3": ("a", False, []),
+        "10.0.1.1": ("b", True, ["10.0.1.2", "10.0.9.9"]),
+        "10.0.1.2": ("b", False, []),
+        "10.0.9.9": ("b", False, []),
+    }
+
+    def setUp(self):
+        AllEc2InstancesData.objects.bulk_create([
+            AllEc2InstancesData(instanceId=f"i-{ip}", region="us-east-1", name=cluster, instanceType="t3.small", keyName="",
+                                launchTime=timezone.now(), availabilityZone="us-east-1a", privateDnsName="", privateIpAddress=ip,
+                                publicDnsName="", publicIpAddress="", state={"Code": 16, "Name": "running"}, subnetId="",
+                                vpcId="vpc-1", architecture="x86_64", blockDeviceMapping=[], ebsOptimized="False", securityGroups=[],
+                                tags=[{"Key": "Project", "Value": "pygmy"}, {"Key": "Environment", "Value": "test"},
+                                      {"Key": "Cluster", "Value": cluster}],
+                                virtualizationType="hvm", cpuOptions={})
+            for ip, (cluster, is_primary, replicas) in self.nodes.items()])
+        self.threads = set()
+
+    def connect(self, host, *args, **kwargs):
+        self.threads.add(threading.current_thread())
+        if host == "10.0.9.9":
+            raise psycopg2.OperationalError("connection refused")
+        cluster, is_primary, replicas = self.nodes[host]
+        return MagicMock(is_ec2_postgres_instance_primary=MagicMock(return_value=is_primary),
+                         get_all_slave_servers=MagicMock(return_value=replicas))
+
+    def discover(self):
+        with patch("engine.aws.ec_wrapper.PostgresData", side_effect=self.connect), \
+             patch.object(CredentialsProvider, "get", return_value=None):
+            graph = EC2Service().discover_topology(list(AllEc2InstancesData.objects.order_by("instanceId")))
+        stored = dict((db.instance_id, (db.isPrimary, db.isConnected, db.cluster.name if db.cluster else None))
+                      for db in Ec2DbInfo.objects.select_related("cluster"))
+        return dict((primary.instanceId, sorted(replicas)) for primary, replicas in graph.items()), stored
+
+    def test_concurrent_discovery_matches_serial(self):
+        with self.settings(TOPOLOGY_PROBE_MAX_WORKERS=4):
+            concurrent = self.discover()
+        self.assertNotIn(threading.main_thread(), self.threads)
+        Ec2DbInfo.objects.all().delete()
+        ClusterInfo.objects.all().delete()
+        self.threads = set()
+        with self.settings(TOPOLOGY_PROBE_MAX_WORKERS=1):
+            serial = self.discover()
+        self.assertEqual({threading.main_thread()}, self.threads)
+        self.assertEqual(serial, concurrent)
+
+        graph, stored = concurrent
+        self.assertEqual({"i-10.0.0.1": ["10.0.0.2", "10.0.0.3"], "i-10.0.1.1": ["10.0.1.2", "10.0.9.9"]}, graph)
+        self.assertEqual((True, True, "pygmy-test-a"), stored["i-10.0.0.1"])
+        self.assertEqual((False, True, "pygmy-test-a"), stored["i-10.0.0.3"])
+        self.assertEqual((False, True, "pygmy-test-b"), stored["i-10.0.1.2"])
+        # The node that couldn't be probed is marked disconnected without holding up the others
+        self.assertEqual((False, False, "pygmy-test-b"), stored["i-10.0.9.9"])
+
+
+class InventoryEventsTest(TestCase):
+
+    def setUp(self):
+        self.mock_ec2 = mock_ec2()
+        self.mock_ec2.start()
+        self.addCleanup(self.mock_ec2.stop)
+        AWSServices.clear_clients()
+        Settings.objects.create(name="ec2", value="True")
+        Settings.objects.create(name="rds", value="False")
+        Settings.objects.create(name="EC2_INSTANCE_POSTGRES_TAG_KEY_NAME", value="Role")
+        Settings.objects.create(name="EC2_INSTANCE_POSTGRES_TAG_KEY_VALUE", value="postgresql")
+        Settings.objects.create(name="AWS_us-east-1", description="us-east-1", value="True", type=AWS_REGION)
+        ec2 = boto3.resource("ec2", "us-east-1")
+        self.primary = ec2.create_instances(ImageId='i-12345', MinCount=1, MaxCount=1, InstanceType="t3.small",
+                                            TagSpecifications=MockEc2Data.get_tags("primary"))[0].id
+        self.replica = ec2.create_instances(ImageId='i-12345', MinCount=1, MaxCount=1, InstanceType="t3.small",
+                                            TagSpecifications=MockEc2Data.get_tags("secondry"))[0].id
+
+    @staticmethod
+    def state_change(instance_id, state, time="2021-06-01T10:00:00Z", region="us-east-1"):
+        return {"detail-type": "EC2 Instance State-change Notification", "source": "aws.ec2", "region": region,
+                "time": time, "detail": {"instance-id": instance_id, "state": state}}
+
+    def apply(self, events):
+        # The mocked probes read the test's uncommitted rows, so they run in the test's own thread
+        with self.settings(TOPOLOGY_PROBE_MAX_WORKERS=1),\
+             patch.object(PostgresData, "__init__", new=MockPostgresData.define_value),\
+             patch.object(PostgresData, "is_ec2_postgres_instance_primary", new=MockPostgresData.is_ec2_postgres_instance_primary),\
+             patch.object(PostgresData, "get_all_slave_servers", new=MockPostgresData.get_all_slave_servers),\
+             patch.object(PostgresData, "close", new=MockPostgresData.close):
+            return InventoryEvents.apply(InventoryEvents.load("\n".join(json.dumps(event) for event in events)))
+
+    def test_events_update_only_their_instances(self):
+        with patch.object(EC2Service, "describe_region", wraps=EC2Service().describe_region) as describe_region:
+            result = self.apply([self.state_change(self.replica, "running"), self.state_change(self.primary, "running")])
+        # Both instances were read in one call, and nothing else was
+        self.assertEqual(1, describe_region.call_count)
+        self.assertEqual(2, result["updated"])
+        self.assertEqual({self.primary, self.replica}, set(AllEc2InstancesData.objects.values_list("instanceId", flat=True)))
+        primary = Ec2DbInfo.objects.get(instance_id=self.primary)
+        self.assertTrue(primary.isPrimary)
+        self.assertEqual(primary.cluster, Ec2DbInfo.objects.get(instance_id=self.replica).cluster)
+
+    def test_latest_event_wins(self):
+        self.apply([self.state_change(self.replica, "running")])
+        result = self.apply([self.state_change(self.replica, "running", time="2021-06-01T10:05:00Z"),
+                             self.state_change(self.replica, "stopped", time="2021-06-01T10:02:00Z"),
+                             self.state_change("i-other", "running", region="eu-west-1")])
+        self.assertEqual(1, result["ignored"])
+        self.assertEqual("running", AllEc2InstancesData.objects.get(instanceId=self.replica).state["Name"])
+
+        self.apply([self.state_change(self.replica, "stopping"), self.state_change(self.replica, "stopped", time="2021-06-01T10:01:00Z")])
+        self.assertEqual({"Code": 80, "Name": "stopped"}, AllEc2InstancesData.objects.get(instanceId=self.replica).state)
+        self.assertFalse(Ec2DbInfo.objects.get(instance_id=self.replica).isConnected)
+
+    def test_wrapped_and_untimed_events_are_ordered(self):
+        def sns(event):
+            return {"Type": "Notification", "Timestamp": "2021-06-01T09:00:00.000Z", "Message": json.dumps(event)}
+        untimed = self.state_change(self.replica, "stopping")
+        del untimed["time"]
+        # The SNS envelope's Timestamp doesn't count, the wrapped event's time does
+        latest = InventoryEvents.latest([sns(self.state_change(self.replica, "stopped", time="2021-06-01T10:05:00Z")),
+                                         self.state_change(self.replica, "running", time="2021-06-01T10:02:00Z")])
+        self.assertEqual("stopped", latest[("EC2", "us-east-1", self.replica)])
+        # An event without a time stays after the timed event before it in the feed
+        latest = InventoryEvents.latest([self.state_change(self.replica, "running", time="2021-06-01T10:00:00Z"), untimed,
+                                         self.state_change(self.primary, "running", time="2021-06-01T09:00:00Z")])
+        self.assertEqual("stopping", latest[("EC2", "us-east-1", self.replica)])
+        self.assertEqual([self.primary, self.replica], [instance_id for _, _, instance_id in latest])
+
+    def test_terminated_instances_are_forgotten(self):
+        self.apply([self.state_change(self.primary, "running"), self.state_change(self.replica, "running")])
+        boto3.client("ec2", "us-east-1").terminate_instances(InstanceIds=[self.replica])
+        result = self.apply([self.state_change(self.replica, "terminated")])
+        self.assertEqual(1, result["removed"])
+        self.assertFalse(AllEc2InstancesData.objects.filter(instanceId=self.replica).exists())
+        self.assertFalse(Ec2DbInfo.objects.filter(instance_id=self.replica).exists())
+        self.assertTrue(Ec2DbInfo.objects.filter(instance_id=self.primary).exists())
+
+
+class DBHandlerTest(TestCase):
+
+    @staticmethod
+    def stored():
+        # The engine's own db handler writes from its thread too, so only look at what this test logged
+        return Log.objects.filter(module__in=["tests", "db_logger"]).order_by("time", "id")
+
+    def make_logger(self, **kwargs):
+        # A long flush interval keeps the writer thread out of the way; the test flushes by hand
+        handler = DBHandler(flush_interval=3600, **kwargs)
+        self.addCleanup(handler.close)
+        logger = logging.getLogger(f"engine.tests.{self._testMethodName}")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return logger, handler
+
+    def test_records_are_written_in_batches(self):
+        logger, handler = self.make_logger(batch_size=2)
+        for n in range(4):
+            logger.info(f"#Rule {n}: step")
+        logger.debug("no rule here")
+        self.assertEqual(0, self.stored().count())
+
+        with self.assertNumQueries(3):
+            handler.flush()
+        self.assertEqual([0, 1, 2, 3, None], [log.rule_id for log in self.stored()])
+
+    def test_forked_process_starts_its_own_writer(self):
+        logger, handler = self.make_logger()
+        logger.info("before the fork")
+        parent_worker, parent_queue = handler.worker, handler.queue
+        # What a forked child sees: the parent's pid, queue and thread object, but no running thread
+        handler.pid = -1
+        with patch.object(parent_worker, "is_alive", return_value=False):
+            logger.info("in the child")
+        self.assertIsNot(parent_worker, handler.worker)
+        self.assertTrue(handler.worker.is_alive())
+        self.assertEqual(os.getpid(), handler.pid)
+        self.assertEqual(1, parent_queue.qsize())
+        self.assertEqual(["in the child"], [entry[4] for entry in handler.take_batch()])
+
+    def test_old_logs_are_pruned_in_batches(self):
+        now = timezone.now()
+        Log.objects.bulk_create([Log(time=now - timedelta(days=days), module="tests", message=str(days)) for days in range(0, 10)])
+        with self.settings(LOG_PRUNE_BATCH_SIZE=2):
+            call_command("prune_logs", days=5, stdout=StringIO())
+        self.assertEqual(["0", "1", "2", "3", "4"], sorted(self.stored().values_list("message", flat=True)))
+
+    def test_log_api_pages_by_cursor(self):
+        now = timezone.now()
+        Log.objects.bulk_create([Log(time=now - timedelta(minutes=minutes), module="tests", level_name="INFO" if minutes % 2 else "ERROR",
+                                     message=str(minutes), rule_id=7) for minutes in range(0, 5)])
+        self.client.force_login(get_user_model().objects.create_user("logs@example.com", "logs"))
+        url = reverse("log_api_list") + "?format=json&page_size=2&rule_id=7"
+        pages = list()
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url).json()
+            # Neither counted nor offset
+            self.assertFalse([query for query in queries.captured_queries if "COUNT(" in query["sql"] or "OFFSET" in query["sql"]])
+            self.assertNotIn("count", response)
+            pages.append([log["message"] for log in response["results"]])
+            url = response["next"]
+        self.assertEqual([["0", "1"], ["2", "3"], ["4"]], pages)
+
+        errors = self.client.get(reverse("log_api_list") + "?format=json&rule_id=7&level=error").json()
+        self.assertEqual(["0", "2", "4"], [log["message"] for log in errors["results"]])
+        self.assertContains(self.client.get(reverse("log_list")), 'id="log_filters"', count=1)
+
+    def test_log_api_pages_through_logs_sharing_a_time(self):
+        now = timezone.now()
+        logs = Log.objects.bulk_create([Log(time=now - timedelta(minutes=n // 3), module="tests", message=str(n), rule_id=7)
+                                        for n in range(7)])
+        self.client.force_login(get_user_model().objects.create_user("logs@example.com", "logs"))
+        url = reverse("log_api_list") + "?format=json&page_size=2&rule_id=7"
+        seen = list()
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url).json()
+            # Ties on time are broken by id, so every page boundary falls in the same place
+            order_by = 'ORDER BY "{0}"."time" DESC, "{0}"."id" DESC'.format(Log._meta.db_table)
+            self.assertTrue([query for query in queries.captured_queries if order_by in query["sql"]])
+            seen.extend(log["id"] for log in response["results"])
+            url = response["next"]
+        self.assertEqual([log.id for log in sorted(logs, key=lambda log: (log.time, log.id), reverse=True)], seen)
+
+    def test_full_queue_drops_the_least_important_records(self):
+        logger, handler = self.make_logger(max_queue=2)
+        logger.info("first")
+        logger.info("second")
+        logger.info("dropped")
+        logger.warning("important")
+        handler.flush()
+        self.assertEqual(["second", "important", "Dropped 2 log records because the log queue was full"],
+                         list(self.stored().values_list("message", flat=True)))
+
+
+class ListAPITest(TestCase):
+    def setUp(self):
+        self.cluster = ClusterInfo.objects.create(name="paged", primaryNodeIp="10.0.0.1", type="EC2")
+        other = ClusterInfo.objects.create(name="other", primaryNodeIp="10.0.0.2", type="EC2")
+        rule = Rules.objects.create(cluster=self.cluster, rule={}, action=SCALE_UP, run_type="Daily", run_at=["0 0 * * *"])
+        other_rule = Rules.objects.create(cluster=other, rule={}, action=SCALE_UP, run_type="Daily", run_at=["0 0 * * *"])
+        ActionLogs.objects.bulk_create([ActionLogs(rule=rule, msg=str(n), status=bool(n % 2)) for n in range(5)])
+        ActionLogs.objects.create(rule=other_rule, msg="other")
+
+    def pages(self, url):
+        pages = list()
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url).json()
+            self.assertFalse([query for query in queries.captured_queries if "COUNT(" in query["sql"] or "OFFSET" in query["sql"]])
+            pages.append(response["results"])
+            url = response["next"]
+        return pages
+
+    def test_actions_are_paged_filtered_and_projected(self):
+        self.assertIn(self.client.get(reverse("action_api_list") + "?format=json").status_code, [401, 403])
+        self.client.force_login(get_user_model().objects.create_user("actions@example.com", "actions"))
+        pages = self.pages(reverse("action_api_list") + f"?format=json&page_size=2&cluster={self.cluster.id}&fields=msg")
+        self.assertEqual([[{"msg": "4"}, {"msg": "3"}], [{"msg": "2"}, {"msg": "1"}], [{"msg": "0"}]], pages)
+
+        failed = self.client.get(reverse("action_api_list") + f"?format=json&cluster={self.cluster.id}&status=false").json()
+        self.assertEqual(["4", "2", "0"], [action["msg"] for action in failed["results"]])
+        self.assertEqual(400, self.client.get(reverse("action_api_list") + "?format=json&cluster=nope").status_code)
+
+        before = ActionLogs.objects.get(msg="2").id
+        self.assertEqual(["1", "0"], [action.msg for action in self.client.get(reverse("action_list") + f"?before={before}").context["actions"]])
+
+    def test_rules_and_clusters_are_paged(self):
+        pages = self.pages("/v1/api/clusters?format=json&page_size=1&fields=name")
+        self.assertEqual([[{"name": "paged"}], [{"name": "other"}]], pages)
+        rules = self.client.get("/v1/api/rules?format=json&cluster_name=other").json()
+        self.assertEqual([ClusterInfo.objects.get(name="other").id], [rule["cluster"] for rule in rules["results"]])
+
+
+class InstanceQueryCountTest(TestCase):
+    def setUp(self):
+        self.ec2 = ClusterInfo.objects.create(name="ec2-cluster", primaryNodeIp="10.0.0.1", type="EC2")
+        self.rds = ClusterInfo.objects.create(name="rds-cluster", primaryNodeIp="10.0.0.2", type="RDS")
+        self.client.force_login(get_user_model().objects.create_user("counts@example.com", "counts"))
+
+    def add_instances(self, start, count):
+        ec2 = AllEc2InstancesData.objects.bulk_create([AllEc2InstancesData(
+            instanceId=f"i-{n}", region="us-east-1", name=f"node-{n}", instanceType="m5.large", keyName="", launchTime=timezone.now(),
+            availabilityZone="us-east-1a", privateDnsName="", privateIpAddress="", publicDnsName="", publicIpAddress="",
+            state={"Name": "running"}, subnetId="", vpcId="", architecture="", blockDeviceMapping=[], ebsOptimized="",
+            securityGroups=[], tags=[], virtualizationType="", cpuOptions={}) for n in range(start, start + count)])
+        rds = RdsInstances.objects.bulk_create([RdsInstances(
+            dbInstanceIdentifier=f"db-{n}", region="us-east-1", dbInstanceClass="db.m5.large", dbName="postgres", engine="postgres",
+            dbInstanceStatus="available", dbEndpoint={}, dbStorage="", dbVpcSecurityGroups=[], masterUsername="", preferredBackupWindow="",
+            availabilityZone="us-east-1a", dBParameterGroups=[], engineVersion="", licenseModel="", tagList=[]) for n in range(start, start + count)])
+        Ec2DbInfo.objects.bulk_create([Ec2DbInfo(instance_object=instance, instance_id=instance.instanceId, cluster=self.ec2, type="EC2",
+                                                 isPrimary=instance.instanceId == "i-0") for instance in ec2]
+                                      + [Ec2DbInfo(instance_object=instance, instance_id=instance.dbInstanceIdentifier, cluster=self.rds, type="RDS",
+                                                   isPrimary=instance.dbInstanceIdentifier == "db-0") for instance in rds])
+
+    def count_queries(self, fetch):
+        with CaptureQueriesContext(connection) as queries:
+            fetch()
+        return len(queries.captured_queries)
+
+    def test_pages_are_a_constant_number_of_queries(self):
+        pages = dict({
+            "landing": lambda: self.assertContains(self.client.get(reverse("landing")), "db.m5.large"),
+            "ec2 cluster": lambda: self.assertContains(self.client.get(reverse("clusters", args=[self.ec2.id])), "m5.large"),
+            "rds cluster": lambda: self.assertContains(self.client.get(reverse("clusters", args=[self.rds.id])), "db.m5.large"),
+            "instances api": lambda: self.client.get("/v1/api/instances?format=json&page_size=500").json(),
+        })
+        self.add_instances(0, 5)
+        few = dict((name, self.count_queries(fetch)) for name, fetch in pages.items())
+        self.add_instances(5, 1000)
+        many = dict((name, self.count_queries(fetch)) for name, fetch in pages.items())
+        self.assertEqual(few, many)
+
+    def test_rule_helper_loads_instances_with_the_rows(self):
+        self.add_instances(0, 20)
+        rule = Rules.objects.create(cluster=self.ec2, rule={}, action=SCALE_UP, run_type="Daily", run_at=["0 0 * * *"])
+        helper = RuleHelper(rule)
+        # The rows, then the EC2 instances
+        with self.assertNumQueries(2):
+            instances = [db.instance_object.instanceType for db in helper.secondary_dbs]
+        self.assertEqual(19, len(instances))
+        with self.assertNumQueries(2):
+            self.assertEqual("i-0", helper.primary_db().instance_object.instanceId)
+            self.assertEqual("i-0", helper.primary_db().instance_id)
+
+
+class InstanceTypeCatalogTest(TestCase):
+    def setUp(self):
+        InstanceTypeCatalog().invalidate()
+        self.addCleanup(InstanceTypeCatalog().invalidate)
+        for instance_type, vcpus, memory in [("m5.xlarge", 4, 16384), ("m5.large", 2, 8192), ("r5.large", 2, 16384)]:
+            AllEc2InstanceTypes.objects.create(instance_type=instance_type, virtual_cpu_info={"DefaultVCpus": vcpus}, memory_info={"SizeInMiB": memory})
+
+    def type_queries(self, queries):
+        return [query for query in queries.captured_queries if "instancetypes" in query["sql"]]
+
+    def test_catalog_is_loaded_once_and_indexed(self):
+        with self.assertNumQueries(1):
+            catalog = InstanceTypeCatalog().get("EC2")
+            self.assertIs(catalog, InstanceTypeCatalog().get("EC2"))
+        self.assertEqual(["m5.large", "m5.xlarge", "r5.large"], catalog.types)
+        self.assertEqual([{"instance_type": "m5.large", "value": "m5.large", "data": "m5.large"}], json.loads(catalog.json)[:1])
+        self.assertEqual(["m5.large", "m5.xlarge"], catalog.family("m5.24xlarge"))
+        self.assertEqual(["m5.large", "r5.large"], catalog.by_vcpus[2])
+        self.assertEqual(["r5.large", "m5.xlarge"], catalog.by_memory[16384])
+
+        with override_settings(INSTANCE_TYPE_CATALOG_TTL=0):
+            self.assertIsNot(catalog, InstanceTypeCatalog().get("EC2"))
+
+    @patch.object(EC2Service, "get_instance_types", return_value=[{"InstanceType": "c5.large"}])
+    def test_saving_types_invalidates_the_catalog(self, get_instance_types):
+        self.assertNotIn("c5.large", InstanceTypeCatalog().get("EC2").types)
+        EC2Service().save_instance_types()
+        self.assertEqual(["c5"], list(InstanceTypeCatalog().get("EC2").by_family)[:1])
+
+    def test_rule_forms_dont_read_the_types(self):
+        self.client.force_login(get_user_model().objects.create_user("catalog@example.com", "catalog"))
+        self.assertContains(self.client.get(reverse("create_rule")), "m5.xlarge")
+        with CaptureQueriesContext(connection) as queries:
+            self.assertContains(self.client.get(reverse("create_rule")), "r5.large")
+        self.assertEqual([], self.type_queries(queries))
+
+
+class CredentialsProviderTest(TestCase):
+    def setUp(self):
+        CredentialsProvider().invalidate()
+        self.addCleanup(CredentialsProvider().invalidate)
+        DbCredentials.objects.create(name="ec2", description="EC2 Postgres Secrets", user_name="postgres", password="pg-secret")
+        self.aws = DbCredentials.objects.create(name="aws", description="AWS Secrets", user_name="AKIA", password="aws-secret")
+
+    def test_secrets_are_decrypted_once(self):
+        with patch.object(CryptoUtil, "decode", autospec=True, side_effect=CryptoUtil.decode) as decode, self.assertNumQueries(1):
+            for _ in range(5):
+                self.assertEqual("pg-secret", CredentialsProvider().get("ec2").password)
+                self.assertEqual(dict({"AWS_ACCESS_KEY_ID": "AKIA", "AWS_SECRET_ACCESS_KEY": "aws-secret"}), CredentialsProvider().aws_env())
+            self.assertIsNone(CredentialsProvider().get("rds"))
+        self.assertEqual(2, decode.call_count)
+
+        with override_settings(CREDENTIALS_CACHE_TTL=0), self.assertNumQueries(1):
+            CredentialsProvider().get("ec2")
+
+    @patch("webapp.views.AWSUtil.update_aws_region_list")
+    @patch.object(AWSServices, "clear_clients")
+    def test_saving_a_secret_invalidates_the_cache(self, clear_clients, update_aws_region_list):
+        self.assertEqual("aws-secret", CredentialsProvider().get("aws").password)
+        self.client.force_login(get_user_model().objects.create_user("secrets@example.com", "secrets"))
+        response = self.client.post(reverse("edit_secrets", args=[self.aws.id]), {"username": "AKIA2", "password": "rotated"})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("rotated", CredentialsProvider().get("aws").password)
+        self.assertEqual(dict({"AWS_ACCESS_KEY_ID": "AKIA2", "AWS_SECRET_ACCESS_KEY": "rotated"}), CredentialsProvider().aws_env())
+        clear_clients.assert_called_once_with()
+
+
+def echo_hook(*args, env=None):
+    if args[0] == "fail":
+        raise Exception("asked to fail")
+    return " ".join(args) + (f" as {env['AWS_ACCESS_KEY_ID']}" if env else "")
+
+
+HOOK_WORKER = """
+import json, os, sys
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["args"][0] == "die":
+        sys.exit(3)
+    print(json.dumps(dict(id=request["id"], ok=request["args"][0] != "fail", returncode=1, output=f"{os.getpid()} {request['hook']}")), flush=True)
+"""
+
+
+class HookRunnerTest(SimpleTestCase):
+    def setUp(self):
+        self.addCleanup(HookRunner().close)
+
+    @override_settings(PYGMY_HOOKS={"pre-resize": {"callable": "engine.tests.echo_hook"}})
+    def test_callable_hooks_run_in_process(self):
+        self.assertEqual("i-1 as AKIA", HookRunner().run("pre-resize", ["i-1"], env={"AWS_ACCESS_KEY_ID": "AKIA"}))
+        with self.assertRaises(HookError):
+            HookRunner().run("pre-resize", ["fail"])
+
+    @override_settings(PYGMY_HOOKS={"post-streaming": {"worker": [sys.executable, "-c", HOOK_WORKER], "processes": 2}})
+    def test_workers_are_reused_and_replaced(self):
+        pids = set(HookRunner().run("post-streaming", [f"i-{n}"]).split()[0] for n in range(5))
+        self.assertEqual(1, len(pids))
+        # Run concurrently, the calls share at most two workers
+        results = run_concurrently(lambda n: HookRunner().run("post-streaming", [f"i-{n}"]), range(8), 4)
+        self.assertLessEqual(len(set(result.split()[0] for _, result, _ in results)), 2)
+
+        with self.assertRaises(HookError) as failed:
+            HookRunner().run("post-streaming", ["fail"])
+        self.assertEqual(1, failed.exception.returncode)
+        with self.assertRaises(HookError):
+            HookRunner().run("post-streaming", ["die"])
+        self.assertTrue(HookRunner().run("post-streaming", ["i-1"]).endswith(" post-streaming"))
+
+    def test_scripts_are_the_fallback(self):
+        with tempfile.TemporaryDirectory() as scripts:
+            script = os.path.join(scripts, "dns-change.sh")
+            with open(script, "w") as f:
+                f.write("#!/bin/sh\necho \"$@\"\nexit $2\n")
+            os.chmod(script, 0o755)
+            with override_settings(PYGMY_HOOKS={"dns-change": {"script": script}}):
+                self.assertEqual("SCALE_UP 0\n", HookRunner().run("dns-change", ["SCALE_UP", 0]))
+                with self.assertRaises(HookError) as failed:
+                    HookRunner().run("dns-change", ["SCALE_UP", 2])
+                self.assertEqual(2, failed.exception.returncode)
+
+
+class Route53BatchTest(TestCase):
+    def setUp(self):
+        self.mock_route53 = mock_route53()
+        self.mock_route53.start()
+        self.addCleanup(self.mock_route53.stop)
+        AWSServices.clear_clients()
+        self.addCleanup(AWSServices.clear_clients)
+        self.client = AWSServices.get_client("route53", settings.DEFAULT_REGION)
+        self.zone_id = self.client.create_hosted_zone(Name="example.com", CallerReference="pygmy-tests")["HostedZone"]["Id"]
+
+    def records(self):
+        return dict((record["Name"], record["ResourceRecords"][0]["Value"]) for record in
+                    self.client.list_resource_record_sets(HostedZoneId=self.zone_id)["ResourceRecordSets"] if record["Type"] == "A")
+
+    def test_changes_are_batched_per_zone(self):
+        batch = Route53Batch()
+        batch.add("example.com", "replica1.example.com", "A", "10.0.0.1")
+        batch.add("example.com.", "replicas.example.com", "A", "10.0.0.1")
+        batch.add("example.com", "replicas.example.com", "A", "10.0.0.2")
+        batch.add("missing.example.org", "replica3.missing.example.org", "A", "10.0.0.3")
+        with patch.object(self.client, "change_resource_record_sets", wraps=self.client.change_resource_record_sets) as change:
+            results = batch.submit()
+        change.assert_called_once()
+        self.assertEqual(2, len(change.call_args.kwargs["ChangeBatch"]["Changes"]))
+        self.assertEqual([None, None, None], results[:3])
+        self.assertIn("missing.example.org", str(results[3]))
+        self.assertEqual(dict({"replica1.example.com.": "10.0.0.1", "replicas.example.com.": "10.0.0.2"}), self.records())
+
+    @override_settings(DNS_UPDATER="route53")
+    def test_scale_down_wave_moves_dns_in_one_batch(self):
+        helper = ResizeWaveTest.make_helper(4, 3, 0)
+        helper.action, helper.cluster_type, helper.rule = SCALE_DOWN, "EC2", MagicMock(id=7)
+        replicas = [MagicMock() for n in range(3)]
+        for n, replica in enumerate(replicas):
+            replica.db_info.id = n
+        changes = [("replica0.example.com", "example.com", "10.0.0.9", "10.0.0.1"), None,
+                   ("replica2.example.com", "missing.example.org", "10.0.0.9", "10.0.0.3")]
+        with patch.object(RuleHelper, "get_dns_change", side_effect=changes), \
+             patch.object(RuleHelper, "resize_replica", return_value=True) as resize_replica, \
+             patch.object(RuleHelper, "run_post_streaming_script"), \
+             patch.object(DbHelper, "wait_till_all_streaming", side_effect=lambda helpers: [None] * len(helpers)), \
+             patch.object(self.client, "change_resource_record_sets", wraps=self.client.change_resource_record_sets) as change:
+            results = helper.resize_wave([(replica, "t3.large", 0) for replica in replicas])
+        change.assert_called_once()
+        self.assertEqual(dict({"replica0.example.com.": "10.0.0.9"}), self.records())
+        # The replica whose DNS couldn't be moved is left alone
+        self.assertEqual([replicas[0], replicas[1]], [call.args[0] for call in resize_replica.call_args_list])
+        self.assertEqual([(True, None), (True, None)], [result[1:] for result in results[:2]])
+        self.assertEqual(False, results[2][1])
+
+
+class DNSResolverTest(TestCase):
+    def setUp(self):
+        self.cluster = ClusterInfo.objects.create(name="dns", primaryNodeIp="10.0.0.1", type="EC2")
+        other = ClusterInfo.objects.create(name="other-dns", primaryNodeIp="10.0.0.2", type="EC2")
+        self.primary = Ec2DbInfo.objects.create(instance_id="i-primary", cluster=self.cluster, isPrimary=True, type="EC2")
+        self.replicas = [Ec2DbInfo.objects.create(instance_id=f"i-{n}", cluster=self.cluster, type="EC2") for n in range(3)]
+        DNSData.objects.create(hosted_zone_name="example.com", dns_name="replica0.example.com", match_type="MATCH_INSTANCE", instance=self.replicas[0])
+        DNSData.objects.create(hosted_zone_name="example.com", dns_name="replicas.example.com", match_type="MATCH_ROLE", cluster=self.cluster, tag_role="Secondary")
+        DNSData.objects.create(hosted_zone_name="example.com", dns_name="other.example.com", match_type="MATCH_ROLE", cluster=other, tag_role="Reporting")
+
+    def make_helper(self, db, role):
+        helper = MagicMock(db_info=db)
+        helper.aws.get_tag_map.return_value = dict({settings.EC2_INSTANCE_ROLE_TAG_KEY_NAME: role}) if role else dict()
+        return helper
+
+    def test_entries_are_loaded_once(self):
+        resolver = DNSResolver(self.cluster)
+        helpers = [self.make_helper(self.replicas[0], "Secondary"), self.make_helper(self.replicas[1], "Secondary"),
+                   self.make_helper(self.replicas[2], "Reporting"), self.make_helper(self.replicas[2], None)]
+        with self.assertNumQueries(1):
+            entries = [resolver.resolve(helper) for helper in helpers]
+        self.assertEqual(["replica0.example.com", "replicas.example.com", None, None],
+                         [entry.dns_name if entry else None for entry in entries])
+        # The instance match wins without looking at the tags
+        helpers[0].aws.get_tag_map.assert_not_called()
+
+    def test_primary_address_is_looked_up_once(self):
+        rule = Rules.objects.create(cluster=self.cluster, rule={}, action=SCALE_DOWN, run_type="Daily", run_at=["0 0 * * *"])
+        helper = RuleHelper(rule)
+        with patch("engine.rules.rules_helper.DbHelper") as db_helper:
+            db_helper.return_value.get_endpoint_address.return_value = "10.0.0.1"
+            self.assertEqual(["10.0.0.1"] * 3, [helper.get_primary_address() for _ in range(3)])
+        db_helper.assert_called_once_with(self.primary)
+
+
+class BlackoutCalendarTest(TestCase):
+
+    def setUp(self):
+        self.cluster = ClusterInfo.objects.create(name="blackout", primaryNodeIp="10.0.0.1", type="EC2")
+        self.other = ClusterInfo.objects.create(name="other", primaryNodeIp="10.0.0.2", type="EC2")
+        self.calendar = BlackoutCalendar()
+        self.calendar.invalidate()
+        self.addCleanup(self.calendar.invalidate)
+
+    def entry(self, cluster):
+        return dict({"id": cluster.id, "value": cluster.clusterName})
+
+    def test_dates_and_ranges_are_parsed(self):
+        self.assertEqual([datetime(2021, 4, 30).date(), datetime(2021, 5, 1).date(), datetime(2021, 5, 2).date()],
+                         parse_dates("2021-05-01/2021-05-02, 2021-04-30, 2021-05-01"))
+        self.assertEqual(31, len(parse_dates(["2021-03-01/2021-03-31"])))
+        for bad in ["2021-05-02/2021-05-01", "tomorrow", "2021-02-30"]:
+            with self.assertRaises(ValueError):
+                parse_dates(bad)
+
+    def test_ranges_are_added_with_constant_queries(self):
+        with CaptureQueriesContext(connection) as one_day:
+            self.calendar.add(parse_dates("2021-04-01"), [self.entry(self.cluster)])
+        with CaptureQueriesContext(connection) as one_month:
+            self.calendar.add(parse_dates("2021-05-01/2021-05-31"), [self.entry(self.cluster), self.entry(self.other)])
+        self.assertEqual(len(one_day), len(one_month))
+        self.assertEqual(32, ExceptionData.objects.count())
+        self.assertEqual(63, Blackout.objects.count())
+        self.assertEqual([self.entry(self.cluster), self.entry(self.other)],
+                         ExceptionData.objects.get(exception_date="2021-05-15").clusters)
+
+    def test_dates_are_merged_or_replaced(self):
+        may_day = datetime(2021, 5, 1).date()
+        self.calendar.add([may_day], [self.entry(self.cluster)])
+        self.calendar.add([may_day], [self.entry(self.other), dict({"id": 0, "value": "gone"})])
+        self.assertEqual({self.cluster.id, self.other.id}, self.calendar.clusters_on(may_day))
+        self.assertEqual(2, len(ExceptionData.objects.get(exception_date=may_day).clusters))
+
+        self.calendar.add([may_day], [self.entry(self.other)], replace=True)
+        self.assertEqual({self.other.id}, self.calendar.clusters_on(may_day))
+        self.assertEqual([self.entry(self.other)], ExceptionData.objects.get(exception_date=may_day).clusters)
+
+        self.calendar.delete(ExceptionData.objects.get(exception_date=may_day).id)
+        self.assertFalse(self.calendar.is_blacked_out(self.other.id, may_day))
+        self.assertFalse(Blackout.objects.exists())
+
+    def test_lookups_are_cached(self):
+        today = timezone.now().date()
+        self.calendar.add([today], [self.entry(self.cluster)])
+        with self.assertNumQueries(1):
+            self.assertTrue(self.calendar.is_blacked_out(self.cluster.id))
+            self.assertFalse(self.calendar.is_blacked_out(self.other.id))
+            self.assertTrue(self.calendar.is_blacked_out(self.cluster.id, today))
+        with override_settings(BLACKOUT_CACHE_TTL=0), self.assertNumQueries(1):
+            self.calendar.is_blacked_out(self.cluster.id)
+
+    def test_dates_saved_before_blackouts_still_apply(self):
+        june = datetime(2021, 6, 1).date()
+        ExceptionData.objects.create(exception_date=june, clusters=[self.entry(self.cluster), dict({"id": 0, "value": "gone"})])
+        self.assertTrue(self.calendar.is_blacked_out(self.cluster.id, june))
+        self.assertFalse(self.calendar.is_blacked_out(self.other.id, june))
+        self.assertEqual([self.cluster.id], list(Blackout.objects.filter(exception_date=june).values_list("cluster_id", flat=True)))
+        self.assertFalse(self.calendar.is_blacked_out(self.cluster.id, datetime(2021, 6, 2).date()))
+
+    def test_rebuild_from_exception_dates(self):
+        ExceptionData.objects.create(exception_date="2021-06-01", clusters=[self.entry(self.cluster), dict({"id": 0, "value": "gone"})])
+        self.assertEqual(1, self.calendar.rebuild())
+        self.assertTrue(self.calendar.is_blacked_out(self.cluster.id, datetime(2021, 6, 1).date()))
+
+    @patch("engine.management.commands.run_scheduler.CronUtil.is_due", return_value=True)
+    def test_scheduler_skips_blacked_out_rules(self, is_due):
+        Rules.objects.create(cluster=self.cluster, rule={}, action=SCALE_UP, run_type="Daily", run_at=["0 0 * * *"])
+        other_rule = Rules.objects.create(cluster=self.other, rule={}, action=SCALE_UP, run_type="Daily", run_at=["0 0 * * *"])
+        self.calendar.add([timezone.now().date()], [self.entry(self.cluster)])
+        self.assertEqual([other_rule], SchedulerCommand.due_rules(datetime.now()))
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from engine.concurrency import close_db_connections
+logger = logging.getLogger(__name__)
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+class Waiter:
+    """
+    Poll a check until it returns something truthy, sleeping longer after every miss.
+
+    Delays start at initial seconds and grow by factor up to maximum. Each delay is shortened
+    at random by up to jitter (a fraction of it) so that many waiters don't poll in lockstep.
+    A check that raises one of retry_on counts as a miss; anything else is raised right away.
+    If timeout seconds pass first, WaitTimeout is raised.
+    """
+    def __init__(self, description, timeout=None, initial=None, maximum=None, factor=2, jitter=0.5, retry_on=Exception):
+        self.description = description
+        self.timeout = timeout
+        self.initial = initial if initial is not None else settings.WAIT_BACKOFF_INITIAL
+        self.maximum = maximum if maximum is not None else settings.WAIT_BACKOFF_MAX
+        self.factor = factor
+        self.jitter = jitter
+        self.retry_on = retry_on
+
+    def __repr__(self):
+        return "<Waiter %s timeout:%s>" % (self.description, self.timeout)
+
+    def delays(self):
+        delay = self.initial
+        while True:
+            yield delay * (1 - random.uniform(0, self.jitter))
+            delay = min(delay * self.factor, self.maximum)
+
+    def next_delay(self, delays, deadline, attempts):
+        """
+        How long to sleep before the next attempt, cut short by the deadline
+        """
+        delay = next(delays)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise WaitTimeout(f"Gave up waiting for {self.description} after {attempts} attempts in {self.timeout}s")
+            delay = min(delay, remaining)
+        logger.debug(f"{self.description} not yet; attempt {attempts}, checking again in {delay:.1f}s")
+        return delay
+
+    def miss(self, e):
+        logger.debug(f"Checking {self.description} failed: {e}")
+        return None
+
+    def wait(self, check):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        delays = self.delays()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                result = check()
+            except self.retry_on as e:
+                result = self.miss(e)
+            if result:
+                return result
+            time.sleep(self.next_delay(delays, deadline, attempts))
+
+    async def wait_async(self, check, executor=None):
+        """
+        Like wait, but sleeps on the event loop so many waits can share one thread.
+        Coroutine checks are awaited; plain checks are run on executor so they can't stall the loop.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        delays = self.delays()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                if asyncio.iscoroutinefunction(check):
+                    result = await check()
+                else:
+                    result = await loop.run_in_executor(executor, check)
+            except self.retry_on as e:
+                result = self.miss(e)
+            if result:
+                return result
+            await asyncio.sleep(self.next_delay(delays, deadline, attempts))
+
+
+def wait_all(waits, max_workers):
+    """
+    Run every (waiter, check) pair in waits at once from the calling thread.
+    At most max_workers plain checks are in flight at a time; nothing holds a thread while sleeping.
+
+    Returns a list of (result, exception) tuples in the same order as waits.
+    """
+    waits = list(waits)
+    if not waits:
+        return list()
+
+    async def run(executor):
+        # Plain checks run on pool threads, which must not keep django db connections open
+        return await asyncio.gather(*(waiter.wait_async(check if asyncio.iscoroutinefunction(check) else close_db_connections(check), executor)
+                                      for waiter, check in waits), return_exceptions=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        results = asyncio.run(run(executor))
+    return [(None, result) if isinstance(result, Exception) else (result, None) for result in results]
@@ -1,48 +1,140 @@
+import os
 import re
+import sys
+import atexit
 import logging
+import queue
+import threading
+from datetime import datetime, timezone
+
+RULE_ID = re.compile(r"#Rule\s+(\d+)")
 
 
 class DBHandler(logging.Handler):
-    backup_logger = "test"
+    """
+    Store log records in the Log table without putting an INSERT on the logging thread.
+
+    emit only formats the record and puts it on a queue of at most max_queue records.
+    A background thread writes them with bulk_create once batch_size have queued up or
+    flush_interval seconds have passed, and whatever is still queued is written at exit.
+    When the queue is full a new record is dropped, unless it is a warning or worse, in
+    which case the oldest queued record makes room for it. Dropped records are counted
+    and reported in the log itself.
+
+    A process forked after the thread was started (uwsgi without lazy-apps) starts its own
+    writer, with its own queue, the first time it logs.
+    """
+    def __init__(self, level=logging.NOTSET, batch_size=200, flush_interval=2.0, max_queue=10000):
+        super(DBHandler, self).__init__(level)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.stopping = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.worker = None
+        self.pid = os.getpid()
+        atexit.register(self.close)
 
     def emit(self, record: logging.LogRecord) -> None:
-        from pygmy.models import Log
         try:
             message = self.format(record)
+            last_line = message.rsplit("\n", 1)[-1]
+            rule_id = RULE_ID.search(last_line)
+            entry = (datetime.fromtimestamp(record.created, tz=timezone.utc), record.levelname, record.module,
+                     record.lineno, message, last_line, int(rule_id.group(1)) if rule_id else None)
+            self.start()
+            self.enqueue(entry, record.levelno)
+        except Exception:
+            self.handleError(record)
+
+    def enqueue(self, entry, levelno):
+        try:
+            self.queue.put_nowait(entry)
+            return
+        except queue.Full:
+            pass
+        if levelno >= logging.WARNING:
             try:
-                last_line = message.rsplit("\n", 1)[-1]
-            except Exception as e:
-                last_line = None
+                self.queue.get_nowait()
+                self.dropped += 1
+                self.queue.put_nowait(entry)
+                return
+            except (queue.Empty, queue.Full):
+                pass
+        self.dropped += 1
+
+    def start(self):
+        if self.stopping.is_set():
+            return
+        if self.worker is None or self.pid != os.getpid() or not self.worker.is_alive():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # We were forked: the parent's writer thread didn't come along, its flush lock may have
+                    # been held when we were, and what it had queued is the parent's to write
+                    self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                    self.flush_lock = threading.Lock()
+                    self.dropped = 0
+                    self.worker = None
+                    self.pid = os.getpid()
+                if self.worker is None or not self.worker.is_alive():
+                    self.worker = threading.Thread(target=self.run, name="db-log-writer", daemon=True)
+                    self.worker.start()
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.stopping.wait(self.flush_interval)
+            self.flush()
+
+    def take_batch(self):
+        batch = list()
+        while len(batch) < self.batch_size:
             try:
-                # Log = apps.get_model("pygmy.models", "Log")
-                new_log = Log(
-                    level_name=record.levelname,
-                    module=record.module,
-                    message=message,
-                    last_line=last_line)
-
-                if last_line:
-                    new_log.object = self.check_rule_id(last_line)
-
-                new_log.save()
-            except Exception as e:
-                if self.backup_logger:
-                    try:
-                        getattr(self.backup_logger, record.levelname.lower())(record.message)
-                    except Exception as e:
-                        print(e)
-                else:
-                    print(e)
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """
+        Write everything queued so far, batch_size records per INSERT
+        """
+        from django.apps import apps
+        if not apps.ready:
+            return
+        with self.flush_lock:
+            while True:
+                batch = self.take_batch()
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    message = f"Dropped {dropped} log records because the log queue was full"
+                    batch.append((datetime.now(tz=timezone.utc), "WARNING", "db_logger", None, message, message, None))
+                if not batch:
+                    break
+                self.write(batch)
+                if len(batch) < self.batch_size:
+                    break
+
+    def write(self, batch):
+        from django.db import connection
+        from pygmy.models import Log
+        try:
+            Log.objects.bulk_create([Log(time=time, level_name=level_name, module=module, line_no=line_no,
+                                         message=message, last_line=last_line, rule_id=rule_id)
+                                     for time, level_name, module, line_no, message, last_line, rule_id in batch])
         except Exception as e:
-            print(e)
+            print(f"Failed to store {len(batch)} log records: {e}", file=sys.stderr)
+        finally:
+            # Don't hold a database connection open between batches from the writer thread
+            if threading.current_thread() is self.worker:
+                connection.close()
 
-    def check_rule_id(self, last_line):
-        from engine.models import Rules
-        check_rule_id = re.match(r"#Rule[\s](\d+)", last_line)
-        if check_rule_id:
-            rule_id = (check_rule_id.group())
-            try:
-                return Rules.objects.get(id=rule_id)
-            except Rules.DoesNotExits:
-                pass
-        return None
+    def close(self):
+        self.stopping.set()
+        if self.worker is not None and self.worker is not threading.current_thread():
+            self.worker.join(timeout=self.flush_interval + 5)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Failed to store queued log records at exit: {e}", file=sys.stderr)
+        super(DBHandler, self).close()
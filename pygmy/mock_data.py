@@ -3,6 +3,7 @@ from moto import mock_rds, mock_rds2, mock_ec2
 import boto3
 
 from engine.models import AllEc2InstancesData, Ec2DbInfo, ClusterInfo
+from engine.postgres_wrapper import NodeSnapshot
 
 
 class MockData:
@@ -207,9 +208,12 @@ class MockEc2Data:
 
 class MockPostgresData:
 
-    def define_value(self, DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT=5432):
+    def define_value(self, DB_HOST, DB_USER, DB_PASS, DB_NAME, DB_PORT=5432, expect_errors=False, pool=None):
         self.host = DB_HOST
 
+    def close(self):
+        pass
+
     def is_ec2_postgres_instance_primary(self):
         db = AllEc2InstancesData.objects.get(privateIpAddress=self.host)
         if db.name == "primary":
@@ -227,6 +231,14 @@ class MockPostgresData:
     def get_system_load_avg_40(self):
         return 40
 
+    def get_node_snapshot_20(self, usernames=None):
+        return NodeSnapshot(in_recovery=True, replication_lag=0, load_avg=20, active_connections=0, streaming=True,
+                            usernames=usernames, user_connections=0 if usernames else None)
+
+    def get_node_snapshot_40(self, usernames=None):
+        return NodeSnapshot(in_recovery=True, replication_lag=0, load_avg=40, active_connections=0, streaming=True,
+                            usernames=usernames, user_connections=0 if usernames else None)
+
 
 class MockRdsData:
     mock_describe_instance_types = {
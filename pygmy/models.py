@@ -1,11 +1,20 @@
 from django.db import models
+from django.utils import timezone
 
 
 class Log(models.Model):
-    time = models.DateTimeField(null=False, auto_now_add=True)
+    time = models.DateTimeField(null=False, default=timezone.now)
     level_name = models.CharField(null=True, max_length=255)
     module = models.CharField(null=True, max_length=255)
     line_no = models.IntegerField(null=True)
     message = models.TextField(null=True)
     last_line = models.TextField(null=True)
     object = models.JSONField(null=True)
+    rule_id = models.IntegerField(null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["time", "id"]),
+            models.Index(fields=["level_name", "time", "id"]),
+            models.Index(fields=["rule_id", "time", "id"]),
+        ]
@@ -212,6 +212,89 @@ EC2_INSTANCE_ROLE_TAG_VALUES = ['Master','Slave','Backup']
 # Leaving the array empty will let Pygmy search all VPCs it would normally find.
 EC2_INSTANCE_VPC_MENU = []
 
+# How rules get run. With "cron" every rule (and its retries) is a crontab entry that starts its own process.
+# With "daemon" the crontab is left alone and the run_scheduler command runs due rules in a single long-lived
+# process, at most SCHEDULER_MAX_WORKERS at a time.
+PYGMY_SCHEDULER = "cron"
+SCHEDULER_MAX_WORKERS = 4
+
+# How many AWS regions are scanned at the same time when discovering instances
+AWS_REGION_SCAN_MAX_WORKERS = 6
+
+# How many instances are asked at the same time whether they are a primary, and for their replicas, during a sync
+TOPOLOGY_PROBE_MAX_WORKERS = 16
+
+# How many replicas a rule will probe (replication lag, connection counts, load) at the same time
+RULE_PROBE_MAX_WORKERS = 8
+
+# Connections to the postgres nodes we manage are pooled per node.
+# Idle connections are closed after POSTGRES_POOL_MAX_IDLE_TIME seconds, and ones that have been idle for
+# more than POSTGRES_POOL_HEALTH_CHECK_AFTER seconds are checked with a SELECT 1 before being reused.
+POSTGRES_POOL_MAX_IDLE_TIME = 300
+POSTGRES_POOL_MAX_IDLE_PER_NODE = 4
+POSTGRES_POOL_HEALTH_CHECK_AFTER = 5
+
+# Waiting for something (a replica to stream again, an instance to come up) polls with exponential backoff,
+# starting at WAIT_BACKOFF_INITIAL seconds and growing up to WAIT_BACKOFF_MAX, with random jitter.
+# A replica that isn't streaming again within REPLICA_STREAMING_TIMEOUT seconds of a resize is given up on,
+# as is an instance that isn't available within INSTANCE_STATUS_TIMEOUT seconds of being started.
+WAIT_BACKOFF_INITIAL = 1
+WAIT_BACKOFF_MAX = 30
+REPLICA_STREAMING_TIMEOUT = 1800
+INSTANCE_STATUS_TIMEOUT = 120
+
+# When scaling up, a resized replica only goes back into DNS once its replay position is within
+# REPLICA_CATCHUP_MAX_LAG_BYTES of the primary's WAL position (None only waits for streaming).
+# The apply rate and catch-up ETA are estimated from the last REPLICA_CATCHUP_WINDOW seconds of samples,
+# and a replica that hasn't caught up within REPLICA_CATCHUP_TIMEOUT seconds is left out of DNS.
+REPLICA_CATCHUP_MAX_LAG_BYTES = 16 * 1024 * 1024
+REPLICA_CATCHUP_WINDOW = 60
+REPLICA_CATCHUP_TIMEOUT = 1800
+
+# The web processes keep the EC2 and RDS instance type lists in memory for INSTANCE_TYPE_CATALOG_TTL seconds,
+# so a refresh_all_db_instance_types run shows up in the rule forms within that time.
+INSTANCE_TYPE_CATALOG_TTL = 900
+
+# Decrypted DbCredentials are kept in memory for CREDENTIALS_CACHE_TTL seconds; a secret changed
+# from another process is used from then on.
+CREDENTIALS_CACHE_TTL = 60
+
+# Which clusters are blacked out on a day is kept in memory for BLACKOUT_CACHE_TTL seconds; exception dates
+# saved from another process (e.g. the web UI, for a running scheduler) apply from then on.
+BLACKOUT_CACHE_TTL = 60
+
+# How each hook (dns-change, pre-resize, post-streaming, call-for-help, downsize-prognostication) is run.
+# By default a hook is scripts/<name>.sh, started for every call. A hook can instead be a python function
+# called in-process, {"callable": "dotted.path"}, or be served by long-lived worker processes speaking
+# line-delimited JSON, {"worker": ["python", "scripts/hook-worker.py"], "processes": 4}; see engine/hooks.py.
+PYGMY_HOOKS = dict()
+
+# How DNS entries are moved during a rule run: "script" runs the dns-change hook for every replica, while
+# "route53" changes them itself, with one Route53 change batch per hosted zone for each wave of replicas.
+# Records are written with a TTL of DNS_RECORD_TTL seconds, and changes not INSYNC within DNS_CHANGE_TIMEOUT
+# seconds count as failed.
+DNS_UPDATER = "script"
+DNS_RECORD_TTL = 60
+DNS_CHANGE_TIMEOUT = 300
+
+# The collect_metrics command samples every connected node each METRICS_COLLECT_INTERVAL seconds.
+# Samples older than METRICS_DOWNSAMPLE_AFTER_DAYS days are rolled up into METRICS_DOWNSAMPLE_BUCKET second
+# buckets, and everything older than METRICS_RETENTION_DAYS days is deleted.
+METRICS_COLLECT_INTERVAL = 60
+METRICS_DOWNSAMPLE_AFTER_DAYS = 7
+METRICS_DOWNSAMPLE_BUCKET = 900
+METRICS_RETENTION_DAYS = 90
+
+# If True, rules check nodes against the newest stored sample instead of querying them,
+# as long as that sample is no older than METRICS_MAX_SAMPLE_AGE seconds.
+RULES_USE_STORED_METRICS = False
+METRICS_MAX_SAMPLE_AGE = 180
+
+# The prune_logs command deletes stored log records older than LOG_RETENTION_DAYS days,
+# LOG_PRUNE_BATCH_SIZE rows per statement so it never holds long locks on the log table.
+LOG_RETENTION_DAYS = 30
+LOG_PRUNE_BATCH_SIZE = 10000
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -238,7 +321,12 @@ LOGGING = {
             'filename': os.path.join(BASE_DIR, 'logs', 'error.log'),
         },
         'db_log': {
-            'class': 'pygmy.db_logger.DBHandler'
+            # Records are written in the background, batch_size at a time or every flush_interval seconds.
+            # At most max_queue records wait to be written; beyond that, new ones are dropped.
+            'class': 'pygmy.db_logger.DBHandler',
+            'batch_size': 200,
+            'flush_interval': 2.0,
+            'max_queue': 10000,
         },
     },
     'loggers': {
@@ -0,0 +1,61 @@
+from django_filters import rest_framework as filters
+from engine.models import Rules, ClusterInfo, ExceptionData, Ec2DbInfo, ActionLogs
+from pygmy.models import Log
+
+
+class RuleFilter(filters.FilterSet):
+    cluster_name = filters.CharFilter(field_name="cluster__name")
+    last_run = filters.IsoDateTimeFromToRangeFilter()
+
+    class Meta:
+        model = Rules
+        fields = ["cluster", "action", "status", "run_type"]
+
+
+class ClusterFilter(filters.FilterSet):
+    class Meta:
+        model = ClusterInfo
+        fields = ["name", "type", "enabled"]
+
+
+class Ec2DbInfoFilter(filters.FilterSet):
+    cluster_name = filters.CharFilter(field_name="cluster__name")
+    lastUpdated = filters.IsoDateTimeFromToRangeFilter()
+
+    class Meta:
+        model = Ec2DbInfo
+        fields = ["cluster", "type", "isPrimary", "isConnected", "last_instance_type"]
+
+
+class ExceptionDataFilter(filters.FilterSet):
+    exception_date = filters.DateFromToRangeFilter()
+    cluster = filters.NumberFilter(method="filter_cluster")
+
+    class Meta:
+        model = ExceptionData
+        fields = ["exception_date"]
+
+    def filter_cluster(self, queryset, name, value):
+        # clusters is a list of {"id": ..., "value": ...}
+        return queryset.filter(clusters__contains=[{"id": int(value)}])
+
+
+class ActionLogsFilter(filters.FilterSet):
+    cluster = filters.NumberFilter(field_name="rule__cluster")
+    time = filters.IsoDateTimeFromToRangeFilter()
+
+    class Meta:
+        model = ActionLogs
+        fields = ["rule", "status"]
+
+
+class LogFilter(filters.FilterSet):
+    level = filters.CharFilter(field_name="level_name", method="filter_level")
+    time = filters.IsoDateTimeFromToRangeFilter()
+
+    class Meta:
+        model = Log
+        fields = ["rule_id", "module"]
+
+    def filter_level(self, queryset, name, value):
+        return queryset.filter(level_name=value.upper())
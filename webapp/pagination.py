@@ -0,0 +1,37 @@
+from django_filters.utils import translate_validation
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Page by position in an indexed ordering instead of COUNT(*) and OFFSET, so every page
+    costs the same no matter how far back it is. Responses carry next/previous cursor links.
+    Views pick the ordering with keyset_ordering; it should be unique and not change, so a
+    non-unique field like time is followed by id to break ties.
+    """
+    ordering = ("-time", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, "keyset_ordering", self.ordering)
+        if isinstance(ordering, str):
+            return (ordering, )
+        return tuple(ordering)
+
+
+class KeysetListMixin:
+    """
+    For APIViews whose get isn't a ListAPIView: filter, page and serialize a queryset
+    the same way the list endpoints do
+    """
+    keyset_ordering = "id"
+
+    def list_response(self, request, queryset, filterset_class, serializer_class):
+        filterset = filterset_class(request.query_params, queryset=queryset, request=request)
+        if not filterset.is_valid():
+            raise translate_validation(filterset.errors)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(filterset.qs, request, view=self)
+        return paginator.get_paginated_response(serializer_class(page, many=True, context={"request": request}).data)
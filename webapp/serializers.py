@@ -1,9 +1,23 @@
 from rest_framework import serializers
-from engine.models import Rules, ClusterInfo, ExceptionData, Ec2DbInfo, DNSData, ClusterManagement
+from engine.models import Rules, ClusterInfo, ExceptionData, Ec2DbInfo, DNSData, ClusterManagement, ActionLogs
 from pygmy.models import Log
 
 
-class RuleSerializer(serializers.ModelSerializer):
+class FieldsMixin:
+    """
+    Lets callers of a list endpoint ask for only some fields, e.g. ?fields=id,name
+    """
+    def __init__(self, *args, **kwargs):
+        super(FieldsMixin, self).__init__(*args, **kwargs)
+        request = self.context.get("request")
+        fields = request.query_params.get("fields") if request is not None else None
+        if fields:
+            wanted = set(field.strip() for field in fields.split(","))
+            for name in set(self.fields) - wanted:
+                self.fields.pop(name)
+
+
+class RuleSerializer(FieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Rules
         fields = ['id', 'name', 'cluster', 'action', 'rule', 'run_at']
@@ -20,24 +34,24 @@ class ToggleClusterSerializer(serializers.Serializer):
     enabled = serializers.BooleanField(help_text="Should Pygmy twiddle this cluster?")
 
 
-class ClusterSerializer(serializers.ModelSerializer):
+class ClusterSerializer(FieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ClusterInfo
         fields = ['id', 'name', 'primaryNodeIp', 'type', 'enabled']
 
 
-class ExceptionDataSerializer(serializers.ModelSerializer):
+class ExceptionDataSerializer(FieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = ExceptionData
         fields = ['id', 'exception_date', 'clusters', 'added_on', 'updated_on']
 
 
 class ExceptionCreateSerializer(serializers.Serializer):
-    dates = serializers.JSONField(help_text="list of valid dates of format YYYY-MM-DD", default=list)
+    dates = serializers.JSONField(help_text="list of valid dates of format YYYY-MM-DD or ranges of format YYYY-MM-DD/YYYY-MM-DD", default=list)
     clusterIds = serializers.JSONField(help_text="list of valid cluster ids", default=list)
 
 
-class Ec2DbInfoSerializer(serializers.ModelSerializer):
+class Ec2DbInfoSerializer(FieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Ec2DbInfo
         fields = ["id", "instance_id", "instance_type", "isPrimary", "cluster"]
@@ -55,7 +69,13 @@ class ClusterManagementSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
-class LogSerializer(serializers.ModelSerializer):
+class LogSerializer(FieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Log
         fields = "__all__"
+
+
+class ActionLogSerializer(FieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ActionLogs
+        fields = ["id", "rule", "time", "msg", "extra_data", "status"]
@@ -2,7 +2,8 @@ from django.urls import path, re_path
 from django.views.generic import TemplateView
 from webapp.view.actions import ActionsView
 from webapp.view.apis import ClusterAPIView, ExceptionApiView, ExceptionEditApiView, ListInstances, CreateDNSEntry, \
-    CreateClusterManagement, EditClusterManagement, ToggleCluster, InProgress
+    CreateClusterManagement, EditClusterManagement, ToggleCluster, InProgress, InventoryEventsAPIView, \
+    ActionLogsAPIView
 from webapp.view.exceptions import ExceptionsView, ExceptionsCreateView, ExceptionsEditView
 from webapp.view.logs import LogsView, LogsApiView
 from webapp.view.rules import CreateRulesView, RulesView, EditRuleView
@@ -41,6 +42,8 @@ urlpatterns = [
     path("v1/api/exceptions", ExceptionApiView.as_view(), name="create_rule_api"),
     path("v1/api/exceptions/<int:id>", ExceptionEditApiView.as_view(), name="create_rule_api"),
     path("v1/api/instances", ListInstances.as_view(), name="create_rule_api"),
+    path("v1/api/actions", ActionLogsAPIView.as_view(), name="action_api_list"),
+    path("v1/api/instances/events", InventoryEventsAPIView.as_view(), name="instance_events_api"),
     path("v1/api/progressing/<str:name>", InProgress.as_view(), name="in_progress"),
     path("v1/api/dns", CreateDNSEntry.as_view(), name="create_rule_api"),
     path("v1/api/cluster/management", CreateClusterManagement.as_view(), name="create_rule_api"),
@@ -7,10 +7,18 @@ from engine.models import ActionLogs
 
 class ActionsView(LoginRequiredMixin, View):
     template = "actions/list.html"
+    size = 500
 
     def get(self, request, *args, **kwargs):
+        # The newest actions, or the ones before ?before=<id>, size at a time
+        actions = ActionLogs.objects.select_related("rule").order_by("-id")
+        before = request.GET.get("before")
+        if before and before.isdigit():
+            actions = actions.filter(id__lt=int(before))
+        actions = list(actions[:self.size])
         return render(request, self.template, {
-            "actions": ActionLogs.objects.all().order_by("-time")
+            "actions": actions,
+            "older": actions[-1].id if len(actions) == self.size else None
         })
 
     def dispatch(self, *args, **kwargs):
@@ -5,12 +5,18 @@ from rest_framework import generics
 from rest_framework.parsers import JSONParser
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from engine.models import Rules, ClusterInfo, ExceptionData, Ec2DbInfo, ClusterManagement, DNSData
+from engine.aws.events import InventoryEvents
+from engine.blackouts import BlackoutCalendar, parse_dates
+from engine.models import Rules, ClusterInfo, ExceptionData, Ec2DbInfo, ClusterManagement, DNSData, ActionLogs
 from engine.rules.rules_helper import RuleHelper
 from engine.rules.cronutils import CronUtil
 from drf_yasg2.utils import swagger_auto_schema
+from django_filters.rest_framework import DjangoFilterBackend
+from webapp.filters import RuleFilter, ClusterFilter, ExceptionDataFilter, Ec2DbInfoFilter, ActionLogsFilter
+from webapp.pagination import KeysetPagination, KeysetListMixin
 from webapp.serializers import RuleSerializer, ExceptionDataSerializer, ClusterSerializer, RuleCreateSerializer, \
-    ExceptionCreateSerializer, Ec2DbInfoSerializer, DNSDataSerializer, ClusterManagementSerializer, ToggleClusterSerializer
+    ExceptionCreateSerializer, Ec2DbInfoSerializer, DNSDataSerializer, ClusterManagementSerializer, ToggleClusterSerializer, \
+    ActionLogSerializer
 from rest_framework.generics import ListAPIView, RetrieveUpdateDestroyAPIView, ListCreateAPIView, UpdateAPIView
 from distutils.util import strtobool
 from django.db import DatabaseError
@@ -19,7 +25,7 @@ from django.conf import settings
 logger = logging.getLogger(__name__)
 
 
-class CreateRuleAPIView(APIView):
+class CreateRuleAPIView(KeysetListMixin, APIView):
     """
     Get or create rules
     """
@@ -29,7 +35,7 @@ class CreateRuleAPIView(APIView):
 
     @swagger_auto_schema(tags=["Rules"], responses={200: RuleSerializer(many=True)})
     def get(self, request):
-        return Response(RuleSerializer(Rules.objects.all(), many=True).data)
+        return self.list_response(request, Rules.objects.all(), RuleFilter, RuleSerializer)
 
     @swagger_auto_schema(tags=["Rules"], request_body=RuleCreateSerializer(), responses={200: '{"success": True}'})
     def post(self, request, format=None):
@@ -100,22 +106,27 @@ class ClusterAPIView(generics.ListAPIView):
     permission_classes = []
     queryset = ClusterInfo.objects.all()
     serializer_class = ClusterSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = "id"
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = ClusterFilter
 
     @swagger_auto_schema(tags=["Cluster"])
     def get(self, request, *args, **kwargs):
         return self.list(request, *args, **kwargs)
 
 
-class ExceptionApiView(APIView):
+class ExceptionApiView(KeysetListMixin, APIView):
     """
     Request: {
-        "dates": "2021-04-06, 2021-04-03",
+        "dates": "2021-04-06, 2021-04-03, 2021-05-01/2021-05-07",
         "clusterIds": [2]
     }
     """
     authentication_classes = []
     permission_classes = []
     parser_classes = [JSONParser]
+    keyset_ordering = "exception_date"
 
     @swagger_auto_schema(tags=["Exceptions"], request_body=ExceptionCreateSerializer(), responses={200: '{"success": True}'})
     def post(self, request):
@@ -124,15 +135,8 @@ class ExceptionApiView(APIView):
         try:
             if dates:
                 clustersList = ClusterInfo.objects.filter(id__in=clusters)
-                datesList = dates.split(",")
-                for date in datesList:
-                    exc, created = ExceptionData.objects.get_or_create(exception_date=date.strip(' '))
-                    clist = list({"id": d.id, "value": d.clusterName} for d in clustersList)
-                    if created:
-                        exc.clusters = clist
-                    else:
-                        exc.clusters = list({v['id']: v for v in exc.clusters + clist}.values())
-                    exc.save()
+                clist = list({"id": d.id, "value": d.clusterName} for d in clustersList)
+                BlackoutCalendar().add(parse_dates(dates), clist)
                 return Response(dict({"success": True}))
         except Exception as e:
             print(e)
@@ -141,7 +145,7 @@ class ExceptionApiView(APIView):
 
     @swagger_auto_schema(tags=["Exceptions"], responses={200: ExceptionDataSerializer(many=True)})
     def get(self, request):
-        return Response(ExceptionDataSerializer(ExceptionData.objects.all(), many=True).data)
+        return self.list_response(request, ExceptionData.objects.all(), ExceptionDataFilter, ExceptionDataSerializer)
 
 
 class ExceptionEditApiView(APIView):
@@ -165,14 +169,11 @@ class ExceptionEditApiView(APIView):
             if dates:
                 clustersList = ClusterInfo.objects.filter(id__in=clusters)
                 clist = list({"id": d.id, "value": d.clusterName} for d in clustersList)
-                datesList = dates.split(",")
-                for date in datesList:
-                    exc, created = ExceptionData.objects.get_or_create(exception_date=date.strip(' '))
-                    if date == str(current_exec.exception_date):
-                        exc.clusters = clist
-                    else:
-                        exc.clusters = list({v['id']: v for v in exc.clusters + clist}.values())
-                    exc.save()
+                days = parse_dates(dates)
+                # The exception being edited gets exactly these clusters, any other date gets them added
+                calendar = BlackoutCalendar()
+                calendar.add([day for day in days if day == current_exec.exception_date], clist, replace=True)
+                calendar.add([day for day in days if day != current_exec.exception_date], clist)
                 return Response({"status": "Success"})
         except Exception as e:
             logger.error(e)
@@ -180,8 +181,7 @@ class ExceptionEditApiView(APIView):
 
     @swagger_auto_schema(operation_description="partial_update description override", tags=["Exceptions"])
     def delete(self, request, id, **kwargs):
-        exc_date = ExceptionData.objects.get(id=id)
-        exc_date.delete()
+        BlackoutCalendar().delete(id)
         return Response({"success": True})
 
 
@@ -191,8 +191,46 @@ class ListInstances(ListAPIView):
     """
     authentication_classes = []
     permission_classes = []
-    queryset = Ec2DbInfo.objects.all()
+    queryset = Ec2DbInfo.objects.with_instances()
     serializer_class = Ec2DbInfoSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = "id"
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = Ec2DbInfoFilter
+
+
+class ActionLogsAPIView(ListAPIView):
+    """
+    List the actions rules have taken, newest first
+    """
+    queryset = ActionLogs.objects.all()
+    serializer_class = ActionLogSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = "-id"
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = ActionLogsFilter
+
+    @swagger_auto_schema(tags=["Rules"])
+    def get(self, request, *args, **kwargs):
+        return self.list(request, *args, **kwargs)
+
+
+class InventoryEventsAPIView(APIView):
+    """
+    Apply EC2 instance state-change and RDS instance events, e.g. from an EventBridge API destination
+    """
+    parser_classes = [JSONParser]
+
+    @swagger_auto_schema(tags=["Instances"], responses={200: '{"success": True, "updated": 1, "removed": 0}'})
+    def post(self, request, format=None):
+        events = request.data if isinstance(request.data, list) else [request.data]
+        try:
+            result = InventoryEvents.apply(events)
+            result.update({"success": True})
+        except Exception as e:
+            logger.exception(e)
+            result = {"error": "could not apply events", "data": str(e)}
+        return Response(result)
 
 
 class CreateDNSEntry(ListCreateAPIView):
@@ -6,6 +6,7 @@ from django.shortcuts import render, redirect
 from datetime import datetime
 from django.views import View
 
+from engine.blackouts import BlackoutCalendar, parse_dates
 from engine.models import ExceptionData, ClusterInfo
 
 
@@ -38,14 +39,7 @@ class ExceptionsCreateView(LoginRequiredMixin, View):
         try:
             if dates:
                 clustersList = json.loads(clusters)
-                datesList = dates.split(",")
-                for date in datesList:
-                    exc, created = ExceptionData.objects.get_or_create(exception_date=date.strip(' '))
-                    if created:
-                        exc.clusters = clustersList
-                    else:
-                        exc.clusters = list({v['id']: v for v in exc.clusters + clustersList}.values())
-                    exc.save()
+                BlackoutCalendar().add(parse_dates(dates), clustersList)
                 return render(request, self.template, {"success": True})
         except Exception as e:
             print(e)
@@ -88,11 +82,7 @@ class ExceptionsEditView(LoginRequiredMixin, View):
         try:
             if dates:
                 clustersList = json.loads(clusters)
-                datesList = dates.split(",")
-                for date in datesList:
-                    exc, created = ExceptionData.objects.get_or_create(exception_date=date.strip(' '))
-                    exc.clusters = clustersList
-                    exc.save()
+                BlackoutCalendar().add(parse_dates(dates), clustersList, replace=True)
                 return render(request, self.template, {"success": True})
         except Exception as e:
             print(e)
@@ -113,5 +103,4 @@ class ExceptionUtils:
 
     @staticmethod
     def delete(id):
-        exc_date = ExceptionData.objects.get(id=id)
-        exc_date.delete()
+        BlackoutCalendar().delete(id)
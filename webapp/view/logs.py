@@ -3,9 +3,11 @@ from django.shortcuts import render
 from django.views import View
 from rest_framework import generics
 from rest_framework.authentication import SessionAuthentication
-from rest_framework_datatables.pagination import DatatablesPageNumberPagination
+from django_filters.rest_framework import DjangoFilterBackend
 
 from pygmy.models import Log
+from webapp.filters import LogFilter
+from webapp.pagination import KeysetPagination
 from webapp.serializers import LogSerializer
 
 
@@ -15,7 +17,7 @@ class LogsView(LoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
         return render(request, self.template, {
-            "logs": Log.objects.order_by("time")[:10]
+            "levels": ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
         })
 
     def dispatch(self, *args, **kwargs):
@@ -23,9 +25,15 @@ class LogsView(LoginRequiredMixin, View):
 
 
 class LogsApiView(generics.ListAPIView):
+    """
+    Newest logs first, a page at a time. Can be narrowed down with ?level=, ?rule_id=, ?module=,
+    ?time_after= and ?time_before=
+    """
     authentication_classes = [SessionAuthentication]
     serializer_class = LogSerializer
-    pagination_class = DatatablesPageNumberPagination
-
-    def get_queryset(self):
-        return Log.objects.all()
+    pagination_class = KeysetPagination
+    # Batched log records often share a time
+    keyset_ordering = ("-time", "-id")
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = LogFilter
+    queryset = Log.objects.all()
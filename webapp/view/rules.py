@@ -13,15 +13,10 @@ from engine.rules.cronutils import CronUtil
 class CreateRulesView(LoginRequiredMixin, View):
     template = "rule/create.html"
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.ec2 = EC2DBHelper.get_instances_types()
-        self.rds = RDSDBHelper.get_instances_types()
-
     def get(self, request, **kwargs):
         return render(request, self.template, {
-            "ec2_types": self.ec2,
-            "rds_types": self.rds,
+            "ec2_types": EC2DBHelper.get_instances_types(),
+            "rds_types": RDSDBHelper.get_instances_types(),
             "clusters": ClusterHelper.get_cluster_list()
         })
 
@@ -54,17 +49,12 @@ class CreateRulesView(LoginRequiredMixin, View):
 class EditRuleView(LoginRequiredMixin, View):
     template = "rule/edit.html"
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.ec2 = EC2DBHelper.get_instances_types()
-        self.rds = RDSDBHelper.get_instances_types()
-
     def get(self, request, id, **kwargs):
         try:
             rule = Rules.objects.get(id=id)
             ctx = {
-                "ec2_types": self.ec2,
-                "rds_types": self.rds,
+                "ec2_types": EC2DBHelper.get_instances_types(),
+                "rds_types": RDSDBHelper.get_instances_types(),
                 "clusters": ClusterHelper.get_cluster_list(),
                 "data": rule,
                 "reverse_rule": rule.child_rule.get() if rule.child_rule.all().count() > 0 else None,
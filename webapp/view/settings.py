@@ -70,7 +70,6 @@ def start_background_sync(sync_setting):
     sync_setting.save()
     if sync_setting.name != "logs":
         aws = AWSUtil.get_aws_service(sync_setting.name.upper())
-        aws.clear_db()
         aws.get_instances()
     sync_setting.in_progress = False
     sync_setting.last_sync = timezone.now()
@@ -7,13 +7,15 @@ from rest_framework.response import Response
 from engine.models import DbCredentials, ClusterInfo, Ec2DbInfo
 from engine.rules.db_helper import DbHelper
 from engine.aws.aws_utils import AWSUtil
+from engine.aws.aws_services import AWSServices
+from engine.credentials import CredentialsProvider
 
 
 class LandingView(LoginRequiredMixin, View):
     template = "home.html"
 
     def get(self, request, **kwargs):
-        dbInfo = Ec2DbInfo.objects.all()
+        dbInfo = Ec2DbInfo.objects.with_instances()
         return render(request, self.template, {
             "dbs": dbInfo
         })
@@ -46,7 +48,9 @@ class SecretsEditView(LoginRequiredMixin, View):
                 secret.user_name = username
                 secret.password = password
                 secret.save()
+                CredentialsProvider().invalidate()
                 if secret.name in ["aws"]:
+                    AWSServices.clear_clients()
                     AWSUtil.update_aws_region_list()
             else:
                 return Response(status=400)
@@ -64,7 +68,7 @@ class ClusterView(LoginRequiredMixin, View):
     def get(self, request, id, **kwargs):
         try:
             cluster = ClusterInfo.objects.get(id=id)
-            instances = Ec2DbInfo.objects.filter(cluster_id=cluster)
+            instances = Ec2DbInfo.objects.with_instances().filter(cluster_id=cluster)
             return render(request, self.template, {
                 "instances": instances,
                 "cluster": cluster,